@@ -0,0 +1,94 @@
+"""
+Copyright (c) 2025 viewstar000
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+
+对比每次新建OpenAI客户端与使用连接池复用客户端的单次请求延迟。
+
+用法: python benchmarks/bench_chat_client.py [-n 200]
+"""
+
+import json
+import time
+import argparse
+import threading
+import statistics
+import openai
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from jupyter_agent import bot_chat
+
+REPLY = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "bench",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps(REPLY).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def bench(make_client, n):
+    messages = [{"role": "user", "content": "ping"}]
+    durations = []
+    for _ in range(n):
+        st = time.perf_counter()
+        make_client().chat.completions.create(model="bench", messages=messages)
+        durations.append((time.perf_counter() - st) * 1000)
+    return durations
+
+
+def report(name, durations):
+    durations = sorted(durations)
+    print(
+        f"{name:<10} mean: {statistics.mean(durations):7.3f}ms  "
+        f"p50: {durations[len(durations) // 2]:7.3f}ms  "
+        f"p90: {durations[int(len(durations) * 0.9)]:7.3f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pooled vs. per-call OpenAI clients")
+    parser.add_argument("-n", type=int, default=200, help="Requests per mode (default: 200)")
+    args = parser.parse_args()
+
+    for name in ("_D", "_I", "_W", "_E", "_B", "_M"):
+        setattr(bot_chat, name, lambda *a, **k: None)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+
+    def fresh_client():
+        return openai.OpenAI(api_key="bench", base_url=base_url)
+
+    pool = bot_chat.ChatClientPool()
+
+    def pooled_client():
+        return pool.get_client(base_url, "bench")
+
+    report("per-call", bench(fresh_client, args.n))
+    report("pooled", bench(pooled_client, args.n))
+    pool.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
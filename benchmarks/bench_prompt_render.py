@@ -0,0 +1,125 @@
+"""
+Copyright (c) 2025 viewstar000
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+
+对比每次新建Jinja环境、使用编译模板注册表、以及注册表加单元格片段缓存三种方式渲染
+50个单元格的Notebook上下文的耗时。
+
+用法: python benchmarks/bench_prompt_render.py [-n 100] [-c 50] [--bytecode-cache-dir DIR]
+"""
+
+import time
+import jinja2
+import argparse
+import statistics
+
+from jupyter_agent import bot_chat, bot_contexts
+from jupyter_agent.bot_agents import base
+from jupyter_agent.utils import TemplateRegistry, get_template_registry, to_json
+
+PROMPT = "{% include 'CELL_CONTEXTS' %}\n\n{% include 'TASK_DATA' %}"
+
+
+def make_cells(count):
+    cells = []
+    for idx in range(count):
+        if idx % 5 == 0:
+            cell = {"cell_type": "markdown", "source": "## Step {}\n\nDescribe step {} in detail.".format(idx, idx)}
+        else:
+            cell = {
+                "cell_type": "code",
+                "source": "df_{0} = df.groupby('k').agg({{'v': 'sum'}})\nprint(df_{0}.head())".format(idx),
+                "outputs": [{"output_type": "stream", "name": "stdout", "text": "k  v\n" + "a  1\n" * 20}],
+            }
+        cell["metadata"] = {}
+        cells.append(bot_contexts.CellContext.from_cell(idx, cell))
+    return cells
+
+
+def make_contexts(cells, cell_context):
+    return {
+        "cells": cells,
+        "task": cells[-1],
+        "merged_important_infos": None,
+        "cell_context": cell_context,
+    }
+
+
+def render_per_call(cells, templates):
+    env = jinja2.Environment(loader=jinja2.DictLoader(templates), trim_blocks=True, lstrip_blocks=True)
+    env.filters["json"] = to_json
+    item = jinja2.Environment(trim_blocks=True, lstrip_blocks=True).from_string(base._CELL_CONTEXT_ITEM)
+
+    def cell_context(cell, merged_important_infos=None):
+        return item.render(cell=cell, merged_important_infos=merged_important_infos)
+
+    return env.from_string(PROMPT).render(**make_contexts(cells, cell_context))
+
+
+def render_registry(cells, templates):
+    item = get_template_registry().get_template(base._CELL_CONTEXT_ITEM)
+
+    def cell_context(cell, merged_important_infos=None):
+        return item.render(cell=cell, merged_important_infos=merged_important_infos)
+
+    return get_template_registry().render(PROMPT, templates, **make_contexts(cells, cell_context))
+
+
+def render_registry_cached(cells, templates):
+    messages = bot_chat.ChatMessages(
+        contexts=make_contexts(cells, base.get_cell_context_cache().render), templates=templates, display_message=False
+    )
+    messages.add(PROMPT)
+    return messages.get()[0]["content"][0]["text"]
+
+
+def bench(render, cells, templates, n):
+    durations = []
+    for _ in range(n):
+        st = time.perf_counter()
+        render(cells, templates)
+        durations.append((time.perf_counter() - st) * 1000)
+    return durations
+
+
+def report(name, durations):
+    durations = sorted(durations)
+    print(
+        f"{name:<16} mean: {statistics.mean(durations):7.3f}ms  "
+        f"p50: {durations[len(durations) // 2]:7.3f}ms  "
+        f"p90: {durations[int(len(durations) * 0.9)]:7.3f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark prompt template rendering")
+    parser.add_argument("-n", type=int, default=100, help="Renders per mode (default: 100)")
+    parser.add_argument("-c", "--cells", type=int, default=50, help="Cells in the notebook context (default: 50)")
+    parser.add_argument("--bytecode-cache-dir", default=None, help="Enable the on-disk Jinja bytecode cache")
+    args = parser.parse_args()
+
+    for module in (bot_chat, bot_contexts, base):
+        for name in ("_D", "_I", "_W", "_E", "_B", "_M"):
+            if hasattr(module, name):
+                setattr(module, name, lambda *a, **k: None)
+    get_template_registry().configure(bytecode_cache_dir=args.bytecode_cache_dir)
+    cells = make_cells(args.cells)
+    templates = dict(base.BaseChatAgent.get_prompt_blocks(None))
+    expected = render_per_call(cells, templates)
+    assert render_registry(cells, templates) == expected
+    assert render_registry_cached(cells, templates) == expected
+
+    report("per-call env", bench(render_per_call, cells, templates, args.n))
+    report("registry", bench(render_registry, cells, templates, args.n))
+    report("registry+cache", bench(render_registry_cached, cells, templates, args.n))
+    st = time.perf_counter()
+    TemplateRegistry(bytecode_cache_dir=args.bytecode_cache_dir).render(
+        PROMPT, templates, **make_contexts(cells, base.get_cell_context_cache().render)
+    )
+    print(f"{'cold start':<16} {(time.perf_counter() - st) * 1000:7.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
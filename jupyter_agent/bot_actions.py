@@ -15,12 +15,29 @@ import importlib
 import socket
 
 from enum import Enum
+from concurrent.futures import Future, CancelledError, TimeoutError as FutureTimeoutError
 from typing import Optional, Dict, List, Any
 from pydantic import BaseModel, Field
-from wsgiref.simple_server import make_server
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer
 from bottle import default_app, get, post, request, response
+from collections import OrderedDict
 from .utils import get_env_capbilities
 
+_action_classes: dict[str, type["ActionBase"]] = {}
+
+
+def register_action_class(klass: type["ActionBase"], name: Optional[str] = None, replace: bool = True):
+    """注册动作类型，可按类名或action名称查找；name为空时使用action字段的默认值"""
+    names = [klass.__name__, name or klass.model_fields["action"].default]
+    for name in names:
+        if isinstance(name, str) and name:
+            if replace:
+                _action_classes[name] = klass
+            else:
+                _action_classes.setdefault(name, klass)
+    return klass
+
 
 class ActionBase(BaseModel):
     timestamp: float = 0
@@ -34,6 +51,14 @@ class ActionBase(BaseModel):
         self.timestamp = self.timestamp or time.time()
         self.uuid = self.uuid or str(uuid.uuid4())
 
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs):
+        super().__pydantic_init_subclass__(**kwargs)
+        register_action_class(cls, replace=False)
+
+
+register_action_class(ActionBase)
+
 
 class ReplyActionBase(ActionBase):
     reply_host: str = ""
@@ -135,11 +160,10 @@ def request_user_reply(prompts: list[RequestUserSupplyInfo]) -> list[UserSupplyI
 
 
 def get_action_class(action_name: str) -> type[ActionBase]:
-    for obj in globals().values():
-        if isinstance(obj, type) and issubclass(obj, ActionBase):
-            if obj.__name__ == action_name or obj.model_fields["action"].default == action_name:
-                return obj
-    raise ValueError(f"Unknown action: {action_name}")
+    try:
+        return _action_classes[action_name]
+    except KeyError:
+        raise ValueError(f"Unknown action: {action_name}") from None
 
 
 class ActionReply(BaseModel):
@@ -152,20 +176,135 @@ class ActionReply(BaseModel):
     reply: ActionBase
 
 
+class ActionReplyStore:
+    """保存前端提交的回复
+
+    已取回的回复在retrieved_ttl秒后或超出max_size个时按取回顺序淘汰，一直未被取回的回复在pending_ttl秒后淘汰。
+    """
+
+    def __init__(self, retrieved_ttl: float = 600, pending_ttl: float = 24 * 3600, max_size: int = 1000):
+        self.retrieved_ttl = retrieved_ttl
+        self.pending_ttl = pending_ttl
+        self.max_size = max_size
+        self.evicted = 0
+        self._pending: OrderedDict[str, ActionReply] = OrderedDict()
+        self._retrieved: OrderedDict[str, ActionReply] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __setitem__(self, uuid: str, action_reply: ActionReply):
+        with self._lock:
+            self._pending.pop(uuid, None)
+            self._retrieved.pop(uuid, None)
+            if action_reply.retrieved:
+                self._retrieved[uuid] = action_reply
+            else:
+                self._pending[uuid] = action_reply
+            self.prune()
+
+    def __getitem__(self, uuid: str) -> ActionReply:
+        with self._lock:
+            action_reply = self._pending.get(uuid) or self._retrieved.get(uuid)
+        if action_reply is None:
+            raise KeyError(uuid)
+        return action_reply
+
+    def get(self, uuid: str, default=None) -> Optional[ActionReply]:
+        try:
+            return self[uuid]
+        except KeyError:
+            return default
+
+    def __contains__(self, uuid) -> bool:
+        return uuid in self._pending or uuid in self._retrieved
+
+    def __len__(self) -> int:
+        return len(self._pending) + len(self._retrieved)
+
+    def pop(self, uuid: str, default=None) -> Optional[ActionReply]:
+        with self._lock:
+            return self._pending.pop(uuid, None) or self._retrieved.pop(uuid, default)
+
+    def retrieve(self, uuid: str) -> Optional[ActionReply]:
+        """取回回复并标记为已取回"""
+        with self._lock:
+            action_reply = self._pending.pop(uuid, None)
+            if action_reply is None:
+                action_reply = self._retrieved.pop(uuid, None)
+            if action_reply is None:
+                return None
+            action_reply.retrieved = True
+            action_reply.retrieved_timestamp = time.time()
+            self._retrieved[uuid] = action_reply
+            self.prune()
+            return action_reply
+
+    def prune(self, now: Optional[float] = None):
+        now = now or time.time()
+        with self._lock:
+            while self._retrieved:
+                action_reply = next(iter(self._retrieved.values()))
+                expired = self.retrieved_ttl and now - action_reply.retrieved_timestamp > self.retrieved_ttl
+                if not expired and (not self.max_size or len(self) <= self.max_size):
+                    break
+                self._retrieved.popitem(last=False)
+                self.evicted += 1
+            while self._pending:
+                action_reply = next(iter(self._pending.values()))
+                if not self.pending_ttl or now - action_reply.reply_timestamp <= self.pending_ttl:
+                    break
+                self._pending.popitem(last=False)
+                self.evicted += 1
+
+    def metrics(self) -> dict:
+        return {"pending": len(self._pending), "retrieved": len(self._retrieved), "evicted": self.evicted}
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """每个请求一个线程，长轮询不会阻塞其他请求"""
+
+    daemon_threads = True
+
+
 class ActionDispatcher(threading.Thread):
-    def __init__(self, host="127.0.0.1", port=0, app=None):
+    """通过HTTP与前端交换动作及回复
+
+    等待回复的流程阻塞在该动作的Future上，/action_reply收到回复后立即唤醒；reply_timeout为等待回复的默认超时，
+    None表示一直等待。/action_fetch?timeout=N在队列为空时最多等待N秒（长轮询）。
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        app=None,
+        reply_timeout: Optional[float] = None,
+        reply_ttl: float = 600,
+        reply_max_size: int = 1000,
+    ):
         super().__init__(daemon=True)
         self.action_queue = queue.Queue()
-        self.action_replies: dict[str, ActionReply] = {}
+        self.action_replies = ActionReplyStore(retrieved_ttl=reply_ttl, max_size=reply_max_size)
+        self.reply_timeout = reply_timeout
+        self.closed = False
+        self._reply_futures: dict[str, Future] = {}
+        self._reply_lock = threading.Lock()
         self.app = app or default_app()
         self.host = host
         self.port = port
         self.server = None
         if get_env_capbilities().user_confirm or get_env_capbilities().user_supply_info:
             self.port = self.port or self.select_port(self.host)
-            self.server = make_server(self.host, self.port, self.app)
+            self.server = make_server(self.host, self.port, self.app, server_class=ThreadingWSGIServer)
             self.start()
 
+    def configure(self, reply_timeout=None, reply_ttl=None, reply_max_size=None):
+        self.reply_timeout = reply_timeout
+        if reply_ttl is not None:
+            self.action_replies.retrieved_ttl = reply_ttl
+        if reply_max_size is not None:
+            self.action_replies.max_size = reply_max_size
+        self.action_replies.prune()
+
     def select_port(self, host):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -179,9 +318,17 @@ class ActionDispatcher(threading.Thread):
             self.server.serve_forever()
 
     def close(self):
+        if not self.closed:
+            self.closed = True
+            with self._reply_lock:
+                futures, self._reply_futures = self._reply_futures, {}
+            for future in futures.values():
+                future.cancel()
+            self.action_queue.put(None)  # 唤醒等待中的长轮询
         if self.server is not None:
             self.server.shutdown()
             self.server.server_close()
+            self.server = None
 
     def __del__(self):
         self.close()
@@ -204,27 +351,82 @@ class ActionDispatcher(threading.Thread):
         bot_outputs = importlib.import_module(".bot_outputs", __package__)
         bot_outputs.output_action(action)
 
-    def get_action_reply(self, action: ReplyActionBase, wait: bool = True) -> Optional[ActionBase]:
-
-        while wait and action.uuid not in self.action_replies:
-            time.sleep(1)
-        if action.uuid in self.action_replies:
-            self.action_replies[action.uuid].retrieved = True
-            self.action_replies[action.uuid].retrieved_timestamp = time.time()
-        return self.action_replies.get(action.uuid) and self.action_replies[action.uuid].reply
+    def fetch_action(self, timeout: float = 0) -> Optional[dict]:
+        """取出一个待发送的动作，队列为空时最多等待timeout秒"""
+        try:
+            action = self.action_queue.get(block=timeout > 0, timeout=timeout if timeout > 0 else None)
+        except queue.Empty:
+            return None
+        if action is None:
+            self.action_queue.put(None)  # 已关闭，留给其他等待者
+        return action
+
+    def fetch_actions(self, max_count: int, timeout: float = 0) -> list[dict]:
+        """最多取出max_count个待发送的动作，仅在队列为空时等待第一个动作"""
+        action = self.fetch_action(timeout)
+        actions = [action] if action is not None else []
+        while action is not None and len(actions) < max_count:
+            action = self.fetch_action()
+            if action is not None:
+                actions.append(action)
+        return actions
+
+    def put_action_reply(self, action_reply: ActionReply):
+        with self._reply_lock:
+            self.action_replies[action_reply.uuid] = action_reply
+            future = self._reply_futures.pop(action_reply.uuid, None)
+        if future is not None:
+            future.set_result(action_reply)
+
+    def cancel_action_reply(self, action: ReplyActionBase) -> bool:
+        """取消对该动作回复的等待，等待中的get_action_reply返回None"""
+        with self._reply_lock:
+            future = self._reply_futures.pop(action.uuid, None)
+        return future is not None and future.cancel()
+
+    def get_action_reply(
+        self, action: ReplyActionBase, wait: bool = True, timeout: Optional[float] = None
+    ) -> Optional[ActionBase]:
+        """获取动作的回复，wait为True时等待回复到达、超时（timeout，默认reply_timeout）或被取消"""
+        with self._reply_lock:
+            action_reply = self.action_replies.get(action.uuid)
+            if action_reply is None and wait and not self.closed:
+                future = self._reply_futures.setdefault(action.uuid, Future())
+            else:
+                future = None
+        if future is not None:
+            timeout = self.reply_timeout if timeout is None else timeout
+            try:
+                action_reply = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                self.cancel_action_reply(action)
+                return None
+            except CancelledError:
+                return None
+        if action_reply is None:
+            return None
+        return (self.action_replies.retrieve(action.uuid) or action_reply).reply
 
 
 _default_action_dispatcher = None
+_action_dispatcher_options = {}
+
+
+def configure_action_dispatcher(**options):
+    """设置新建ActionDispatcher的参数（reply_timeout、reply_ttl、reply_max_size），并同步到当前的实例"""
+    _action_dispatcher_options.update(options)
+    if _default_action_dispatcher is not None:
+        _default_action_dispatcher.configure(**_action_dispatcher_options)
 
 
 def get_action_dispatcher() -> ActionDispatcher:
     global _default_action_dispatcher
 
     if not _default_action_dispatcher:
-        _default_action_dispatcher = ActionDispatcher()
+        _default_action_dispatcher = ActionDispatcher(**_action_dispatcher_options)
     elif not _default_action_dispatcher.is_alive():
         _default_action_dispatcher.close()
-        _default_action_dispatcher = ActionDispatcher()
+        _default_action_dispatcher = ActionDispatcher(**_action_dispatcher_options)
     return _default_action_dispatcher
 
 
@@ -242,35 +444,64 @@ def echo():
     return json.dumps({"status": "OK"})
 
 
+def _parse_action_reply(uuid: str, action: Optional[str], source: Optional[str], data: dict) -> ActionReply:
+    action = action or data.get("action")
+    source = source or data.get("source")
+    reply = get_action_class(action)(**data)  # type: ignore
+    return ActionReply(reply_timestamp=time.time(), uuid=uuid, source=source, action=action, reply=reply)
+
+
+def _json_error(e: Exception) -> dict:
+    return {"status": "ERROR", "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+
+
 @post("/action_reply")
 def action_reply():
+    """提交动作的回复
+
+    单个回复: POST /action_reply?uuid=<action uuid>，请求体为回复的动作；
+    批量回复: POST /action_reply，请求体为[{"uuid": <action uuid>, "reply": <回复的动作>}, ...]，逐个返回处理结果。
+    """
     try:
-        uuid = request.GET["uuid"]  # type: ignore
-        action = request.GET.get("a") or request.json.get("action")  # type: ignore
-        source = request.GET.get("s") or request.json.get("source")  # type: ignore
-        reply = get_action_class(action)(**request.json)  # type: ignore
-        action_reply = ActionReply(reply_timestamp=time.time(), uuid=uuid, source=source, action=action, reply=reply)
-        get_action_dispatcher().action_replies[action_reply.uuid] = action_reply
         response.content_type = "application/json"
-        return json.dumps({"status": "OK"})
+        if "uuid" in request.GET:  # type: ignore
+            action_reply = _parse_action_reply(
+                request.GET["uuid"], request.GET.get("a"), request.GET.get("s"), request.json  # type: ignore
+            )
+            get_action_dispatcher().put_action_reply(action_reply)
+            return json.dumps({"status": "OK"})
+        results = []
+        for item in request.json:  # type: ignore
+            try:
+                action_reply = _parse_action_reply(item["uuid"], item.get("action"), item.get("source"), item["reply"])
+                get_action_dispatcher().put_action_reply(action_reply)
+                results.append({"uuid": item["uuid"], "status": "OK"})
+            except Exception as e:
+                results.append({"uuid": item.get("uuid"), **_json_error(e)})
+        return json.dumps({"status": "OK", "results": results})
     except Exception as e:
-        response.content_type = "application/json"
-        return json.dumps(
-            {"status": "ERROR", "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
-        )
+        return json.dumps(_json_error(e))
 
 
 @get("/action_fetch")
 def action_fetch():
+    """获取待执行的动作
+
+    timeout=N 队列为空时最多等待N秒；max=N 一次最多返回N个动作（以actions列表返回）。
+    服务器不是多线程时忽略timeout，避免长轮询阻塞/action_reply等其他请求。
+    """
     try:
-        action = get_action_dispatcher().action_queue.get(block=False)
         response.content_type = "application/json"
+        dispatcher = get_action_dispatcher()
+        timeout = float(request.GET.get("timeout", 0))  # type: ignore
+        if not isinstance(dispatcher.server, ThreadingMixIn):
+            timeout = 0
+        if "max" in request.GET:  # type: ignore
+            actions = dispatcher.fetch_actions(int(request.GET["max"]), timeout=timeout)  # type: ignore
+            return json.dumps({"status": "OK", "actions": actions} if actions else {"status": "EMPTY"})
+        action = dispatcher.fetch_action(timeout=timeout)
+        if action is None:
+            return json.dumps({"status": "EMPTY"})
         return json.dumps({"status": "OK", "action": action})
-    except queue.Empty:
-        response.content_type = "application/json"
-        return json.dumps({"status": "EMPTY"})
     except Exception as e:
-        response.content_type = "application/json"
-        return json.dumps(
-            {"status": "ERROR", "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
-        )
+        return json.dumps(_json_error(e))
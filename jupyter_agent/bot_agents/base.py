@@ -5,30 +5,25 @@ This software is released under the MIT License.
 https://opensource.org/licenses/MIT
 """
 
+import re
+import math
 import json
+import hashlib
 import importlib
+import threading
 import traceback
 
 from collections import OrderedDict
-from typing import Tuple, Any, Optional, Type
+from typing import Tuple, Any, Optional, Type, Callable
 from enum import Enum, unique
 from pydantic import BaseModel, Field
 from IPython.display import Markdown
-from ..bot_outputs import _C, _O, _W, _T, flush_output
+from ..bot_outputs import _C, _O, _D, _I, _W, _T, flush_output
 from ..bot_chat import BotChat
-from ..utils import no_indent
+from ..utils import no_indent, get_template_registry
 
-_CELL_CONTEXTS = no_indent(
+_CELL_CONTEXT_ITEM = no_indent(
     """
-**以下是当前Notebook的执行情况:**
-
-注：
-
-- `# %% Cell[n]` 代表第 `n` 个 cell
-- `# %% [markdown] Cell[n]` 代表第 `n` 个 cell，并且该 cell 的内容为markdown文本
-
-```python
-{%+ for cell in cells +%}
 # -----------------------------------------------------------------------------
 
 {% if cell.type == "planning" and cell.source.strip() %}
@@ -90,7 +85,20 @@ _CELL_CONTEXTS = no_indent(
 {% else %}
     # %% Cell[{{ cell.cell_idx }}] Ignored
 {% endif %}
-{% endfor +%}
+"""
+)
+
+_CELL_CONTEXTS = no_indent(
+    """
+**以下是当前Notebook的执行情况:**
+
+注：
+
+- `# %% Cell[n]` 代表第 `n` 个 cell
+- `# %% [markdown] Cell[n]` 代表第 `n` 个 cell，并且该 cell 的内容为markdown文本
+
+```python
+{%+ for cell in cells %}{{ cell_context(cell, merged_important_infos) }}{% endfor +%}
 
 {% if task and task.subject %}
     # -----------------------------------------------------------------------------
@@ -349,6 +357,13 @@ _TASK_DATA = no_indent(
                 {{ task.output }}
                 ```
             {%+ endif +%}
+            {%+ if task.exec_profile +%}
+                ### 当前代码执行的性能数据：
+
+                ```json
+                {{ task.exec_profile | json }}
+                ```
+            {%+ endif +%}
             {%+ if task.cell_error +%}
                 ### 当前代码执行的错误信息：
 
@@ -409,6 +424,193 @@ _DEFAULT_PROMPT_TPL = """\
 """
 
 
+class CellContextCache:
+    """按单元格内容哈希缓存CELL_CONTEXTS中每个单元格的渲染结果，仅重新渲染新增或变化的单元格
+
+    并发执行的Agent共享同一个缓存，对缓存及统计的访问需持有锁。
+    """
+
+    def __init__(self, template=_CELL_CONTEXT_ITEM, max_size=4096):
+        self.template = get_template_registry().get_template(template)
+        self.max_size = max_size
+        self.fragments: OrderedDict[tuple, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.rendered_bytes = 0
+        self._lock = threading.Lock()
+
+    def render(self, cell, merged_important_infos=None):
+        content_hash = getattr(cell, "content_hash", None)
+        if content_hash is None:
+            return self.template.render(cell=cell, merged_important_infos=merged_important_infos)
+        key = (content_hash, self.infos_hash(merged_important_infos))
+        with self._lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.hits += 1
+                self.fragments.move_to_end(key)
+                self.rendered_bytes += len(fragment.encode("utf-8"))
+                return fragment
+            self.misses += 1
+        # 渲染时不持有锁，并发渲染同一单元格时结果相同，后写入的覆盖先写入的
+        fragment = self.template.render(cell=cell, merged_important_infos=merged_important_infos)
+        with self._lock:
+            self.fragments[key] = fragment
+            self.fragments.move_to_end(key)
+            while len(self.fragments) > self.max_size:
+                self.fragments.popitem(last=False)
+            self.rendered_bytes += len(fragment.encode("utf-8"))
+        return fragment
+
+    @staticmethod
+    def infos_hash(merged_important_infos):
+        """渲染结果依赖重要信息的内容，按其内容的哈希区分缓存"""
+        if not merged_important_infos:
+            return None
+        infos = json.dumps(merged_important_infos, sort_keys=True, ensure_ascii=False, default=repr)
+        return hashlib.sha256(infos.encode("utf-8")).hexdigest()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "rendered_bytes": self.rendered_bytes}
+
+    def clear(self):
+        with self._lock:
+            self.fragments.clear()
+            self.hits = self.misses = self.rendered_bytes = 0
+
+
+_cell_context_cache = CellContextCache()
+
+
+def get_cell_context_cache() -> CellContextCache:
+    return _cell_context_cache
+
+
+_CJK_PATTERN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数，CJK字符按每字1个token计，其余字符按每4个字符1个token计"""
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+
+_token_counter: Callable[[str], int] = estimate_tokens
+
+
+def get_token_counter() -> Callable[[str], int]:
+    return _token_counter
+
+
+def set_token_counter(counter: Optional[Callable[[str], int]]):
+    """设置token计数函数，例如使用tiktoken: set_token_counter(lambda s: len(enc.encode(s)))"""
+    global _token_counter
+
+    _token_counter = counter or estimate_tokens
+
+
+class SummarizedCellContext:
+    """超出上下文预算时使用的任务单元格摘要，只保留任务目标和结果"""
+
+    def __init__(self, cell):
+        self._cell = cell
+
+    source = ""
+    coding_prompt = ""
+    cell_output = ""
+    cell_result = ""
+    cell_error = ""
+
+    @property
+    def content_hash(self):
+        content_hash = getattr(self._cell, "content_hash", None)
+        return content_hash and "summary:" + content_hash
+
+    def __getattr__(self, name):
+        return getattr(self._cell, name)
+
+
+class ContextAssembler:
+    """按token预算选择上下文单元格
+
+    预算先扣除提示词中任务、重要信息及输出格式等固定部分（reserved_tokens），规划及用户补充信息单元格总是保留；
+    其余单元格按与当前任务（query）的相关性从高到低、相关性相同时从最近的开始完整保留，
+    预算不足后其余的任务单元格只保留任务目标和结果，其他单元格被省略。
+    """
+
+    PINNED_CELL_TYPES = ("planning", "user_supply_info")
+    WORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}|[\u4e00-\u9fff]{2,}")
+
+    def __init__(self, budget=0, token_counter=None, cell_context_cache=None, reserved_tokens=0):
+        self.budget = budget
+        self.reserved_tokens = reserved_tokens
+        self.token_counter = token_counter or get_token_counter()
+        self.cell_context_cache = cell_context_cache or get_cell_context_cache()
+
+    def measure(self, cell) -> int:
+        return self.token_counter(self.cell_context_cache.render(cell))
+
+    @classmethod
+    def words(cls, text) -> set:
+        """提取标识符及中文词组（按相邻两字切分），用于估算相关性"""
+        words = set()
+        for word in cls.WORD_PATTERN.findall(text or ""):
+            if _CJK_PATTERN.match(word):
+                words.update(word[i : i + 2] for i in range(len(word) - 1))
+            else:
+                words.add(word.lower())
+        return words
+
+    def relevance(self, cell, query_words) -> float:
+        """与查询共有的词数，按单元格词数的平方根归一，避免偏向长单元格"""
+        cell_words = self.words(self.cell_context_cache.render(cell))
+        return len(cell_words & query_words) / math.sqrt(len(cell_words)) if cell_words else 0.0
+
+    def select_cells(self, cells, query=""):
+        if not self.budget:
+            return cells
+        budget = self.budget - self.reserved_tokens
+        selected = {}
+        used_tokens = 0
+        for idx, cell in enumerate(cells):
+            if cell.type in self.PINNED_CELL_TYPES:
+                selected[idx] = cell
+                used_tokens += self.measure(cell)
+        candidates = [idx for idx in reversed(range(len(cells))) if idx not in selected]
+        query_words = self.words(query)
+        if query_words:
+            relevance = {idx: self.relevance(cells[idx], query_words) for idx in candidates}
+            candidates.sort(key=lambda idx: relevance[idx], reverse=True)
+        summarizing = False
+        for idx in candidates:
+            cell = cells[idx]
+            if not summarizing:
+                tokens = self.measure(cell)
+                if used_tokens + tokens <= budget:
+                    selected[idx] = cell
+                    used_tokens += tokens
+                    continue
+                summarizing = True
+            if cell.type == "task":
+                summary = SummarizedCellContext(cell)
+                tokens = self.measure(summary)
+                if used_tokens + tokens <= budget:
+                    selected[idx] = summary
+                    used_tokens += tokens
+        summarized = sum(isinstance(cell, SummarizedCellContext) for cell in selected.values())
+        _D(
+            "Context budget: {} tokens used of {} ({} reserved), kept {} cells, summarized {}, omitted {}",
+            used_tokens,
+            budget,
+            self.reserved_tokens,
+            len(selected) - summarized,
+            summarized,
+            len(cells) - len(selected),
+        )
+        return [selected[idx] for idx in sorted(selected)]
+
+
 @unique
 class AgentOutputFormat(str, Enum):
     RAW = "raw"
@@ -470,11 +672,14 @@ class BaseChatAgent(BotChat, BaseAgent):
     ACCEPT_EMPYT_REPLY = False
     REPLY_ERROR_RETRIES = 1
     MODEL_TYPE: AgentModelType = AgentModelType.DEFAULT
+    CONTEXT_BUDGET = 0
 
     def __init__(self, notebook_context, **chat_kwargs):
         """初始化基础任务代理"""
         BaseAgent.__init__(self, notebook_context)
         BotChat.__init__(self, **chat_kwargs)
+        self.context_budget = chat_kwargs.get("context_budget") or self.CONTEXT_BUDGET
+        self._prepared_messages = None
 
     def get_prompt_tpl(self):
         return self.PROMPT_TPL
@@ -514,13 +719,37 @@ class BaseChatAgent(BotChat, BaseAgent):
             TASK_TRIGGER=_TASK_TRIGGER,
         )
 
+    def get_context_query(self):
+        """按相关性选择上下文单元格时使用的查询文本"""
+        task = self.get_task_data()
+        return "\n".join(
+            value
+            for value in (getattr(task, name, "") for name in ("subject", "coding_prompt", "source", "cell_error"))
+            if isinstance(value, str)
+        )
+
+    def measure_fixed_tokens(self, contexts) -> int:
+        """不含上下文单元格时提示词的token数，即任务、重要信息及输出格式等固定部分"""
+        blocks = self.get_prompt_blocks()
+        fixed_contexts = dict(contexts, cells=[])
+        prompts = [self.get_prompt_tpl()] + ([self.get_prompt_system()] if self.USE_SYSTEM_PROMPT else [])
+        token_counter = get_token_counter()
+        return sum(token_counter(get_template_registry().render(tpl, blocks, **fixed_contexts)) for tpl in prompts)
+
+    def select_context_cells(self, contexts):
+        if not self.context_budget:
+            return self.cells
+        assembler = ContextAssembler(self.context_budget, reserved_tokens=self.measure_fixed_tokens(contexts))
+        return assembler.select_cells(self.cells, query=self.get_context_query())
+
     def prepare_contexts(self, **kwargs):
         contexts = {
             "blocks": self.get_block_includes(),
-            "cells": self.cells,
+            "cells": [],
             "task": self.get_task_data(),
             "merged_important_infos": None,  # self.notebook_context.merged_important_infos,
             "merged_user_supply_infos": None,  # self.notebook_context.merged_user_supply_infos,
+            "cell_context": _cell_context_cache.render,
             "agent_role": self.get_role_prompt(),
             "task_rules": self.get_rules_prompt(),
             "task_trigger": self.get_trigger_prompt(),
@@ -548,15 +777,43 @@ class BaseChatAgent(BotChat, BaseAgent):
             contexts["output_json_schema"] = json.dumps(json_schema, indent=2, ensure_ascii=False, default=_default)
             contexts["output_json_example"] = json.dumps(json_example, indent=2, ensure_ascii=False, default=_default)
         contexts.update(kwargs)
+        if "cells" not in kwargs:
+            contexts["cells"] = self.select_context_cells(contexts)
         return contexts
 
     def create_messages(self, contexts):
+        stats = _cell_context_cache.stats()
         messages = super().create_messages(contexts, templates=self.get_prompt_blocks())
         if self.USE_SYSTEM_PROMPT:
             messages.add(self.get_prompt_system(), role="system")
         messages.add(self.get_prompt_tpl())
+        _D(
+            "Cell context cache: hits={hits}, misses={misses}, rendered_bytes={rendered_bytes}".format(
+                **{k: v - stats[k] for k, v in _cell_context_cache.stats().items()}
+            )
+        )
+        self.log_prompt_tokens(contexts)
         return messages
 
+    def log_prompt_tokens(self, contexts):
+        """输出提示词中每个块的token数，需重新渲染各个块，仅在启用DEBUG日志时计算"""
+        if not contexts or not contexts.get("blocks"):
+            return
+
+        def _format():
+            blocks = self.get_prompt_blocks()
+            token_counter = get_token_counter()
+            block_tokens = {
+                name: token_counter(get_template_registry().render(blocks[name], blocks, **contexts))
+                for name in contexts["blocks"]
+                if name in blocks
+            }
+            return "Prompt tokens: {}, total={}".format(
+                ", ".join(f"{name}={tokens}" for name, tokens in block_tokens.items()), sum(block_tokens.values())
+            )
+
+        _D(_format)
+
     def combine_raw_replies(self, replies):
         if self.COMBINE_REPLY == AgentCombineReply.FIRST:
             return replies[0]["raw"]
@@ -641,15 +898,34 @@ class BaseChatAgent(BotChat, BaseAgent):
         else:
             raise ValueError("Unsupported output format: {}".format(self.OUTPUT_FORMAT))
 
+    def is_reply_complete(self, replies) -> bool:
+        """流式回复时判断所需的回复块是否已完整，完整后提前终止生成"""
+        if self.COMBINE_REPLY != AgentCombineReply.FIRST:
+            return False
+        if self.OUTPUT_FORMAT == AgentOutputFormat.CODE:
+            return any(reply["type"] == "code" and reply["lang"] == self.OUTPUT_CODE_LANG for reply in replies)
+        elif self.OUTPUT_FORMAT == AgentOutputFormat.JSON:
+            return any(reply["type"] == "code" and reply["lang"] == "json" for reply in replies)
+        elif self.OUTPUT_FORMAT == AgentOutputFormat.TEXT:
+            return any(reply["type"] == "text" for reply in replies)
+        return len(replies) > 0
+
     def on_reply(self, reply) -> Tuple[bool, Any] | Any:
         _C(Markdown(reply))
 
+    def prepare_messages(self, **kwargs):
+        """预先渲染提示消息，之后的调用直接使用该消息，不再受上下文变化的影响"""
+        self._prepared_messages = self.create_messages(self.prepare_contexts(**kwargs))
+        return self._prepared_messages
+
     def __call__(self, **kwargs) -> Tuple[bool, Any]:
-        contexts = self.prepare_contexts(**kwargs)
-        messages = self.create_messages(contexts)
+        messages = self._prepared_messages
+        if messages is None:
+            contexts = self.prepare_contexts(**kwargs)
+            messages = self.create_messages(contexts)
         reply_retries = 0
         while reply_retries <= self.REPLY_ERROR_RETRIES:
-            replies = self.chat(messages.get(), display_reply=self.DISPLAY_REPLY)
+            replies = self.chat(messages.get(), display_reply=self.DISPLAY_REPLY, stop_when=self.is_reply_complete)
             reply = self.combine_replies(replies)
             if reply is False:
                 reply_retries += 1
@@ -678,11 +954,12 @@ class AgentFactory:
         self.chat_kwargs = chat_kwargs
         self.models = {AgentModelType.DEFAULT: {"api_url": None, "api_key": None, "model": None}}
 
-    def config_model(self, agent_model, api_url, api_key, model_name):
+    def config_model(self, agent_model, api_url, api_key, model_name, context_budget=0):
         self.models[agent_model] = {
             "api_url": api_url,
             "api_key": api_key,
             "model": model_name,
+            "context_budget": context_budget,
         }
 
     def get_agent_class(self, agent_class):
@@ -703,6 +980,11 @@ class AgentFactory:
                 "model_name": self.models.get(agent_model, {}).get("model")
                 or self.models[AgentModelType.DEFAULT]["model"],
             }
+            context_budget = self.models.get(agent_model, {}).get("context_budget") or self.models[
+                AgentModelType.DEFAULT
+            ].get("context_budget")
+            if context_budget:
+                chat_kwargs["context_budget"] = context_budget
             chat_kwargs.update(self.chat_kwargs)
             return chat_kwargs
         else:
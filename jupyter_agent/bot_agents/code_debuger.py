@@ -8,6 +8,7 @@ https://opensource.org/licenses/MIT
 import time
 
 from .base import BaseChatAgent, AgentOutputFormat, AgentModelType
+from .code_preflight import preflight_check
 
 
 PROMPT_ROLE = """
@@ -18,7 +19,8 @@ PROMPT_ROLE = """
 - **断言错误**（如断言条件不满足、缺少容错处理）
 - **依赖缺失**（如未导入库、版本冲突）
 - **上下文引用错误**（如未定义的变量、未导入的模块、函数传参错误）
-- **执行环境问题**（如路径错误、数据格式异常）"""
+- **执行环境问题**（如路径错误、数据格式异常）
+- **性能问题**（如`ExecutionLimitExceeded`：执行超时、内存占用过高）"""
 PROMPT_RULES = """
 1. 错误分析与修复流程
 
@@ -33,6 +35,7 @@ PROMPT_RULES = """
     - **上下文引用错误**：如使用了未定义的变量
     - **执行环境问题**：如路径错误、数据格式异常
     - **断言失败**：考虑是否需要增加容错逻辑
+    - **性能问题**：执行被`ExecutionLimitExceeded`中断时，改用向量化运算替代逐行循环（如`iterrows`、`apply`），分批或抽样处理大数据，避免笛卡尔积等过大的中间结果
   
   - 步骤三：修复方案
     - **具体策略**：针对原因提出明确的修改建议（如“将`data_loader()`改为`pd.read_csv()`”）
@@ -106,6 +109,7 @@ class CodeDebugerAgent(BaseChatAgent):
             "coding_prompt": self.task.coding_prompt,
             "source": self.task.source,
             "output": self.task.output,
+            "exec_profile": self.task.exec_profile,
             "cell_error": self.task.cell_error,
         }
 
@@ -113,3 +117,4 @@ class CodeDebugerAgent(BaseChatAgent):
         generated_code = "# Generated by Jupyter Agent (Debugger) {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"))
         generated_code += reply
         self.task.source = generated_code
+        return preflight_check(self)
@@ -6,21 +6,145 @@ https://opensource.org/licenses/MIT
 """
 
 import re
+import ast
+import sys
+import copy
+import types
 
+from enum import Enum
+from contextlib import nullcontext
+from typing import Optional
 from IPython.core.getipython import get_ipython
 from IPython.display import Markdown, clear_output
 from .base import BaseAgent
-from ..utils import TeeOutputCapture
-from ..bot_outputs import _D, _I, _W, _E, _F, _M, _B, _C, flush_output
+from .code_preflight import parse_cell, bound_names
+from ..utils import TeeOutputCapture, HeadTailStringIO, ExecutionWatchdog, ExecutionProfiler
+from ..bot_outputs import _D, _I, _W, _E, _F, _M, _B, _C, flush_output, hold_output
+
+
+OPTIMIZED_CODE_HEADER = "# Generated by Jupyter Agent (Optimizer)"
+
+
+class CodeExecutorState(str, Enum):
+    SLOW = "slow"  # 执行成功，但耗时超过了OPTIMIZE_THRESHOLD
+
+
+MISSING = object()  # 快照中表示变量不存在
+
+
+def referenced_names(tree) -> set[str]:
+    """代码中读取或绑定的所有名称"""
+    return bound_names(tree) | {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+
+
+def snapshot_names(user_ns: dict, names, max_size=0) -> Optional[dict]:
+    """深拷贝命名空间中的指定变量，不存在的变量记为MISSING
+
+    无法拷贝或变量的总大小超过max_size字节（按sys.getsizeof估算，0表示不限制）时返回None。
+    """
+    snapshot = {}
+    total_size = 0
+    for name in names:
+        value = user_ns.get(name, MISSING)
+        if value is MISSING or isinstance(value, types.ModuleType):
+            snapshot[name] = value
+            continue
+        try:
+            total_size += sys.getsizeof(value)
+        except Exception:
+            pass
+        if max_size and total_size > max_size:
+            _W("变量的总大小超过了{}MB，不拷贝执行前的变量", max_size // 1024 // 1024)
+            return None
+        try:
+            snapshot[name] = copy.deepcopy(value)
+        except Exception as e:
+            _W("无法拷贝变量`{}`: {}", name, e)
+            return None
+    return snapshot
+
+
+def restore_names(user_ns: dict, snapshot: dict):
+    """按快照恢复变量绑定，快照之外的变量保持不变"""
+    for name, value in snapshot.items():
+        if value is MISSING:
+            user_ns.pop(name, None)
+        else:
+            user_ns[name] = value
 
 
 class CodeExecutor(BaseAgent):
+    OUTPUT_SPILL_DIR = None  # 设置后完整的stdout/stderr另存到该目录
+    MAX_EXEC_TIME = 0  # 默认的墙钟时间上限（秒），0表示不限制
+    MAX_EXEC_CPU_TIME = 0  # 默认的CPU时间上限（秒）
+    MAX_EXEC_MEMORY = 0  # 默认的内存增长上限（MB）
+    PROFILE = False  # 是否采集执行的性能数据
+    PROFILE_TOP_N = 5  # 性能数据中保留的耗时最多的函数个数
+    OPTIMIZE_THRESHOLD = 0  # 执行耗时超过该秒数时返回CodeExecutorState.SLOW以进入优化阶段，0表示不优化
+    OPTIMIZE_STAGES = ("executing",)  # 可进入优化阶段的执行阶段，仅在这些阶段中拷贝执行前的变量
+    SNAPSHOT_MAX_SIZE = 256  # 执行前拷贝的变量的总大小上限（MB），超出时不拷贝也不优化，0表示不限制
+
+    profile = None
+    exec_time = 0.0
+
+    def get_exec_limits(self) -> dict:
+        """任务选项中的限制优先于默认配置"""
+        get_option = getattr(self.task, "get_data", lambda name: 0)
+        max_memory = get_option("max_exec_memory") or self.MAX_EXEC_MEMORY
+        return {
+            "max_wall_time": get_option("max_exec_time") or self.MAX_EXEC_TIME,
+            "max_cpu_time": get_option("max_exec_cpu_time") or self.MAX_EXEC_CPU_TIME,
+            "max_memory": int(max_memory * 1024 * 1024),
+        }
+
+    def set_profile(self, watchdog: ExecutionWatchdog, profiler: Optional[ExecutionProfiler] = None):
+        self.profile = {
+            "wall_time": round(watchdog.usage["wall_time"], 3),
+            "cpu_time": round(watchdog.usage["cpu_time"], 3),
+        }
+        if profiler is not None:
+            self.profile["peak_memory_mb"] = round(profiler.peak_memory / 1024 / 1024, 2)
+            self.profile["hotspots"] = profiler.hotspots
+        if hasattr(self.task, "set_data"):
+            self.task.set_data("exec_profile", self.profile)
+        _I("执行耗时: {wall_time}s, CPU时间: {cpu_time}s".format(**self.profile))
+
+    def is_slow(self) -> bool:
+        """执行耗时是否超过了OPTIMIZE_THRESHOLD"""
+        return bool(self.OPTIMIZE_THRESHOLD and self.exec_time > self.OPTIMIZE_THRESHOLD)
+
+    def is_optimizable(self) -> bool:
+        """当前阶段执行较慢时是否会进入优化阶段，优化过的代码不再重复优化"""
+        return bool(
+            self.OPTIMIZE_THRESHOLD
+            and getattr(self.task, "agent_stage", None) in self.OPTIMIZE_STAGES
+            and not self.task.source.startswith(OPTIMIZED_CODE_HEADER)
+        )
+
+    def take_snapshot(self, ipython) -> Optional[dict]:
+        """执行前拷贝代码引用的变量，供优化阶段在相同的状态上执行改写后的代码"""
+        try:
+            names = referenced_names(parse_cell(self.task.source))
+        except SyntaxError:
+            return None
+        return snapshot_names(ipython.user_ns, names, int(self.SNAPSHOT_MAX_SIZE * 1024 * 1024))
+
+    def format_traceback(self, ipython, result) -> str:
+        error = result and (result.error_before_exec or result.error_in_exec)
+        if not error:
+            return ""
+        exc_info = ipython._format_exception_for_storage(error)
+        ansi_escape = re.compile(r"\x1b\[[0-9;]*m")
+        cell_idx_pat = re.compile(r"Cell In\[\d+\],")
+        clean_traceback = "\n".join(ansi_escape.sub("", line) for line in exc_info["traceback"])
+        return cell_idx_pat.sub("Cell[{}],".format(self.task.cell_idx), clean_traceback)
 
     def __call__(self):
         """执行代码逻辑"""
-        _D(f"执行代码: {repr(self.task.source)[:80]}")
+        _D("执行代码: {!r:.80}", self.task.source)
         ipython = get_ipython()
         exec_failed = False
+        self.profile = None
         self.task.cell_output = ""
         self.task.cell_error = ""
 
@@ -30,30 +154,59 @@ class CodeExecutor(BaseAgent):
             _E("执行失败: IPython environment not found.")
             result = None
         else:
-            with TeeOutputCapture() as captured:
-                result = ipython.run_cell(self.task.source)
-                if captured.stdout:
-                    self.task.cell_output += "Stdout:\n\n" + captured.stdout + "\n"
-                if captured.stderr:
-                    self.task.cell_output += "Stderr:\n\n" + captured.stderr + "\n"
-                if captured.outputs:
-                    self.task.cell_output += "Outputs:\n\n"
-                    for output in captured.outputs:
-                        output_content = output.data.get("text/markdown", "") or output.data.get("text/plain", "")
-                        self.task.cell_output += output_content
-                        self.task.cell_output += "\n"
-            _D(f"执行输出: {repr(self.task.cell_output)[:80]}")
-            if result.success:
+            # 预留标题及截断提示的空间，使截断后的输出无需再被上下文截断
+            max_size = max(self.task.max_output_size - 256, 256)
+            result = None
+            profiler = ExecutionProfiler(self.PROFILE_TOP_N) if self.PROFILE else nullcontext()
+            # 释放之前未被使用的快照，仅在会进入优化阶段时重新拷贝
+            self.task.exec_snapshot = None
+            snapshot = self.take_snapshot(ipython) if self.is_optimizable() else None
+            # 捕获输出期间暂停刷新Agent的输出面板，避免其被捕获到单元格的输出中
+            # 仅在执行用户代码期间中断，避免中断IPython及输出捕获的状态恢复
+            with hold_output(), ExecutionWatchdog(**self.get_exec_limits(), armed=False) as watchdog:
+                with TeeOutputCapture(max_size=max_size, spill_dir=self.OUTPUT_SPILL_DIR) as captured, profiler:
+                    with watchdog.armed_in(ipython):
+                        result = ipython.run_cell(self.task.source)
+            self.exec_time = watchdog.usage["wall_time"]
+            if self.PROFILE:
+                self.set_profile(watchdog, profiler)  # type: ignore
+            cell_output = []
+            if captured.stdout:
+                cell_output.append("Stdout:\n\n" + captured.stdout + "\n")
+            if captured.stderr:
+                cell_output.append("Stderr:\n\n" + captured.stderr + "\n")
+            if captured.outputs:
+                outputs = HeadTailStringIO(max_size // 2, max_size - max_size // 2)
+                for output in captured.outputs:
+                    outputs.write(output.data.get("text/markdown", "") or output.data.get("text/plain", ""))
+                    outputs.write("\n")
+                cell_output.append("Outputs:\n\n" + outputs.getvalue())
+            self.task.cell_output = "".join(cell_output)
+            _D("执行输出: {!r:.80}", self.task.cell_output)
+            if watchdog.exceeded:
+                # 超限时给出性能问题的诊断，引导调试时改写为更高效的代码
+                exec_failed = True
+                self.task.cell_error = (
+                    "ExecutionLimitExceeded: The code was interrupted because its {}. "
+                    "Rewrite it to be more efficient: vectorize row-wise loops, process data in batches or "
+                    "on a sample, and avoid materializing large intermediate results.\n\n{}".format(
+                        watchdog.format_exceeded(), self.format_traceback(ipython, result)
+                    )
+                )
+                _E("执行中断: {}", watchdog.format_exceeded())
+            elif result.success:
                 self.task.cell_result = "{}".format(result.result)
-                _D(f"执行结果: {repr(self.task.cell_result)[:80]}")
+                _D("执行结果: {!r:.80}", self.task.cell_result)
             else:
                 exec_failed = True
-                exc_info = ipython._format_exception_for_storage(result.error_before_exec or result.error_in_exec)
-                ansi_escape = re.compile(r"\x1b\[[0-9;]*m")
-                cell_idx_pat = re.compile(r"Cell In\[\d+\],")
-                clean_traceback = "\n".join(ansi_escape.sub("", line) for line in exc_info["traceback"])
-                clean_traceback = cell_idx_pat.sub("Cell[{}],".format(self.task.cell_idx), clean_traceback)
-                self.task.cell_error = clean_traceback
-                _E(f"执行失败: {clean_traceback}")
+                self.task.cell_error = self.format_traceback(ipython, result)
+                _E("执行失败: {}", self.task.cell_error)
+
+            if not exec_failed and snapshot is not None and self.is_slow():
+                _I("执行耗时{:.2f}s，超过了{}s，尝试优化代码", self.exec_time, self.OPTIMIZE_THRESHOLD)
+                if self.profile is None:
+                    self.set_profile(watchdog)
+                self.task.exec_snapshot = snapshot
+                return False, CodeExecutorState.SLOW
 
         return exec_failed, not exec_failed
@@ -8,6 +8,7 @@ https://opensource.org/licenses/MIT
 import time
 
 from .base import BaseChatAgent, AgentOutputFormat, AgentModelType
+from .code_preflight import preflight_check
 
 
 PROMPT_ROLE = """
@@ -82,3 +83,4 @@ class CodeGeneratorAgent(BaseChatAgent):
         generated_code = "# Generated by Jupyter Agent (Coder) {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"))
         generated_code += reply
         self.task.source = generated_code
+        return preflight_check(self)
@@ -0,0 +1,114 @@
+"""
+Copyright (c) 2025 viewstar000
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+"""
+
+import time
+
+from IPython.core.getipython import get_ipython
+from .base import BaseChatAgent, AgentOutputFormat, AgentModelType
+from .code_executor import CodeExecutor, OPTIMIZED_CODE_HEADER, MISSING, referenced_names, restore_names
+from .code_preflight import parse_cell
+from ..bot_outputs import _D, _I, _W
+
+
+PROMPT_ROLE = """
+你是一位**Python数据分析性能优化专家**，专精于在不改变结果的前提下提升Jupyter Notebook代码的执行效率：
+- **向量化**（如用`pandas`/`numpy`的列运算替代`iterrows`、`apply`及Python循环）
+- **批量处理**（如合并重复的文件读取、数据库查询及网络请求）
+- **减少中间结果**（如避免笛卡尔积、不必要的`copy`及全量排序）
+- **选择合适的数据结构与算法**（如用字典/集合查找替代列表遍历）"""
+PROMPT_RULES = """
+1. 优化流程
+
+  - 步骤一：定位瓶颈
+    - 结合执行的性能数据（耗时、内存峰值、耗时最多的函数）找到耗时最多的代码
+  - 步骤二：改写代码
+    - 仅改写瓶颈部分，保持其他代码不变
+    - 优先使用向量化、批量处理等方式，避免引入新的依赖库
+
+2. 优化约束
+
+  - **结果一致**：改写后的代码的输出（包括`print`的内容、格式及顺序）必须与原代码完全一致
+  - **副作用一致**：定义的变量、函数及其取值必须与原代码一致，后续单元格会继续引用它们
+  - **修复范围**：仅针对最后一个单元格中的代码进行优化，禁止修改其他单元格
+  - **完整输出**：输出最后一个单元格的完整代码，不要仅输出修改的部分
+
+3. 输出格式标准
+
+  - **输出格式**：输出为Python代码，禁止使用其他语言
+  - **输出范围**：仅输出最后一个单元格的完整代码，禁止输出其他单元格
+"""
+PROMPT_TRIGGER = """
+请在保证输出结果不变的前提下，优化上述代码的执行性能。
+"""
+
+
+class CodeOptimizerAgent(BaseChatAgent):
+    """改写执行较慢的代码，在原代码执行前的变量快照上重新执行，仅在输出一致且更快时保留改写后的代码"""
+
+    PROMPT_ROLE = PROMPT_ROLE
+    PROMPT_RULES = PROMPT_RULES
+    PROMPT_TRIGGER = PROMPT_TRIGGER
+    OUTPUT_FORMAT = AgentOutputFormat.CODE
+    OUTPUT_CODE_LANG = "python"
+    MODEL_TYPE = AgentModelType.CODING
+    MIN_SPEEDUP = 1.1  # 改写后的代码至少快这么多倍才会被保留
+
+    def get_task_data(self):
+        return {
+            "cell_idx": self.task.cell_idx,
+            "task_id": self.task.task_id,
+            "subject": self.task.subject,
+            "coding_prompt": self.task.coding_prompt,
+            "source": self.task.source,
+            "output": self.task.output,
+            "exec_profile": self.task.exec_profile,
+        }
+
+    def on_reply(self, reply: str):
+        origin = {
+            "source": self.task.source,
+            "cell_output": self.task.cell_output,
+            "cell_result": self.task.cell_result,
+            "exec_profile": self.task.exec_profile,
+        }
+        origin_time = (origin["exec_profile"] or {}).get("wall_time", 0)
+        ipython = get_ipython()
+        snapshot, self.task.exec_snapshot = getattr(self.task, "exec_snapshot", None), None
+        source = "{} {}\n{}".format(OPTIMIZED_CODE_HEADER, time.strftime("%Y-%m-%d %H:%M:%S"), reply)
+        if ipython is None or snapshot is None:
+            _W("缺少执行前的变量快照，放弃优化后的代码")
+            return False, False
+        try:
+            names = set(snapshot) | referenced_names(parse_cell(source))
+        except SyntaxError as e:
+            _W("放弃优化后的代码（syntax error: {}）", e)
+            return False, False
+        # 在原代码执行前的状态上执行改写后的代码，放弃改写时恢复原代码执行后的变量
+        executed = {name: ipython.user_ns.get(name, MISSING) for name in names}
+        restore_names(ipython.user_ns, snapshot)
+        self.task.source = source
+        executor = CodeExecutor(self.notebook_context)
+        failed, _ = executor()
+        if failed:
+            reason = "execution failed"
+        elif (self.task.cell_output, self.task.cell_result) != (origin["cell_output"], origin["cell_result"]):
+            reason = "outputs differ"
+        elif origin_time and executor.exec_time * self.MIN_SPEEDUP > origin_time:
+            reason = "not faster"
+        else:
+            _I("代码优化完成，执行耗时从{:.2f}s降至{:.2f}s", origin_time, executor.exec_time)
+            self.task.set_data("exec_profile", executor.profile or {"wall_time": round(executor.exec_time, 3)})
+            return False, True
+        _W("放弃优化后的代码（{}），执行耗时{:.2f}s", reason, executor.exec_time)
+        restore_names(ipython.user_ns, executed)
+        self.task.source = origin["source"]
+        self.task.cell_output = origin["cell_output"]
+        self.task.cell_result = origin["cell_result"]
+        self.task.cell_error = ""
+        self.task.set_data("exec_profile", origin["exec_profile"])
+        _D("恢复优化前的代码: {!r:.80}", self.task.source)
+        return False, False
@@ -0,0 +1,182 @@
+"""
+Copyright (c) 2025 viewstar000
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+"""
+
+import ast
+import builtins
+import importlib.util
+
+from IPython.core.getipython import get_ipython
+from IPython.core.inputtransformer2 import TransformerManager
+from .base import BaseAgent
+from ..bot_contexts import CellType
+from ..bot_outputs import _D, _I, _W, _E
+
+KNOWN_IMPORTS = {
+    "pd": ("pandas", "import pandas as pd"),
+    "np": ("numpy", "import numpy as np"),
+    "pandas": ("pandas", "import pandas"),
+    "numpy": ("numpy", "import numpy"),
+}
+# 可自动补全导入的标准库模块，其他同名的标准库模块（如this、code、copy）更可能是拼写错误或缺失的变量
+STDLIB_IMPORTS = {
+    "os",
+    "sys",
+    "re",
+    "json",
+    "math",
+    "time",
+    "random",
+    "itertools",
+    "collections",
+    "pathlib",
+    "functools",
+    "statistics",
+}
+# 同名的模块与类，无法确定应导入哪一个
+AMBIGUOUS_IMPORTS = {"datetime"}
+# IPython内核中始终可用的名称
+IPYTHON_NAMES = {"get_ipython", "display", "In", "Out", "exit", "quit"}
+
+_transformer = TransformerManager()
+
+
+def parse_cell(source: str) -> ast.Module:
+    """解析单元格代码，魔法命令按IPython的规则转换后再解析，转换不改变行号"""
+    return ast.parse(_transformer.transform_cell(source))
+
+
+def bound_names(tree: ast.AST) -> set[str]:
+    """返回代码中任意作用域内绑定的名称，不区分作用域以避免误报"""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.MatchAs, ast.MatchStar)) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+    return names
+
+
+def has_star_import(tree: ast.AST) -> bool:
+    return any(
+        isinstance(node, ast.ImportFrom) and any(alias.name == "*" for alias in node.names) for node in ast.walk(tree)
+    )
+
+
+def undefined_names(tree: ast.AST, known_names) -> list[str]:
+    """按首次出现的顺序返回未定义的名称"""
+    defined = bound_names(tree)
+    undefined = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            name = node.id
+            if name not in defined and name not in known_names and not hasattr(builtins, name):
+                undefined.setdefault(name, (node.lineno, node.col_offset))
+    return sorted(undefined, key=undefined.get)  # type: ignore
+
+
+def resolve_import(name: str) -> str:
+    """返回可自动补全的导入语句，无法确定时返回空字符串"""
+    if name in AMBIGUOUS_IMPORTS:
+        return ""
+    if name in KNOWN_IMPORTS:
+        module, statement = KNOWN_IMPORTS[name]
+    elif name in STDLIB_IMPORTS:
+        module, statement = name, f"import {name}"
+    else:
+        return ""
+    return statement if importlib.util.find_spec(module) is not None else ""
+
+
+def insert_imports(source: str, tree: ast.Module, imports: list[str]) -> str:
+    """在开头的注释、文档字符串及__future__导入之后插入导入语句"""
+    lineno = len(source.split("\n")) + 1
+    for idx, node in enumerate(tree.body):
+        if idx == 0 and isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            continue
+        if isinstance(node, ast.ImportFrom) and node.module == "__future__":
+            continue
+        lineno = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+        break
+    lines = source.split("\n")
+    return "\n".join(lines[: lineno - 1] + imports + lines[lineno - 1 :])
+
+
+class CodePreflightChecker(BaseAgent):
+    """在执行前静态检查生成的代码
+
+    语法错误直接转交调试，缺失的常用标准库及pandas/numpy导入自动补全，省去一次执行失败及调试的往返。
+    """
+
+    saved_debug_loops = 0
+
+    def known_names(self) -> set[str]:
+        """内核命名空间及之前的单元格中定义的名称"""
+        names = set(IPYTHON_NAMES)
+        ipython = get_ipython()
+        if ipython is not None:
+            names.update(ipython.user_ns)
+        for cell in self.cells:
+            if cell.cell_idx >= self.task.cell_idx or cell.type not in (CellType.CODE, CellType.TASK):
+                continue
+            try:
+                names.update(bound_names(parse_cell(cell.source)))
+            except SyntaxError:
+                pass
+        return names
+
+    def __call__(self):
+        """检查代码，返回(False, True)时继续执行，存在语法错误时返回(True, False)转交调试并计入重试次数"""
+        self.saved_debug_loops = 0
+        source = self.task.source
+        try:
+            tree = parse_cell(source)
+        except SyntaxError as e:
+            self.task.cell_output = ""
+            self.task.cell_result = ""
+            self.task.cell_error = "SyntaxError: {} (line {}, offset {})\n{}".format(
+                e.msg, e.lineno, e.offset, (e.text or "").rstrip()
+            )
+            _E("代码存在语法错误: {}", self.task.cell_error)
+            return True, False
+        if has_star_import(tree):
+            _D("代码中包含`import *`，跳过名称检查")
+            return False, True
+        undefined = undefined_names(tree, self.known_names())
+        resolved = {name: resolve_import(name) for name in undefined}
+        imports = [statement for statement in resolved.values() if statement]
+        unresolved = [name for name, statement in resolved.items() if not statement]
+        if unresolved:
+            _W("代码中存在未定义的名称: {}", ", ".join(unresolved))
+        if imports:
+            _I("自动补全缺失的导入: {}", "; ".join(imports))
+            self.task.source = insert_imports(source, tree, imports)
+            self.saved_debug_loops = 1
+        return False, True
+
+
+def preflight_check(agent) -> tuple[bool, bool]:
+    """在生成或调试代码的Agent中检查其生成的代码，返回值即该Agent的执行结果
+
+    检查在同一阶段内完成，阶段的执行记录仍归属于生成代码的Agent，节省的调试次数记录到该Agent上。
+    """
+    checker = CodePreflightChecker(agent.notebook_context)
+    result = checker()
+    agent.saved_debug_loops = checker.saved_debug_loops
+    return result
@@ -82,6 +82,7 @@ class TaskStructureSummaryAgent(BaseChatAgent):
             "coding_prompt": self.task.coding_prompt,
             "source": self.task.source,
             "output": self.task.output,
+            "exec_profile": self.task.exec_profile,
             "summary_prompt": self.task.summary_prompt,
         }
 
@@ -5,14 +5,20 @@ This software is released under the MIT License.
 https://opensource.org/licenses/MIT
 """
 
+import os
 import re
 import json
-import jinja2
+import time
 import openai
+import hashlib
+import threading
 
 from enum import Enum
-from pydantic import BaseModel
+from contextlib import contextmanager
+from typing import Optional
+from multiprocessing.managers import BaseManager
 from .bot_outputs import _D, _I, _W, _E, _F, _B, _M
+from .utils import get_template_registry
 
 
 class ChatMessages:
@@ -21,34 +27,18 @@ class ChatMessages:
         self.contexts = contexts
         self.templates = templates
         self.display_message = display_message
-        if self.templates is not None:
-            self.jinja_env = jinja2.Environment(
-                loader=jinja2.DictLoader(self.templates), trim_blocks=True, lstrip_blocks=True
-            )
-        else:
-            self.jinja_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
-        self.jinja_env.filters["json"] = self._json
-
-    def _json(self, obj):
-
-        def _default(o):
-            if isinstance(o, BaseModel):
-                return o.model_dump()
-            if isinstance(o, Enum):
-                return o.value
-            return repr(o)
-
-        return json.dumps(obj, indent=2, ensure_ascii=False, default=_default)
+        self.template_registry = get_template_registry()
+        self.jinja_env = self.template_registry.get_environment(self.templates)
 
     def add(self, content, role="user", content_type="text", tpl_context=None):
         tpl_context = tpl_context or self.contexts
         if content_type == "text" and tpl_context is not None:
-            content = self.jinja_env.from_string(content).render(**tpl_context)
+            content = self.template_registry.render(content, self.templates, **tpl_context)
         if content_type == "text":
             content_key = "text"
         else:
             raise NotImplementedError
-        _D("Adding message: role={}, content_type={}".format(role, content_type))
+        _D("Adding message: role={}, content_type={}", role, content_type)
         if self.display_message:
             _B(content, title="Chat Message [type={}, length={}, role={}]".format(content_type, len(content), role))
         if len(self.messages) == 0 or self.messages[-1]["role"] != role:
@@ -63,140 +53,538 @@ class ChatMessages:
         self.messages = []
 
 
+class ChatClientPool:
+    """OpenAI客户端池，按(base_url, api_key, timeout)复用客户端及其HTTP长连接
+
+    通过checkout()使用的客户端记录使用者数量，被淘汰或关闭时若仍有使用者，则在最后一个使用者归还后再关闭。
+    """
+
+    def __init__(self, max_connections=16, max_keepalive_connections=8, keepalive_expiry=60.0, idle_timeout=600.0):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.idle_timeout = idle_timeout
+        self._clients: dict[tuple, list] = {}  # key -> [client, last_used, users]
+        self._lock = threading.Lock()
+
+    def configure(self, max_connections=None, max_keepalive_connections=None, keepalive_expiry=None, idle_timeout=None):
+        """更新连接池配置，连接参数变化时关闭已有客户端，下次请求时按新配置重建"""
+        limits = (self.max_connections, self.max_keepalive_connections, self.keepalive_expiry)
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_keepalive_connections is not None:
+            self.max_keepalive_connections = max_keepalive_connections
+        if keepalive_expiry is not None:
+            self.keepalive_expiry = keepalive_expiry
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        if limits != (self.max_connections, self.max_keepalive_connections, self.keepalive_expiry):
+            self.close()
+
+    def _create_client(self, base_url, api_key, timeout):
+        _I("Connecting to OpenAI API: {}".format(base_url or "default"))
+        # 使用openai所依赖的HTTP库的Limits类型，不直接依赖该库
+        limits_class = type(openai.DEFAULT_CONNECTION_LIMITS)
+        http_client = openai.DefaultHttpxClient(
+            limits=limits_class(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            )
+        )
+        client_kwargs = {"api_key": api_key, "base_url": base_url, "http_client": http_client}
+        if timeout is not None:
+            client_kwargs["timeout"] = timeout
+        return openai.OpenAI(**client_kwargs)
+
+    def _get_entry(self, key):
+        self._evict_idle(time.time(), exclude=key)
+        if key not in self._clients:
+            self._clients[key] = [self._create_client(*key), 0, 0]
+        entry = self._clients[key]
+        entry[1] = time.time()
+        return entry
+
+    def get_client(self, base_url, api_key, timeout=None):
+        """获取可复用的客户端，不存在时创建；不记录使用者，跨线程使用时应使用checkout()"""
+        with self._lock:
+            return self._get_entry((base_url, api_key, timeout))[0]
+
+    @contextmanager
+    def checkout(self, base_url, api_key, timeout=None):
+        """在使用期间占用客户端，期间不会被evict_idle()、configure()或close()关闭"""
+        key = (base_url, api_key, timeout)
+        with self._lock:
+            entry = self._get_entry(key)
+            entry[2] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] = time.time()
+                entry[2] -= 1
+                retired = not entry[2] and self._clients.get(key) is not entry
+            if retired:
+                entry[0].close()
+
+    def _evict_idle(self, now, exclude=None):
+        for key, (client, last_used, users) in list(self._clients.items()):
+            if key != exclude and not users and self.idle_timeout and now - last_used > self.idle_timeout:
+                _D("Evicting idle OpenAI client: {}".format(key[0] or "default"))
+                del self._clients[key]
+                client.close()
+
+    def evict_idle(self):
+        """关闭超过idle_timeout未使用的客户端"""
+        with self._lock:
+            self._evict_idle(time.time())
+
+    def close(self):
+        """关闭所有客户端及其连接，正在使用的客户端在归还后关闭"""
+        with self._lock:
+            entries, self._clients = list(self._clients.values()), {}
+            idle_clients = [client for client, _, users in entries if not users]
+        for client in idle_clients:
+            client.close()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+_default_client_pool = None
+
+
+def get_client_pool() -> ChatClientPool:
+    global _default_client_pool
+
+    if _default_client_pool is None:
+        _default_client_pool = ChatClientPool()
+    return _default_client_pool
+
+
+def close_client_pool():
+    global _default_client_pool
+
+    if _default_client_pool is not None:
+        _default_client_pool.close()
+        _default_client_pool = None
+
+
+_limiter_semaphore = None
+
+
+def _init_limiter_server(max_concurrency):
+    global _limiter_semaphore
+
+    _limiter_semaphore = threading.BoundedSemaphore(max_concurrency)
+
+
+def _get_limiter_semaphore():
+    return _limiter_semaphore
+
+
+class ChatLimiterManager(BaseManager):
+    """跨进程共享的LLM并发限制服务，批量评估时由bot_eval启动，各内核通过环境变量连接"""
+
+    ADDRESS_ENV = "JUPYTER_AGENT_LLM_LIMITER"
+    AUTHKEY_ENV = "JUPYTER_AGENT_LLM_LIMITER_AUTHKEY"
+
+    @classmethod
+    def serve(cls, max_concurrency) -> "ChatLimiterManager":
+        """启动限制服务，并将连接信息写入环境变量供子进程继承"""
+        authkey = os.urandom(16)
+        manager = cls(address=("127.0.0.1", 0), authkey=authkey)
+        manager.start(_init_limiter_server, (max_concurrency,))
+        os.environ[cls.ADDRESS_ENV] = "{}:{}".format(*manager.address)
+        os.environ[cls.AUTHKEY_ENV] = authkey.hex()
+        return manager
+
+
+ChatLimiterManager.register("get_semaphore", callable=_get_limiter_semaphore)
+
+
+class ChatConcurrencyLimiter:
+    """LLM请求并发限制，未配置共享限制服务时不做限制"""
+
+    def __init__(self, semaphore=None):
+        self.semaphore = semaphore
+
+    @classmethod
+    def from_env(cls) -> "ChatConcurrencyLimiter":
+        address = os.environ.get(ChatLimiterManager.ADDRESS_ENV)
+        if not address:
+            return cls()
+        try:
+            host, port = address.rsplit(":", 1)
+            authkey = bytes.fromhex(os.environ.get(ChatLimiterManager.AUTHKEY_ENV, ""))
+            manager = ChatLimiterManager(address=(host, int(port)), authkey=authkey)
+            manager.connect()
+            return cls(manager.get_semaphore())
+        except Exception as e:
+            _W("Failed to connect to LLM concurrency limiter {}: {}".format(address, e))
+            return cls()
+
+    def __enter__(self):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+
+_default_chat_limiter = None
+
+
+def get_chat_limiter() -> ChatConcurrencyLimiter:
+    global _default_chat_limiter
+
+    if _default_chat_limiter is None:
+        _default_chat_limiter = ChatConcurrencyLimiter.from_env()
+    return _default_chat_limiter
+
+
+class ResponseCacheMode(str, Enum):
+    OFF = "off"
+    READWRITE = "readwrite"
+    REPLAY = "replay"
+    RECORD = "record"
+
+
+class ResponseCacheMiss(Exception):
+    pass
+
+
+class ResponseCache:
+    """聊天回复的磁盘缓存，按(接口地址, 模型, 规范化后的消息, 采样参数)索引
+
+    - readwrite: 命中时直接返回缓存的回复，未命中时请求接口并写入缓存
+    - replay: 只读，未命中时抛出ResponseCacheMiss，保证回归测试可复现
+    - record: 总是请求接口，并用新的回复覆盖缓存
+    """
+
+    EVICT_SCAN_INTERVAL = 100
+
+    def __init__(self, cache_dir=None, mode=ResponseCacheMode.OFF, ttl=7 * 24 * 3600, max_size=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.mode = ResponseCacheMode(mode)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "expired": 0, "evictions": 0}
+        self._size = None  # 缓存目录的总大小，None表示需要重新扫描
+        self._writes_since_scan = 0
+
+    def configure(self, cache_dir=None, mode=None, ttl=None, max_size=None):
+        if cache_dir is not None:
+            self.cache_dir = cache_dir or None
+            with self._lock:
+                self._size = None
+        if mode is not None:
+            self.mode = ResponseCacheMode(mode)
+        if ttl is not None:
+            self.ttl = ttl
+        if max_size is not None:
+            self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return self.mode != ResponseCacheMode.OFF and bool(self.cache_dir)
+
+    @staticmethod
+    def normalize_messages(messages):
+        """去除消息文本首尾及行尾的空白，统一换行符，避免无意义的差异导致缓存不命中"""
+
+        def _normalize(value):
+            if isinstance(value, str):
+                lines = value.replace("\r\n", "\n").strip().split("\n")
+                return "\n".join(line.rstrip() for line in lines)
+            if isinstance(value, dict):
+                return {k: _normalize(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [_normalize(v) for v in value]
+            return value
+
+        return _normalize(messages)
+
+    def make_key(self, base_url, model_name, messages, params) -> str:
+        key = {
+            "base_url": base_url,
+            "model": model_name,
+            "messages": self.normalize_messages(messages),
+            "params": params,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False, default=repr).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def get(self, key) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+        if self.ttl and time.time() - entry.get("created", 0) > self.ttl:
+            self._count("expired")
+            self._count("misses")
+            try:
+                size = os.stat(path).st_size
+                os.unlink(path)
+                self._track_size(-size)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count("hits")
+        return entry["content"]
+
+    def _track_size(self, delta, writes=0) -> bool:
+        """累加缓存总大小，返回是否需要扫描缓存目录并淘汰旧条目"""
+        with self._lock:
+            self._writes_since_scan += writes
+            if self._size is None:
+                return True
+            self._size += delta
+            return self._size > self.max_size or self._writes_since_scan >= self.EVICT_SCAN_INTERVAL
+
+    def put(self, key, content, model_name=""):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "model": model_name, "content": content}, f, ensure_ascii=False)
+        size = os.stat(tmp_path).st_size
+        try:
+            size -= os.stat(path).st_size
+        except OSError:
+            pass
+        os.replace(tmp_path, path)
+        self._count("writes")
+        if self.max_size and self._track_size(size, writes=1):
+            self.evict()
+
+    def evict(self):
+        """缓存总大小超过max_size时，按最近使用时间删除最旧的条目
+
+        put只在累计的总大小超过max_size、或每EVICT_SCAN_INTERVAL次写入（计入其他进程的写入）时扫描缓存目录。
+        """
+        if not self.max_size or not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for sub_dir in os.scandir(self.cache_dir):
+            if sub_dir.is_dir():
+                for entry in os.scandir(sub_dir.path):
+                    if entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+                total_size -= size
+                self._count("evictions")
+            except OSError:
+                pass
+        with self._lock:
+            self._size = total_size
+            self._writes_since_scan = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_default_response_cache = ResponseCache()
+
+
+def get_response_cache() -> ResponseCache:
+    return _default_response_cache
+
+
+class ReplyTokenizer:
+    """聊天回复的增量分词器，支持think/code/fence块的嵌套，输出完整的顶层块"""
+
+    DELIMITER_PATTERN = re.compile(r"(<think>)|(</think>)|(```[a-zA-Z_0-9]+)|(```)")
+    PENDING_FENCE_PATTERN = re.compile(r"`+[a-zA-Z_0-9]*\Z")
+
+    def __init__(self):
+        self.buffer = ""
+        self.text = ""
+        self.frames = []
+
+    def _safe_length(self):
+        """返回缓冲区中不会被后续内容改变分词结果的前缀长度"""
+        safe = len(self.buffer)
+        if mo := self.PENDING_FENCE_PATTERN.search(self.buffer):
+            safe = mo.start()
+        for tag in ("<think>", "</think>"):
+            for k in range(len(tag) - 1, 0, -1):
+                if self.buffer.endswith(tag[:k]):
+                    safe = min(safe, len(self.buffer) - k)
+                    break
+        return safe
+
+    def _close_frame(self):
+        kind, opener, text = self.frames.pop()
+        closer = "</think>" if kind == "think" else "```"
+        if self.frames:
+            self.frames[-1][2] += text + closer
+            return None
+        if kind == "think":
+            return {"type": "think", "content": text, "raw": opener + text + closer}
+        elif kind == "code":
+            return {"type": "code", "lang": opener[3:].lower(), "content": text, "raw": opener + text + closer}
+        else:
+            return {"type": "fence", "content": text, "raw": opener + text + closer}
+
+    def _flush_text(self):
+        text, self.text = self.text, ""
+        return [{"type": "text", "content": text}] if text else []
+
+    def _process(self, token):
+        blocks = []
+        if not self.frames:
+            if token == "<think>":
+                blocks += self._flush_text()
+                self.frames.append(["think", token, ""])
+            elif token.startswith("```"):
+                blocks += self._flush_text()
+                self.frames.append(["code" if len(token) > 3 else "fence", token, ""])
+            elif token == "</think>":
+                blocks += self._flush_text()
+                blocks.append({"type": "text", "content": token})
+            else:
+                self.text += token
+        elif self.frames[-1][0] == "think":
+            if token == "</think>":
+                blocks.append(self._close_frame())
+            elif token == "<think>":
+                self.frames.append(["think", token, ""])
+            else:
+                self.frames[-1][2] += token
+        else:
+            if token == "```":
+                blocks.append(self._close_frame())
+            elif token.startswith("```"):
+                self.frames.append(["code", token, ""])
+            else:
+                self.frames[-1][2] += token
+        return [block for block in blocks if block is not None]
+
+    def feed(self, chunk):
+        """输入一段回复内容，返回已完整结束的块"""
+        self.buffer += chunk or ""
+        safe = self._safe_length()
+        data, self.buffer = self.buffer[:safe], self.buffer[safe:]
+        blocks = []
+        for token in self.DELIMITER_PATTERN.split(data):
+            if token:
+                blocks += self._process(token)
+        return blocks
+
+    def close(self):
+        """结束输入，返回剩余的块，未闭合的块视为已结束"""
+        blocks = []
+        for token in self.DELIMITER_PATTERN.split(self.buffer):
+            if token:
+                blocks += self._process(token)
+        self.buffer = ""
+        while self.frames:
+            block = self._close_frame()
+            if block is not None:
+                blocks.append(block)
+        return blocks + self._flush_text()
+
+
 class BotChat:
     """聊天混合类，提供聊天相关功能"""
 
     display_think = True
     display_message = True
     display_response = False
+    timeout = None
+    stream = False
 
     def __init__(self, base_url, api_key, model_name, **chat_kwargs):
         """初始化聊天混合类"""
         self.base_url = base_url
         self.api_key = api_key
         self.model_name = model_name
+        self.timeout = chat_kwargs.get("timeout", self.timeout)
+        self.stream = chat_kwargs.get("stream", self.stream)
         self.display_think = chat_kwargs.get("display_think", self.display_think)
         self.display_message = chat_kwargs.get("display_message", self.display_message)
         self.display_response = chat_kwargs.get("display_response", self.display_response)
 
     def parse_reply(self, reply, ret_think_block=False, ret_empty_block=False, display_reply=True):
         """解析聊天回复"""
+        return self.parse_reply_stream(
+            [reply], ret_think_block=ret_think_block, ret_empty_block=ret_empty_block, display_reply=display_reply
+        )
 
-        def _read_think_block(tokens):
-            text = ""
-            while True:
-                try:
-                    token = next(iter_tokens)
-                except StopIteration:
-                    break
-                if token is None:
-                    continue
-                if token == "</think>":
-                    break
-                elif token == "<think>":
-                    text += _read_think_block(tokens)
-                    text += "</think>"
-                # elif token.startswith("```") and len(token) > 3:
-                #     text += _read_code_block(tokens)
-                # elif token.startswith("```") and len(token) == 3:
-                #     text += _read_fence_block(tokens)
-                else:
-                    text += token
-            return text
-
-        def _read_code_block(tokens):
-            text = ""
-            while True:
-                try:
-                    token = next(iter_tokens)
-                except StopIteration:
-                    break
-                if token is None:
-                    continue
-                if token == "```":
-                    break
-                # elif token == "<think>":
-                #     text += _read_think_block(tokens)
-                elif token.startswith("```") and len(token) > 3:
-                    text += _read_code_block(tokens)
-                    text += "```"
-                else:
-                    text += token
-            return text
-
-        def _read_fence_block(tokens):
-            text = ""
-            while True:
+    def parse_reply_stream(self, chunks, ret_think_block=False, ret_empty_block=False, display_reply=True):
+        """增量解析聊天回复，每个块在其结束标记到达时立即输出"""
+        tokenizer = ReplyTokenizer()
+        for chunk in chunks:
+            for block in tokenizer.feed(chunk):
+                yield from self._handle_block(block, ret_think_block, ret_empty_block, display_reply)
+        for block in tokenizer.close():
+            yield from self._handle_block(block, ret_think_block, ret_empty_block, display_reply)
+
+    def _handle_block(self, block, ret_think_block, ret_empty_block, display_reply):
+        content = block["content"]
+        if block["type"] == "think":
+            if (self.display_think or display_reply) and content and content.strip():
+                _B(content, title="Thought Block")
+            if ret_think_block and (ret_empty_block or content and content.strip()):
+                yield block
+        elif block["type"] == "code":
+            if display_reply and content and content.strip():
+                _B(content, title="Code Block", format="code", code_language=block["lang"])
+            if ret_empty_block or content and content.strip():
+                yield block
+        elif block["type"] == "fence":
+            if display_reply and content and content.strip():
+                _B(content, title="Fence Block", format="code", code_language="text")
+            if ret_empty_block or content and content.strip():
+                yield block
+        else:
+            token = content
+            is_json_block = False
+            if (
+                token.strip().startswith("{")
+                and token.strip().endswith("}")
+                or token.strip().startswith("[")
+                and token.strip().endswith("]")
+            ):
                 try:
-                    token = next(iter_tokens)
-                except StopIteration:
-                    break
-                if token is None:
-                    continue
-                if token == "```":
-                    break
-                # elif token == "<think>":
-                #     text += _read_think_block(tokens)
-                elif token.startswith("```") and len(token) > 3:
-                    text += _read_code_block(tokens)
-                    text += "```"
-                else:
-                    text += token
-            return text
-
-        tokens = re.split(r"(<think>)|(</think>)|(```[a-zA-Z_0-9]+)|(```)", reply)
-        iter_tokens = iter(tokens)
-        while True:
-            try:
-                token = next(iter_tokens)
-            except StopIteration:
-                break
-            if token:
-                if token == "<think>":
-                    think_block = _read_think_block(iter_tokens)
-                    raw_think_block = token + think_block + "</think>"
-                    if (self.display_think or display_reply) and think_block and think_block.strip():
-                        _B(think_block, title="Thought Block")
-                    if ret_think_block and (ret_empty_block or think_block and think_block.strip()):
-                        yield {"type": "think", "content": think_block, "raw": raw_think_block}
-                elif token.startswith("```") and len(token) > 3:
-                    content = _read_code_block(iter_tokens)
-                    raw_content = token + content + "```"
-                    lang = token[3:].lower()
-                    if display_reply and content and content.strip():
-                        _B(content, title="Code Block", format="code", code_language=lang)
-                    if ret_empty_block or content and content.strip():
-                        yield {"type": "code", "lang": lang, "content": content, "raw": raw_content}
-                elif token.startswith("```") and len(token) == 3:
-                    content = _read_fence_block(iter_tokens)
-                    raw_content = token + content + "```"
-                    if display_reply and content and content.strip():
-                        _B(content, title="Fence Block", format="code", code_language="text")
-                    if ret_empty_block or content and content.strip():
-                        yield {"type": "fence", "content": content, "raw": raw_content}
-                else:
-                    is_json_block = False
-                    if (
-                        token.strip().startswith("{")
-                        and token.strip().endswith("}")
-                        or token.strip().startswith("[")
-                        and token.strip().endswith("]")
-                    ):
-                        try:
-                            json.loads(token)
-                            _I(f"Got JSON Block from text: {repr(token)[:80]}")
-                            is_json_block = True
-                            if display_reply and token and token.strip():
-                                _B(token, title="JSON Block", format="code", code_language="json")
-                            if ret_empty_block or token and token.strip():
-                                yield {"type": "code", "lang": "json", "content": token.strip(), "raw": token}
-                        except json.JSONDecodeError:
-                            _I(f"Got non-JSON Block from text: {repr(token)[:80]}")
-                    if not is_json_block:
-                        if display_reply and token and token.strip():
-                            _M(token)
-                        if ret_empty_block or token and token.strip():
-                            yield {"type": "text", "content": token, "raw": token}
+                    json.loads(token)
+                    _I(f"Got JSON Block from text: {repr(token)[:80]}")
+                    is_json_block = True
+                    if display_reply and token and token.strip():
+                        _B(token, title="JSON Block", format="code", code_language="json")
+                    if ret_empty_block or token and token.strip():
+                        yield {"type": "code", "lang": "json", "content": token.strip(), "raw": token}
+                except json.JSONDecodeError:
+                    _I(f"Got non-JSON Block from text: {repr(token)[:80]}")
+            if not is_json_block:
+                if display_reply and token and token.strip():
+                    _M(token)
+                if ret_empty_block or token and token.strip():
+                    yield {"type": "text", "content": token, "raw": token}
 
     def create_messages(self, contexts=None, templates=None):
         return ChatMessages(contexts=contexts, templates=templates, display_message=self.display_message)
@@ -210,29 +598,68 @@ class BotChat:
         max_tokens=32 * 1024,
         max_completion_tokens=4 * 1024,
         n=1,
+        stream=None,
+        stop_when=None,
         **kwargs,
     ):
-        """发送聊天请求"""
-        _I("Connecting to OpenAI API: {}".format(self.base_url or "default"))
-        openai_client = openai.OpenAI(api_key=self.api_key, base_url=self.base_url)
-        _I("Sending request to OpenAI API, model: {}".format(self.model_name))
-        response = openai_client.chat.completions.create(
-            model=self.model_name,
-            messages=messages,
-            max_tokens=max_tokens,
-            max_completion_tokens=max_completion_tokens,
-            n=n,
-            **kwargs,
-        )
+        """发送聊天请求
+
+        stream为True时以流式方式接收回复，每个块结束后立即解析输出；
+        stop_when(replies)返回True时提前终止生成；
+        启用回复缓存时按缓存模式读取或写入缓存的回复。
+        """
+        stream = self.stream if stream is None else stream
+        response_cache = get_response_cache()
+        cache_key = None
+        if response_cache.enabled:
+            cache_key = response_cache.make_key(
+                self.base_url,
+                self.model_name,
+                messages,
+                dict(kwargs, max_tokens=max_tokens, max_completion_tokens=max_completion_tokens, n=n),
+            )
+            if response_cache.mode != ResponseCacheMode.RECORD:
+                reply = response_cache.get(cache_key)
+                if reply is not None:
+                    _I("Using cached response, model: {}".format(self.model_name))
+                    if self.display_response:
+                        _B(reply, title="Chat Response")
+                    return list(
+                        self.parse_reply(
+                            reply,
+                            ret_think_block=ret_think_block,
+                            ret_empty_block=ret_empty_block,
+                            display_reply=display_reply,
+                        )
+                    )
+                if response_cache.mode == ResponseCacheMode.REPLAY:
+                    raise ResponseCacheMiss("No cached response in replay mode, model: {}".format(self.model_name))
+        with get_client_pool().checkout(self.base_url, self.api_key, self.timeout) as openai_client, get_chat_limiter():
+            _I("Sending request to OpenAI API, model: {}".format(self.model_name))
+            response = openai_client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                max_tokens=max_tokens,
+                max_completion_tokens=max_completion_tokens,
+                n=n,
+                stream=stream,
+                **kwargs,
+            )
+            if stream:
+                return self._chat_stream(
+                    response, ret_think_block, ret_empty_block, display_reply, stop_when, cache_key
+                )
         if not response.choices or not response.choices[0].message:
             _E("No valid response from OpenAI API")
             return []
         else:
             _I("Received response from OpenAI API")
-            _D("Response content: " + repr(response.choices[0].message.content)[:50])
+            _D("Response content: {!r:.50}", response.choices[0].message.content)
             if self.display_response:
                 _B(response.choices[0].message.content, title="Chat Response")
             reply = response.choices[0].message.content
+            if cache_key is not None and reply:
+                response_cache.put(cache_key, reply, self.model_name)
             return list(
                 self.parse_reply(
                     reply,
@@ -241,3 +668,38 @@ class BotChat:
                     display_reply=display_reply,
                 )
             )
+
+    def _chat_stream(self, response, ret_think_block, ret_empty_block, display_reply, stop_when, cache_key=None):
+        contents = []
+
+        def _iter_contents():
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                    contents.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+
+        replies = []
+        stopped = False
+        for block in self.parse_reply_stream(
+            _iter_contents(),
+            ret_think_block=ret_think_block,
+            ret_empty_block=ret_empty_block,
+            display_reply=display_reply,
+        ):
+            replies.append(block)
+            if stop_when is not None and stop_when(replies):
+                _I("Got the required reply blocks, stop generating")
+                response.close()
+                stopped = True
+                break
+        if not contents:
+            _E("No valid response from OpenAI API")
+            return []
+        _I("Received streaming response from OpenAI API")
+        _D(lambda: "Response content: {!r:.50}".format("".join(contents)))
+        if self.display_response:
+            _B("".join(contents), title="Chat Response")
+        if cache_key is not None and not stopped:
+            # 提前停止生成时回复不完整，不写入缓存，避免以相同请求命中时返回截断的回复
+            get_response_cache().put(cache_key, "".join(contents), self.model_name)
+        return replies
@@ -11,10 +11,12 @@ import json
 import yaml
 import time
 import shlex
+import hashlib
 import argparse
+import threading
 import traceback
-import nbformat
 
+from collections import OrderedDict
 
 from typing import Optional, Type
 from enum import Enum
@@ -22,7 +24,7 @@ from pydantic import BaseModel, Field
 from IPython.core.getipython import get_ipython
 from .bot_outputs import _D, _I, _W, _E, _F, _A, ReplyType
 from .bot_actions import UserSupplyInfoReply
-from .utils import get_env_capbilities, indent
+from .utils import get_env_capbilities, indent, read_notebook
 
 
 class CellType(str, Enum):
@@ -74,6 +76,14 @@ class CellContext:
     def source(self):
         return self.cell_source
 
+    def get_hash_fields(self) -> tuple:
+        return (type(self).__name__, self.cell_idx, self.cell_type, self.source, tuple(sorted(self.cell_tags)))
+
+    @property
+    def content_hash(self) -> str:
+        """单元格内容的哈希值，内容不变时哈希值不变，用于缓存渲染结果"""
+        return hashlib.sha1(repr(self.get_hash_fields()).encode("utf-8")).hexdigest()
+
     @property
     def is_code_context(self):
         return (
@@ -106,6 +116,9 @@ class UserSupplyInfoCellContext(CellContext):
         else:
             self.cell_format = "YAML"
 
+    def get_hash_fields(self) -> tuple:
+        return super().get_hash_fields() + (self.cell_format,)
+
     def get_user_supply_infos(self) -> list[UserSupplyInfoReply]:
         if self.cell_format == "JSON":
             infos = json.loads(self.cell_source)
@@ -145,6 +158,9 @@ class CodeCellContext(CellContext):
         self._cell_error = ""
         self.load_cell_outputs(cell)
 
+    def get_hash_fields(self) -> tuple:
+        return super().get_hash_fields() + (self._cell_output, self._cell_result, self._cell_error)
+
     def get_cell_output(self):
         """获取任务单元格的输出"""
         if len(self._cell_output) > self.max_output_size:
@@ -202,17 +218,17 @@ class CodeCellContext(CellContext):
             for output in cell.get("outputs", []):
                 # Available output types: stream, error, execute_result, display_data
                 if output["output_type"] == "stream":
-                    _D(f"CELL[{self.cell_idx}] Stream output: {output["name"]}:{repr(output['text'])[:50]}")
+                    _D("CELL[{}] Stream output: {}:{!r:.50}", self.cell_idx, output["name"], output["text"])
                     self.cell_output += output["name"] + ":\n" + output["text"] + "\n"
                 if output["output_type"] == "error":
-                    _D(f"CELL[{self.cell_idx}] Error output: {output.get("ename", "")} {output.get('evalue', "")}")
+                    _D("CELL[{}] Error output: {} {}", self.cell_idx, output.get("ename", ""), output.get("evalue", ""))
                     self.cell_error += output.get("ename", "") + ": " + output.get("evalue", "") + "\n"
                     if "traceback" in output:
                         self.cell_error += "Traceback:\n" + "\n".join(output.get("traceback", [])) + "\n"
                 if output["output_type"] == "execute_result":
                     output_data = output.get("data", {})
                     output_text = output_data.get("text/markdown") or output_data.get("text/plain")
-                    _D(f"CELL[{self.cell_idx}] Execute result: {repr(output_text)[:50]}")
+                    _D("CELL[{}] Execute result: {!r:.50}", self.cell_idx, output_text)
                     self.cell_result += output_text + "\n"
                 if output["output_type"] == "display_data":
                     output_meta = output.get("metadata", {})
@@ -221,10 +237,10 @@ class CodeCellContext(CellContext):
                         output_text = output_data.get("text/markdown") or output_data.get("text/plain")
                         reply_type = output_meta.get("reply_type")
                         if reply_type == ReplyType.CELL_ERROR:
-                            _D(f"CELL[{self.cell_idx}] Display error data: {repr(output_text)[:50]}")
+                            _D("CELL[{}] Display error data: {!r:.50}", self.cell_idx, output_text)
                             self.cell_error += output_text + "\n"
                         else:
-                            _D(f"CELL[{self.cell_idx}] Display output data: {repr(output_text)[:50]}")
+                            _D("CELL[{}] Display output data: {!r:.50}", self.cell_idx, output_text)
                             self.cell_output += output_text + "\n"
         except Exception as e:
             _W("Failed to load notebook cells {}: {}".format(type(e), str(e)))
@@ -242,6 +258,10 @@ class AgentData(BaseModel):
     important_infos: Optional[dict] = Field(None, description="重要信息[JSON]")
     request_above_supply_infos: Optional[list] = Field(None, description="前置用户需求补充[JSON]")
     request_below_supply_infos: Optional[list] = Field(None, description="后置用户需求补充[JSON]")
+    max_exec_time: float = Field(0, description="代码执行的墙钟时间上限（秒），0表示使用默认配置")
+    max_exec_cpu_time: float = Field(0, description="代码执行的CPU时间上限（秒），0表示使用默认配置")
+    max_exec_memory: int = Field(0, description="代码执行的内存增长上限（MB），0表示使用默认配置")
+    exec_profile: Optional[dict] = Field(None, description="代码执行的性能数据[JSON]")
 
     @classmethod
     def default(cls) -> "AgentData":
@@ -268,6 +288,7 @@ class AgentCellContext(CodeCellContext):
         super().__init__(idx, cell)
         self.agent_flow = None
         self.agent_stage = None
+        self.exec_snapshot = None  # 代码执行前的变量快照，供优化阶段使用
         self.magic_line, self.magic_code = self.cell_source.split("\n", 1)
         self.magic_argv = shlex.split(self.magic_line)
         self.magic_name = self.magic_argv[0]
@@ -299,6 +320,9 @@ class AgentCellContext(CodeCellContext):
     def result(self):
         return self.agent_data.result
 
+    def get_hash_fields(self) -> tuple:
+        return super().get_hash_fields() + (self.agent_data.model_dump_json(),)
+
     def __getattr__(self, name):
         return getattr(self.agent_data, name)
 
@@ -327,12 +351,14 @@ class AgentCellContext(CodeCellContext):
         parser.add_argument("-s", "--stage", type=str, default=None, help="Task stage")
         options, self._remain_args = parser.parse_known_args(self.magic_argv)
         _D(
-            "CELL[{}] Magic Name: {}, Magic Args: {}, Remain Args: {}".format(
-                self.cell_idx, self.magic_name, options, self._remain_args
-            )
+            "CELL[{}] Magic Name: {}, Magic Args: {}, Remain Args: {}",
+            self.cell_idx,
+            self.magic_name,
+            options,
+            self._remain_args,
         )
-        _D("CELL[{}] Magic Line: {}".format(self.cell_idx, repr(self.magic_line[len(self.magic_name) :].strip())))
-        _D("CELL[{}] Magic Code: {}".format(self.cell_idx, repr(self.magic_code.strip())))
+        _D(lambda: "CELL[{}] Magic Line: {!r}".format(self.cell_idx, self.magic_line[len(self.magic_name) :].strip()))
+        _D(lambda: "CELL[{}] Magic Code: {!r}".format(self.cell_idx, self.magic_code.strip()))
         self.agent_flow = options.flow
         self.agent_stage = options.stage
         if options.planning and not self.agent_flow:
@@ -363,8 +389,8 @@ class AgentCellContext(CodeCellContext):
             else:
                 cell_code += line + "\n"
         self._cell_code = cell_code.strip()
-        _D("CELL[{}] Cell Options: {} ...".format(self.cell_idx, repr(cell_options)[:80]))
-        _D("CELL[{}] Cell Code: {} ...".format(self.cell_idx, repr(self._cell_code)[:80]))
+        _D("CELL[{}] Cell Options: {!r:.80} ...", self.cell_idx, cell_options)
+        _D("CELL[{}] Cell Code: {!r:.80} ...", self.cell_idx, self._cell_code)
         if cell_options:
             try:
                 cell_options = yaml.safe_load(cell_options)
@@ -372,7 +398,7 @@ class AgentCellContext(CodeCellContext):
                     if self.has_data(key):
                         if self.is_json_field(key) and isinstance(value, str):
                             value = json.loads(value)
-                        _D("CELL[{}] Load task option {}: {}".format(self.cell_idx, key, value))
+                        _D("CELL[{}] Load task option {}: {}", self.cell_idx, key, value)
                         self.set_data(key, value)
             except Exception as e:
                 _W("Failed to load task options {}: {}".format(type(e), str(e)))
@@ -387,17 +413,17 @@ class AgentCellContext(CodeCellContext):
                 output_meta = output.get("metadata", {})
                 if output_meta.get("reply_type") == ReplyType.TASK_RESULT:
                     output_text = output_data.get("text/markdown") or output_data.get("text/plain")
-                    _D(f"CELL[{self.cell_idx}] Task result: {repr(output_text)[:80]}")
+                    _D("CELL[{}] Task result: {!r:.80}", self.cell_idx, output_text)
                     task_result += "\n" + output_text
         if task_result.strip():
             self.agent_data.result = task_result
 
     def load_data_from_metadata(self, cell):
         agent_meta_infos = cell.get("metadata", {}).get("jupyter-agent-data", {})
-        _D("CELL[{}] Agent Meta Data: {}".format(self.cell_idx, repr(agent_meta_infos)[:80]))
+        _D("CELL[{}] Agent Meta Data: {!r:.80}", self.cell_idx, agent_meta_infos)
         for k, v in agent_meta_infos.items():
             if self.has_data(k):
-                _D(f"CELL[{self.cell_idx}] Load agent meta data: {k}: {repr(v)[:80]}")
+                _D("CELL[{}] Load agent meta data: {}: {!r:.80}", self.cell_idx, k, v)
                 self.set_data(k, v)
 
     def format_magic_line(self):
@@ -460,6 +486,9 @@ class AgentCellContext(CodeCellContext):
             for key, value in self.agent_data.model_dump().items():
                 if key == "result" and self.type == CellType.PLANNING:
                     continue
+                if key == "exec_profile":
+                    # 性能数据每次执行都会变化，只保存在元数据及评估记录中，不写入单元格代码
+                    continue
                 if value:
                     if isinstance(value, (dict, list)) and self.is_json_field(key):
                         value = json.dumps(value, ensure_ascii=False, indent=4)
@@ -482,10 +511,57 @@ class AgentCellContext(CodeCellContext):
         cell_source += "\n" + self.source
         ipython = get_ipython()
         if ipython is not None:
-            _D("Updating Cell Source: {} ...".format(repr(cell_source)[:80]))
+            _D("Updating Cell Source: {!r:.80} ...", cell_source)
             ipython.set_next_input(cell_source, replace=True)
 
 
+class NotebookCellCache:
+    """按(Notebook路径, 单元格序号, 原始单元格哈希)缓存已解析的CellContext，在同一内核的多次调用间复用"""
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._cells: OrderedDict[tuple, CellContext] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash_cell(cell: dict) -> str:
+        return hashlib.sha1(json.dumps(cell, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, notebook_path, idx, cell_hash) -> Optional[CellContext]:
+        key = (notebook_path, idx, cell_hash)
+        with self._lock:
+            cell_ctx = self._cells.get(key)
+            if cell_ctx is not None:
+                self.hits += 1
+                self._cells.move_to_end(key)
+            else:
+                self.misses += 1
+            return cell_ctx
+
+    def put(self, notebook_path, idx, cell_hash, cell_ctx: CellContext):
+        with self._lock:
+            self._cells[(notebook_path, idx, cell_hash)] = cell_ctx
+            while len(self._cells) > self.max_size:
+                self._cells.popitem(last=False)
+
+    def __len__(self):
+        return len(self._cells)
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self.hits = self.misses = 0
+
+
+_notebook_cell_cache = NotebookCellCache()
+
+
+def get_notebook_cell_cache() -> NotebookCellCache:
+    return _notebook_cell_cache
+
+
 class NotebookContext:
     """Notebook上下文类"""
 
@@ -508,25 +584,36 @@ class NotebookContext:
                 or self.notebook_state != os.stat(self.notebook_path).st_mtime
             ):
                 _I(f"Loading Notebook Context: {self.notebook_path}")
-                with open(self.notebook_path, "r", encoding="utf-8") as f:
-                    nb = nbformat.read(f, as_version=4)
+                with open(self.notebook_path, "rb") as f:
+                    nb = read_notebook(f)
                 self._cells = []
                 cur_line_compact = "".join(self.cur_line.split())
                 cur_content_compact = "".join(self.cur_content.split())
-                for idx, cell in enumerate(nb.cells):
-                    _D(f"CELL[{idx}] {cell['cell_type']} {repr(cell['source'])[:80]}")
-                    cell_ctx = CellContext.from_cell(idx, cell)
+                cell_cache = get_notebook_cell_cache()
+                reused = 0
+                for idx, cell in enumerate(nb["cells"]):
+                    cell_hash = cell_cache.hash_cell(cell)
+                    cell_ctx = cell_cache.get(self.notebook_path, idx, cell_hash)
+                    cached = cell_ctx is not None
+                    if not cached:
+                        _D("CELL[{}] {} {!r:.80}", idx, cell["cell_type"], cell["source"])
+                        cell_ctx = CellContext.from_cell(idx, cell)
                     if isinstance(cell_ctx, AgentCellContext):
                         magic_line_compact = "".join(cell_ctx.magic_line[len(cell_ctx.magic_name) :].split())
                         magic_code_compact = "".join(cell_ctx.magic_code.split())
                         if cur_line_compact == magic_line_compact and cur_content_compact == magic_code_compact:
                             if self._current_cell is None:
                                 _I(f"CELL[{idx}] Reach current cell, RETURN!")
-                                self._current_cell = cell_ctx
+                                # 当前任务单元格会在执行过程中被修改，不复用缓存
+                                self._current_cell = CellContext.from_cell(idx, cell)
                             else:
                                 _I(f"CELL[{idx}] Reach current cell, SKIP!")
                             break
+                    if not cached:
+                        cell_cache.put(self.notebook_path, idx, cell_hash, cell_ctx)
+                    reused += cached
                     self._cells.append(cell_ctx)
+                _D(f"Reused {reused} cached cells, parsed {len(self._cells) - reused} cells")
                 self.notebook_state = os.stat(self.notebook_path).st_mtime
                 _I(f"Got {len(self._cells)} notebook cells")
         except Exception as e:
@@ -6,19 +6,31 @@ https://opensource.org/licenses/MIT
 """
 
 import os
+import sys
+import copy
 import time
 import json
+import glob
+import gzip
+import threading
 import random
 import argparse
+import traceback
 import nbformat
 
 from pathlib import Path
 from typing import Optional
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
 from pydantic import BaseModel, Field
 from nbclient.client import NotebookClient
 from .bot_actions import ActionBase, ActionSetCellContent, SetCellContentParams, get_action_class
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class BaseEvaluationRecord(BaseModel):
     timestamp: float = 0
@@ -40,6 +52,9 @@ class BaseEvaluationRecord(BaseModel):
     coding_score: float = 0.0
     important_score: float = 0.0
     user_supply_score: float = 0.0
+    response_cache: Optional[dict] = None
+    exec_profile: Optional[dict] = None
+    saved_debug_loops: int = 0
 
 
 class StageEvaluationRecord(BaseEvaluationRecord):
@@ -54,6 +69,233 @@ class NotebookEvaluationRecord(BaseEvaluationRecord):
     eval_type: str = "NOTEBOOK"
 
 
+class EvaluationSink:
+    """评估记录输出的基类"""
+
+    def write(self, record: BaseEvaluationRecord):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonlEvaluationSink(EvaluationSink):
+    """带缓冲的JSONL输出，缓冲的记录数达到buffer_size或距上次写入超过flush_interval秒时写入文件"""
+
+    def __init__(self, path: str | Path, buffer_size: int = 64, flush_interval: float = 1.0):
+        self.path = Path(path)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._file = None
+        self._last_flush_time = 0.0  # 第一条记录立即写入，尽早创建文件
+        self._lock = threading.Lock()
+
+    def open_file(self):
+        return open(self.path, "a", encoding="utf-8")
+
+    def write(self, record: BaseEvaluationRecord):
+        with self._lock:
+            self._buffer.append(record.model_dump_json() + "\n")
+            if len(self._buffer) < self.buffer_size and time.time() - self._last_flush_time < self.flush_interval:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush_time = time.time()
+            if not self._buffer:
+                return
+            if self._file is None:
+                self._file = self.open_file()
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class GzipJsonlEvaluationSink(JsonlEvaluationSink):
+    """gzip压缩的JSONL输出，每次写入缓冲都追加一个完整的gzip成员，写入后文件即可被gzip.open连续读取"""
+
+    def open_file(self):
+        return gzip.open(self.path, "at", encoding="utf-8")
+
+    def flush(self):
+        super().flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class NpzEvaluationSink(EvaluationSink):
+    """NumPy列式输出，BaseEvaluationRecord的每个数值及字符串字段保存为.npz中的一个数组"""
+
+    def __init__(self, path: str | Path):
+        if np is None:
+            raise ImportError("numpy is required for .npz evaluation output")
+        self.path = Path(path)
+        field_dtypes = {int: np.int64, float: np.float64, bool: np.bool_, str: np.str_}
+        self.dtypes = {
+            name: field_dtypes[field.annotation]
+            for name, field in BaseEvaluationRecord.model_fields.items()
+            if field.annotation in field_dtypes
+        }
+        self.columns = {name: [] for name in self.dtypes}
+        if self.path.exists():
+            with np.load(self.path) as data:
+                for name in self.columns:
+                    if name in data:
+                        self.columns[name].extend(data[name].tolist())
+        self._lock = threading.Lock()
+
+    def write(self, record: BaseEvaluationRecord):
+        with self._lock:
+            for name, values in self.columns.items():
+                values.append(getattr(record, name))
+
+    def flush(self):
+        with self._lock:
+            arrays = {name: np.asarray(values, dtype=self.dtypes[name]) for name, values in self.columns.items()}
+            tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp.npz")
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, self.path)
+
+
+def create_evaluation_sink(path: str | Path, **kwargs) -> EvaluationSink:
+    """按文件后缀创建评估记录输出：.npz为列式NumPy文件，.gz为gzip压缩的JSONL，其余为JSONL"""
+    suffix = Path(path).suffix.lower()
+    if suffix == ".npz":
+        return NpzEvaluationSink(path)
+    elif suffix == ".gz":
+        return GzipJsonlEvaluationSink(path, **kwargs)
+    else:
+        return JsonlEvaluationSink(path, **kwargs)
+
+
+class NotebookCheckpointWriter:
+    """后台写入Notebook检查点
+
+    每执行interval秒或every_n个单元格才生成一次快照，快照交给后台线程序列化，
+    未写入的旧快照会被新快照替换；写入时先写临时文件再重命名，保证输出文件完整。
+    interval和every_n都为0时每个单元格都会写入。
+    """
+
+    def __init__(self, output_path: str | Path, interval: float = 2.0, every_n: int = 0):
+        self.output_path = Path(output_path)
+        self.interval = interval
+        self.every_n = every_n
+        self.writes = 0
+        self._pending = None
+        self._writing = False
+        self._dirty_cells = 0
+        self._last_snapshot_time = 0.0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="NotebookCheckpointWriter", daemon=True)
+        self._thread.start()
+
+    def _is_due(self):
+        if not self.interval and not self.every_n:
+            return True
+        if self.every_n and self._dirty_cells >= self.every_n:
+            return True
+        return bool(self.interval) and time.time() - self._last_snapshot_time >= self.interval
+
+    def notify(self, notebook):
+        """标记Notebook已变化，满足写入策略时提交快照"""
+        self._dirty_cells += 1
+        if self._is_due():
+            self._submit(notebook)
+
+    def _submit(self, notebook):
+        # 快照在调用线程生成，避免后台序列化时Notebook仍在被修改
+        snapshot = copy.deepcopy(notebook)
+        self._dirty_cells = 0
+        self._last_snapshot_time = time.time()
+        with self._cond:
+            self._pending = snapshot
+            self._cond.notify_all()
+
+    @property
+    def dirty(self):
+        return self._dirty_cells > 0
+
+    def flush(self, notebook=None):
+        """提交Notebook的最新快照（如有）并等待所有快照写入完成"""
+        if notebook is not None:
+            self._submit(notebook)
+        with self._cond:
+            while self._pending is not None or self._writing:
+                self._cond.wait()
+
+    def close(self, notebook=None):
+        self.flush(notebook)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def write(self, notebook):
+        tmp_path = self.output_path.with_name(f".{self.output_path.name}.{os.getpid()}.tmp")
+        nbformat.write(notebook, str(tmp_path))
+        os.replace(tmp_path, self.output_path)
+        self.writes += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                notebook, self._pending = self._pending, None
+                self._writing = True
+            try:
+                self.write(notebook)
+            except Exception as e:
+                print(f"Failed to write notebook checkpoint {self.output_path}: {type(e).__name__}: {e}")
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+
+OUTPUT_RECORD_KEYS = ("jupyter-agent-evaluation-records", "jupyter-agent-action-records")
+
+
+class AgentNotebookClient(NotebookClient):
+    """在每条display_data/update_display_data消息到达时回调on_display_metadata
+
+    AgentOutput的每次更新只携带新增的记录，而NotebookClient只保留同一display_id最后一次更新的元数据，
+    因此需要在消息到达时收集。
+    """
+
+    def __init__(self, nb, on_display_metadata=None, **kwargs):
+        super().__init__(nb, **kwargs)
+        self.on_display_metadata = on_display_metadata
+
+    def process_message(self, msg, cell, cell_index):
+        if self.on_display_metadata is not None and msg["msg_type"] in ("display_data", "update_display_data"):
+            self.on_display_metadata(cell_index, msg["content"].get("metadata") or {})
+        return super().process_message(msg, cell, cell_index)
+
+
 class NotebookRunner:
 
     def __init__(
@@ -67,6 +309,10 @@ class NotebookRunner:
         startup_timeout: int = 60,
         allow_errors: bool = False,
         skip_cells_with_tag: str = "skip-execution",
+        response_cache_mode: str = "",
+        response_cache_dir: str | Path = "",
+        checkpoint_interval: float = 2.0,
+        checkpoint_every: int = 0,
         **kwargs,
     ):
         self.input_path = Path(input_path).with_suffix(".ipynb")
@@ -76,6 +322,12 @@ class NotebookRunner:
         self.max_cells = max_cells
         self.start_time = 0
         self.is_global_finished = False
+        self.response_cache_stats = {}
+        # 内核进程继承环境变量，由BotMagics读取回复缓存配置
+        if response_cache_mode:
+            os.environ["JUPYTER_AGENT_RESPONSE_CACHE_MODE"] = response_cache_mode
+        if response_cache_dir:
+            os.environ["JUPYTER_AGENT_RESPONSE_CACHE_DIR"] = str(Path(response_cache_dir).absolute())
 
         suffix = str(int(time.time()))
         if not self.output_path:
@@ -99,8 +351,13 @@ class NotebookRunner:
             print("Opening notebook:", input_path)
             self.notebook = nbformat.read(f, as_version=4)
 
-        self.client = NotebookClient(
+        self.checkpoint = NotebookCheckpointWriter(self.output_path, checkpoint_interval, checkpoint_every)
+        self.evaluation_sink = create_evaluation_sink(self.evaluate_path) if self.evaluate_path else None
+
+        self._output_records = {}
+        self.client = AgentNotebookClient(
             self.notebook,
+            on_display_metadata=self.on_display_metadata,
             timeout=timeout,
             startup_timeout=startup_timeout,
             skip_cells_with_tag=skip_cells_with_tag,
@@ -112,6 +369,29 @@ class NotebookRunner:
             **kwargs,
         )
 
+    def on_display_metadata(self, cell_index, output_meta):
+        if "jupyter-agent-output-id" in output_meta:
+            self.collect_output_records(cell_index, output_meta)
+
+    def collect_output_records(self, cell_index, output_meta, legacy_id=""):
+        output_id = output_meta.get("jupyter-agent-output-id", legacy_id)
+        cell_records = self._output_records.setdefault(cell_index, {})
+        for key in OUTPUT_RECORD_KEYS:
+            if key in output_meta:
+                records = cell_records.setdefault((key, output_id), {})
+                for seq, record in enumerate(output_meta[key], output_meta.get(key + "-start", 0)):
+                    records.setdefault(seq, record)
+
+    def get_output_records(self, cell_index, cell_output_metas, key):
+        """按输出及序号拼接单元格的增量记录，cell_output_metas中的最终快照或旧格式的完整记录用于补齐缺失的部分"""
+        for idx, output_meta in enumerate(cell_output_metas):
+            self.collect_output_records(cell_index, output_meta, legacy_id=f"output-{idx}")
+        records = []
+        for (record_key, _), output_records in self._output_records.get(cell_index, {}).items():
+            if record_key == key:
+                records.extend(output_records[seq] for seq in sorted(output_records))
+        return records
+
     def save_evaluation_record(self, record: BaseEvaluationRecord):
 
         if isinstance(record, FlowEvaluationRecord):
@@ -126,9 +406,10 @@ class NotebookRunner:
             f"duration: {record.execution_duration:.2f}s "
             f"correct: {record.correct_score:.2f}"
         )
-        if self.evaluate_path:
-            with open(self.evaluate_path, "a") as eval_file:
-                eval_file.write(record.model_dump_json() + "\n")
+        for k, v in (record.response_cache or {}).items():
+            self.response_cache_stats[k] = self.response_cache_stats.get(k, 0) + v
+        if self.evaluation_sink is not None:
+            self.evaluation_sink.write(record)
 
     def handle_cell_payloads(self, cell_index, cell_payloads):
         for payload in cell_payloads:
@@ -165,31 +446,30 @@ class NotebookRunner:
     def handle_evaluation_record(self, cell_index, cell_output_metas):
         is_bot_cell = False
         is_flow_completed = False
-        for output_meta in cell_output_metas:
-            for record in output_meta.get("jupyter-agent-evaluation-records", []):
-                is_bot_cell = True
-                if record["eval_type"] == "NOTEBOOK":
-                    record = NotebookEvaluationRecord(**record)
-                    record.timestamp = record.timestamp or time.time()
-                    record.notebook_name = str(self.output_path)
-                    record.execution_duration = time.time() - self.start_time
-                    self.is_global_finished = True
-                    is_flow_completed = True
-                    del self.notebook.cells[cell_index + 1 :]  # Remove all cells after the notebook cell
-                elif record["eval_type"] == "FLOW":
-                    record = FlowEvaluationRecord(**record)
-                    record.timestamp = record.timestamp or time.time()
-                    record.notebook_name = str(self.output_path)
-                    is_flow_completed = True
-                elif record["eval_type"] == "STAGE":
-                    record = StageEvaluationRecord(**record)
-                    record.timestamp = record.timestamp or time.time()
-                    record.notebook_name = str(self.output_path)
-                else:
-                    record = BaseEvaluationRecord(**record)
-                    record.timestamp = record.timestamp or time.time()
-                    record.notebook_name = str(self.output_path)
-                self.save_evaluation_record(record)
+        for record in self.get_output_records(cell_index, cell_output_metas, "jupyter-agent-evaluation-records"):
+            is_bot_cell = True
+            if record["eval_type"] == "NOTEBOOK":
+                record = NotebookEvaluationRecord(**record)
+                record.timestamp = record.timestamp or time.time()
+                record.notebook_name = str(self.output_path)
+                record.execution_duration = time.time() - self.start_time
+                self.is_global_finished = True
+                is_flow_completed = True
+                del self.notebook.cells[cell_index + 1 :]  # Remove all cells after the notebook cell
+            elif record["eval_type"] == "FLOW":
+                record = FlowEvaluationRecord(**record)
+                record.timestamp = record.timestamp or time.time()
+                record.notebook_name = str(self.output_path)
+                is_flow_completed = True
+            elif record["eval_type"] == "STAGE":
+                record = StageEvaluationRecord(**record)
+                record.timestamp = record.timestamp or time.time()
+                record.notebook_name = str(self.output_path)
+            else:
+                record = BaseEvaluationRecord(**record)
+                record.timestamp = record.timestamp or time.time()
+                record.notebook_name = str(self.output_path)
+            self.save_evaluation_record(record)
         if is_bot_cell and not is_flow_completed:
             self.save_evaluation_record(
                 FlowEvaluationRecord(
@@ -252,14 +532,13 @@ class NotebookRunner:
     def handle_jupyter_agent_actions(self, cell_index, cell_meta, cell_output_metas):
         cell_action_timestamp = cell_meta.get("jupyter-agent-action-timestamp", 0)
         output_action_timestamp = cell_action_timestamp
-        for output_meta in cell_output_metas:
-            for action in output_meta.get("jupyter-agent-action-records", []):
-                action = get_action_class(action["action"])(**action)
-                if action.timestamp > cell_action_timestamp:
-                    output_action_timestamp = max(action.timestamp, output_action_timestamp)
-                    if isinstance(action, ActionSetCellContent):
-                        print(f"CELL[{cell_index}] Action: {action.action} - {action.source} - {action.timestamp}")
-                        cell_index = self.handle_set_next_cell(cell_index, action)
+        for action in self.get_output_records(cell_index, cell_output_metas, "jupyter-agent-action-records"):
+            action = get_action_class(action["action"])(**action)
+            if action.timestamp > cell_action_timestamp:
+                output_action_timestamp = max(action.timestamp, output_action_timestamp)
+                if isinstance(action, ActionSetCellContent):
+                    print(f"CELL[{cell_index}] Action: {action.action} - {action.source} - {action.timestamp}")
+                    cell_index = self.handle_set_next_cell(cell_index, action)
         print(f"CELL[{cell_index}] Saving Action timestamp: {output_action_timestamp}")
         self.notebook.cells[cell_index].metadata["jupyter-agent-action-timestamp"] = output_action_timestamp
 
@@ -278,11 +557,12 @@ class NotebookRunner:
         self.handle_jupyter_agent_data(cell_index, cell_meta, cell_output_metas)
         self.handle_evaluation_record(cell_index, cell_output_metas)
         self.handle_jupyter_agent_actions(cell_index, cell_meta, cell_output_metas)
+        self._output_records.pop(cell_index, None)
         print(f"CELL[{cell_index}] Saving executed {cell_type} cell - {cell_id}")
         if cell_index > self.max_cells:
             print(f"CELL[{cell_index}] Reached max cells: {self.max_cells}, removing the rest...")
             del self.notebook.cells[cell_index + 1 :]
-        nbformat.write(self.notebook, self.output_path)
+        self.checkpoint.notify(self.notebook)
 
     def on_notebook_start(self, notebook):
         print("Notebook execution started.")
@@ -316,22 +596,157 @@ class NotebookRunner:
                     is_success=False,
                 )
             )
+        if self.response_cache_stats:
+            print("Response cache:", ", ".join(f"{k}={v}" for k, v in self.response_cache_stats.items()))
+        if self.evaluation_sink is not None:
+            self.evaluation_sink.flush()
         print(f"Saving executed notebook to: {self.output_path}")
-        nbformat.write(self.notebook, self.output_path)
+        self.checkpoint.flush(self.notebook)
 
     def run(self):
 
-        self.client.execute()
+        try:
+            self.client.execute()
+        finally:
+            self.checkpoint.close(self.notebook if self.checkpoint.dirty else None)
+            if self.evaluation_sink is not None:
+                self.evaluation_sink.close()
+
+
+def collect_notebooks(input_path: str) -> list[Path]:
+    """展开目录或通配符，返回待执行的Notebook列表"""
+    if Path(input_path).is_dir():
+        return sorted(Path(input_path).glob("*.ipynb"))
+    if glob.has_magic(input_path):
+        return sorted(Path(p) for p in glob.glob(input_path, recursive=True) if p.endswith(".ipynb"))
+    return [Path(input_path)]
+
+
+def run_notebook(runner_kwargs: dict) -> dict:
+    """在工作进程中执行单个Notebook，返回执行结果概要"""
+    start_time = time.time()
+    try:
+        NotebookRunner(**runner_kwargs).run()
+        error = ""
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    return {
+        "notebook": str(runner_kwargs["input_path"]),
+        "evaluate_path": str(runner_kwargs["evaluate_path"]),
+        "duration": time.time() - start_time,
+        "error": error,
+    }
+
+
+def summarize_records(result: dict, records: list[BaseEvaluationRecord]) -> dict:
+    flows = [r for r in records if r.eval_type == "FLOW"]
+    stages = [r for r in records if r.eval_type == "STAGE"]
+    scored = [r.correct_score for r in flows if r.correct_score]
+    return {
+        "notebook": Path(result["notebook"]).name,
+        "status": "ERROR" if result["error"] else "OK",
+        "flows": f"{sum(r.is_success for r in flows)}/{len(flows)}",
+        "stages": f"{sum(r.is_success for r in stages)}/{len(stages)}",
+        "finished": "Y" if any(r.eval_type == "NOTEBOOK" and r.is_success for r in records) else "N",
+        "correct": f"{sum(scored) / len(scored):.2f}" if scored else "-",
+        "duration": f"{result['duration']:.1f}s",
+    }
+
+
+def format_summary_table(rows: list[dict]) -> str:
+    if not rows:
+        return ""
+    columns = list(rows[0].keys())
+    widths = {c: max(len(c), *(len(str(row[c])) for row in rows)) for c in columns}
+    lines = ["  ".join(c.ljust(widths[c]) for c in columns), "  ".join("-" * widths[c] for c in columns)]
+    lines += ["  ".join(str(row[c]).ljust(widths[c]) for c in columns) for row in rows]
+    return "\n".join(line.rstrip() for line in lines)
+
+
+def run_batch(
+    notebooks: list[Path],
+    output_dir: str | Path = "",
+    evaluate_path: str | Path = "",
+    jobs: int = 4,
+    llm_concurrency: int = 0,
+    **runner_kwargs,
+) -> list[dict]:
+    """并行执行多个Notebook，每个工作进程使用独立的内核，所有内核共享LLM并发限制
+
+    各Notebook的评估记录合并写入evaluate_path，并打印汇总表。
+    """
+    from .bot_chat import ChatLimiterManager  # bot_chat -> bot_outputs -> bot_evaluation
+
+    suffix = str(int(time.time()))
+    output_dir = Path(output_dir or Path(notebooks[0]).parent.joinpath(f"bot_eval_{suffix}")).absolute()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    evaluate_path = Path(evaluate_path or output_dir.joinpath("evaluation.jsonl")).absolute()
+    limiter = ChatLimiterManager.serve(llm_concurrency) if llm_concurrency > 0 else None
+    tasks = []
+    for idx, notebook in enumerate(notebooks):
+        name = f"{idx:03d}_{Path(notebook).with_suffix('').name}"
+        tasks.append(
+            dict(
+                runner_kwargs,
+                input_path=notebook,
+                output_path=output_dir.joinpath(name + ".ipynb"),
+                evaluate_path=output_dir.joinpath(name + ".jsonl"),
+                reset_output=True,
+            )
+        )
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [executor.submit(run_notebook, task) for task in tasks]
+            for future in as_completed(futures):
+                result = future.result()
+                print(f"Finished {result['notebook']} in {result['duration']:.1f}s {result['error']}")
+                results.append(result)
+    finally:
+        if limiter is not None:
+            limiter.shutdown()
+    results.sort(key=lambda r: r["evaluate_path"])
+    rows = []
+    if evaluate_path.exists():
+        evaluate_path.unlink()
+    with create_evaluation_sink(evaluate_path, buffer_size=1024) as merged_sink:
+        for result in results:
+            records = []
+            if Path(result["evaluate_path"]).exists():
+                with open(result["evaluate_path"]) as eval_file:
+                    for line in eval_file:
+                        if line.strip():
+                            record = BaseEvaluationRecord.model_validate_json(line)
+                            merged_sink.write(record)
+                            records.append(record)
+            rows.append(summarize_records(result, records))
+    print(f"Merged evaluation records saved to: {evaluate_path}")
+    print(format_summary_table(rows))
+    return results
+
+
+def main(argv: Optional[list[str]] = None):
+    """Main function to run the notebook execution."""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "report":
+        from .bot_evaluation_report import report_main
 
+        return report_main(argv[1:])
+    if argv and argv[0] == "compare":
+        from .bot_evaluation_report import compare_main
 
-def main():
-    """Main function to run the notebook execution."""
+        return compare_main(argv[1:])
     parser = argparse.ArgumentParser(description="Run a Jupyter notebook.")
     parser.add_argument(
         "-o", "--output_path", type=str, default="", help="Path to save the executed notebook (default: same as input)"
     )
     parser.add_argument(
-        "-e", "--evaluate_path", type=str, default="", help="Path to save evaluate records (default: same as input)"
+        "-e",
+        "--evaluate_path",
+        type=str,
+        default="",
+        help="Path to save evaluate records, .jsonl, .jsonl.gz or .npz (default: same as input)",
     )
     parser.add_argument(
         "-R", "--reset_output", action="store_true", help="Reset output notebook before execution (default: False)"
@@ -357,8 +772,64 @@ def main():
         default="skip-execution",
         help="Tag to skip cells with (default: 'skip-execution')",
     )
-    parser.add_argument("input_path", type=str, help="Path to the input notebook file")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--response_cache",
+        type=str,
+        default="",
+        choices=["", "off", "readwrite", "replay", "record"],
+        help="Chat response cache mode for the executed notebook (default: use BotMagics config)",
+    )
+    parser.add_argument(
+        "--response_cache_dir", type=str, default="", help="Directory for cached chat responses (default: none)"
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=float,
+        default=2.0,
+        help="Min seconds between output notebook checkpoints (default: 2.0)",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=0,
+        help="Write an output notebook checkpoint every N executed cells (default: 0, by interval only)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=4, help="Parallel workers when running multiple notebooks (default: 4)"
+    )
+    parser.add_argument(
+        "--llm_concurrency",
+        type=int,
+        default=0,
+        help="Max concurrent LLM requests shared by all kernels in batch mode (default: 0, unlimited)",
+    )
+    parser.add_argument(
+        "input_path", type=str, help="Path to the input notebook file, or a directory / glob of notebooks"
+    )
+    args = parser.parse_args(argv)
+
+    notebooks = collect_notebooks(args.input_path)
+    if len(notebooks) > 1 or Path(args.input_path).is_dir() or glob.has_magic(args.input_path):
+        if not notebooks:
+            parser.error(f"No notebooks found in {args.input_path}")
+        run_batch(
+            notebooks,
+            output_dir=args.output_path,
+            evaluate_path=args.evaluate_path,
+            jobs=args.jobs,
+            llm_concurrency=args.llm_concurrency,
+            max_cells=args.max_cells,
+            timeout=args.timeout,
+            startup_timeout=args.startup_timeout,
+            allow_errors=args.allow_errors,
+            kernel_name=args.kernel_name,
+            skip_cells_with_tag=args.skip_cells_with_tag,
+            response_cache_mode=args.response_cache,
+            response_cache_dir=args.response_cache_dir,
+            checkpoint_interval=args.checkpoint_interval,
+            checkpoint_every=args.checkpoint_every,
+        )
+        return
 
     NotebookRunner(
         input_path=args.input_path,
@@ -371,8 +842,12 @@ def main():
         allow_errors=args.allow_errors,
         kernel_name=args.kernel_name,
         skip_cells_with_tag=args.skip_cells_with_tag,
+        response_cache_mode=args.response_cache,
+        response_cache_dir=args.response_cache_dir,
+        checkpoint_interval=args.checkpoint_interval,
+        checkpoint_every=args.checkpoint_every,
     ).run()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
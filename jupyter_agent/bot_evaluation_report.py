@@ -0,0 +1,538 @@
+"""
+Copyright (c) 2025 viewstar000
+
+This software is released under the MIT License.
+https://opensource.org/licenses/MIT
+"""
+
+import re
+import gzip
+import json
+import math
+import argparse
+import itertools
+import operator
+
+from pathlib import Path
+from typing import Iterator, Optional
+from .bot_evaluation import BaseEvaluationRecord, format_summary_table
+from .utils import fast_json
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+SCORE_FIELDS = [
+    "correct_score",
+    "planning_score",
+    "reasoning_score",
+    "coding_score",
+    "important_score",
+    "user_supply_score",
+]
+GROUP_FIELDS = ["eval_type", "flow", "stage", "agent", "evaluator"]
+REPORT_FIELDS = GROUP_FIELDS + ["execution_duration", "stage_count", "is_success", "is_stopped"] + SCORE_FIELDS
+PERCENTILES = [50, 90, 99]
+ALIGN_FIELDS = ["eval_type", "notebook_name", "cell_index", "flow", "stage", "agent", "evaluator"]
+# 对比的指标及其变差方向：1表示数值越大越差，-1表示数值越小越差
+COMPARE_METRICS = {"execution_duration": 1, "stage_count": 1, **{name: -1 for name in SCORE_FIELDS}}
+COMPARE_FIELDS = ALIGN_FIELDS + list(COMPARE_METRICS)
+
+
+def _field_dtype(name):
+    annotation = BaseEvaluationRecord.model_fields[name].annotation
+    return {int: np.int64, float: np.float64, bool: np.bool_}.get(annotation, object)
+
+
+def _records_to_columns(records: list[dict], fields: list[str]) -> dict:
+    defaults = [BaseEvaluationRecord.model_fields[name].default for name in fields]
+    getter = operator.itemgetter(*fields)
+    try:
+        rows = [getter(r) for r in records]
+    except KeyError:  # 旧版本写入的记录可能缺少部分字段
+        rows = [tuple(r.get(name, default) for name, default in zip(fields, defaults)) for r in records]
+    if len(fields) == 1:
+        rows = [(row,) for row in rows]
+    columns = {}
+    for name, values in zip(fields, zip(*rows) if rows else [()] * len(fields)):
+        dtype = _field_dtype(name)
+        if dtype is object:
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+        else:
+            column = np.asarray(values, dtype=dtype)
+        columns[name] = column
+    return columns
+
+
+def iter_record_chunks(
+    paths: list[str | Path], fields: Optional[list[str]] = None, chunk_size: int = 100000
+) -> Iterator[dict]:
+    """分块读取评估记录文件（.jsonl、.jsonl.gz或.npz），每块以字段名到NumPy数组的字典返回
+
+    每次最多只有chunk_size条记录驻留内存。
+    """
+    if np is None:
+        raise ImportError("numpy is required for evaluation reports")
+    fields = fields or REPORT_FIELDS
+    for path in paths:
+        path = Path(path)
+        if path.suffix.lower() == ".npz":
+            with np.load(path) as data:
+                total = len(data[fields[0]]) if fields[0] in data else 0
+                loaded = {}
+                for name in fields:
+                    if name in data:
+                        loaded[name] = data[name]
+                    else:
+                        default = BaseEvaluationRecord.model_fields[name].default
+                        loaded[name] = np.full(total, default, dtype=_field_dtype(name))
+                for start in range(0, total, chunk_size):
+                    yield {
+                        name: (
+                            values[start : start + chunk_size].astype(object)
+                            if _field_dtype(name) is object
+                            else values[start : start + chunk_size]
+                        )
+                        for name, values in loaded.items()
+                    }
+            continue
+        opener = gzip.open if path.suffix.lower() == ".gz" else open
+        with opener(path, "rb") as f:
+            while True:
+                lines = [line for line in (line.strip() for line in itertools.islice(f, chunk_size)) if line]
+                if not lines:
+                    break
+                yield _records_to_columns(fast_json.loads(b"[" + b",".join(lines) + b"]"), fields)
+
+
+def bootstrap_mean_ci(
+    values,
+    n_resamples: int = 1000,
+    confidence: float = 0.95,
+    rng=None,
+    total: int = 0,
+    max_resample_size: int = 2000,
+):
+    """均值的bootstrap置信区间
+
+    values可以是总体中total条记录的随机样本；样本多于max_resample_size条时每次只重采样max_resample_size条，
+    再按sqrt(m/n)把重采样均值的离差缩放回总体规模（m-out-of-n bootstrap），使耗时与记录数无关。
+    values为二维数组时各列共用同一组重采样下标，返回每列的(low, high)列表。
+    """
+    values = np.asarray(values, dtype=np.float64)
+    columns = values.reshape(len(values), -1).T
+    total = max(total, len(values))
+    if len(values) == 0:
+        bounds = [(float("nan"), float("nan"))] * len(columns)
+    elif len(values) == 1 or n_resamples <= 0:
+        bounds = [(float(column.mean()),) * 2 for column in columns]
+    else:
+        rng = rng if rng is not None else np.random.default_rng()
+        size = min(len(values), max_resample_size)
+        indices = rng.integers(0, len(values), size=(n_resamples, size))
+        alpha = (1 - confidence) / 2
+        bounds = []
+        for column in columns:
+            mean = float(column.mean())
+            means = mean + (column[indices].mean(axis=1) - mean) * np.sqrt(size / total)
+            low, high = np.quantile(means, [alpha, 1 - alpha])
+            bounds.append((float(low), float(high)))
+    return bounds[0] if values.ndim == 1 else bounds
+
+
+class GroupStats:
+    """单个分组的统计量：计数与求和精确累加，耗时与评分保留至多max_samples条的蓄水池样本用于分位数及bootstrap"""
+
+    def __init__(self, key: tuple, max_samples: int, rng):
+        self.key = key
+        self.max_samples = max_samples
+        self.rng = rng
+        self.count = 0
+        self.success = 0
+        self.stopped = 0
+        self.scored = 0
+        self.score_sums = np.zeros(len(SCORE_FIELDS))
+        self.stage_counts = np.zeros(0, dtype=np.int64)
+        self.samples = np.empty((0, 1 + len(SCORE_FIELDS)))
+        self.seen = 0
+
+    def add(self, durations, stage_counts, success, stopped, scores):
+        self.count += len(durations)
+        self.success += int(success.sum())
+        self.stopped += int(stopped.sum())
+        self.scored += int(np.any(scores != 0, axis=1).sum())
+        self.score_sums += scores.sum(axis=0)
+        counts = np.bincount(np.maximum(stage_counts, 0))
+        if len(counts) > len(self.stage_counts):
+            self.stage_counts = np.pad(self.stage_counts, (0, len(counts) - len(self.stage_counts)))
+        self.stage_counts[: len(counts)] += counts
+        self.sample(np.column_stack([durations, scores]))
+
+    def sample(self, values):
+        room = max(self.max_samples - len(self.samples), 0)
+        if room:
+            self.samples = np.concatenate([self.samples, values[:room]])
+            self.seen += len(values[:room])
+            values = values[room:]
+        if len(values):
+            positions = self.seen + np.arange(1, len(values) + 1)
+            slots = (self.rng.random(len(values)) * positions).astype(np.int64)
+            accepted = slots < self.max_samples
+            self.samples[slots[accepted]] = values[accepted]
+            self.seen += len(values)
+
+    def summary(self, n_resamples: int = 1000, confidence: float = 0.95) -> dict:
+        durations = self.samples[:, 0]
+        result = dict(zip(GROUP_FIELDS, self.key))
+        result.update(
+            count=self.count,
+            success_rate=self.success / self.count if self.count else 0.0,
+            stopped_rate=self.stopped / self.count if self.count else 0.0,
+            latency={f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(durations, PERCENTILES))},
+            scored=self.scored,
+            scores={},
+            stage_counts={idx: int(n) for idx, n in enumerate(self.stage_counts) if n},
+        )
+        if self.scored:
+            bounds = bootstrap_mean_ci(self.samples[:, 1:], n_resamples, confidence, self.rng, total=self.count)
+            for idx, (name, (low, high)) in enumerate(zip(SCORE_FIELDS, bounds)):
+                result["scores"][name] = {"mean": float(self.score_sums[idx] / self.count), "ci": [low, high]}
+        return result
+
+
+class EvaluationReport:
+    """按eval_type/flow/stage/agent/evaluator分组累加评估记录块
+
+    FLOW及NOTEBOOK记录的stage为结束时的阶段，agent为空，分组时均忽略这两个字段。
+    """
+
+    def __init__(self, max_samples: int = 100000, seed: Optional[int] = None):
+        if np is None:
+            raise ImportError("numpy is required for evaluation reports")
+        self.max_samples = max_samples
+        self.rng = np.random.default_rng(seed)
+        self.groups: dict[tuple, GroupStats] = {}
+
+    def add_chunk(self, columns: dict):
+        if not len(columns["eval_type"]):
+            return
+        is_stage = columns["eval_type"] == "STAGE"
+        stage = np.where(is_stage, columns["stage"], "")
+        agent = np.where(is_stage, columns["agent"], "")
+        keys = columns["eval_type"] + "\x1f" + columns["flow"] + "\x1f" + stage + "\x1f" + agent
+        keys = keys + "\x1f" + columns["evaluator"]
+        unique_keys, inverse = np.unique(keys.astype(str), return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(unique_keys)))[:-1]
+        scores = np.column_stack([columns[name] for name in SCORE_FIELDS]).astype(np.float64)
+        for key, idx in zip(unique_keys, np.split(order, bounds)):
+            key = tuple(key.split("\x1f"))
+            if key not in self.groups:
+                self.groups[key] = GroupStats(key, self.max_samples, self.rng)
+            self.groups[key].add(
+                columns["execution_duration"][idx].astype(np.float64),
+                columns["stage_count"][idx].astype(np.int64),
+                columns["is_success"][idx],
+                columns["is_stopped"][idx],
+                scores[idx],
+            )
+
+    def add_files(self, paths: list[str | Path], chunk_size: int = 100000):
+        for columns in iter_record_chunks(paths, REPORT_FIELDS, chunk_size):
+            self.add_chunk(columns)
+        return self
+
+    def summary(self, n_resamples: int = 1000, confidence: float = 0.95) -> list[dict]:
+        type_order = {"NOTEBOOK": 0, "FLOW": 1, "STAGE": 2}
+        keys = sorted(self.groups, key=lambda k: (type_order.get(k[0], 3),) + k)
+        return [self.groups[key].summary(n_resamples, confidence) for key in keys]
+
+
+def format_report_rows(summary: list[dict]) -> list[dict]:
+    rows = []
+    for item in summary:
+        correct = item["scores"].get("correct_score")
+        rows.append(
+            {
+                "type": item["eval_type"],
+                "flow": item["flow"],
+                "stage": item["stage"],
+                "agent": item["agent"],
+                "evaluator": item["evaluator"],
+                "count": item["count"],
+                "success": f"{item['success_rate']:.1%}",
+                "p50": f"{item['latency']['p50']:.2f}s",
+                "p90": f"{item['latency']['p90']:.2f}s",
+                "p99": f"{item['latency']['p99']:.2f}s",
+                "correct": (
+                    f"{correct['mean']:.2f} [{correct['ci'][0]:.2f}, {correct['ci'][1]:.2f}]" if correct else "-"
+                ),
+                "stage_counts": (
+                    " ".join(f"{k}:{v}" for k, v in item["stage_counts"].items()) if item["eval_type"] == "FLOW" else ""
+                ),
+            }
+        )
+    return rows
+
+
+def report_main(argv: Optional[list[str]] = None):
+    """bot_eval report: 汇总一个或多个评估记录文件"""
+    parser = argparse.ArgumentParser(prog="bot_eval report", description="Summarize evaluation records.")
+    parser.add_argument(
+        "--chunk_size", type=int, default=100000, help="Records loaded per chunk (default: 100000)"
+    )
+    parser.add_argument(
+        "--max_samples",
+        type=int,
+        default=100000,
+        help="Max samples kept per group for percentiles and bootstrap (default: 100000)",
+    )
+    parser.add_argument(
+        "--bootstrap", type=int, default=1000, help="Bootstrap resamples for score CIs (default: 1000)"
+    )
+    parser.add_argument(
+        "--confidence", type=float, default=0.95, help="Confidence level of score CIs (default: 0.95)"
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for sampling and bootstrap")
+    parser.add_argument("--json", type=str, default="", help="Save the full report as JSON to this path")
+    parser.add_argument("paths", nargs="+", help="Evaluation record files, .jsonl, .jsonl.gz or .npz")
+    args = parser.parse_args(argv)
+
+    report = EvaluationReport(max_samples=args.max_samples, seed=args.seed)
+    report.add_files(args.paths, chunk_size=args.chunk_size)
+    summary = report.summary(n_resamples=args.bootstrap, confidence=args.confidence)
+    print(format_summary_table(format_report_rows(summary)))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        print(f"Report saved to: {args.json}")
+    return 0
+
+
+def load_columns(paths: list[str | Path], fields: list[str], chunk_size: int = 100000) -> dict:
+    chunks = list(iter_record_chunks(paths, fields, chunk_size))
+    if not chunks:
+        return {name: np.empty(0, dtype=_field_dtype(name)) for name in fields}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in fields}
+
+
+def normalize_notebook_name(name: str) -> str:
+    """去掉输出Notebook路径中的目录及bot_eval追加的时间戳后缀，使两次运行的同一Notebook可以对齐"""
+    return re.sub(r"(_\d{9,})?(\.ipynb)?$", "", Path(name).name)
+
+
+def _record_keys(columns: dict):
+    names, inverse = np.unique(columns["notebook_name"].astype(str), return_inverse=True)
+    notebook = np.array([normalize_notebook_name(name) for name in names], dtype=object)[inverse.reshape(-1)]
+    is_stage = columns["eval_type"] == "STAGE"
+    keys = columns["eval_type"] + "\x1f" + notebook + "\x1f" + columns["cell_index"].astype(str).astype(object)
+    keys = keys + "\x1f" + columns["flow"] + "\x1f" + np.where(is_stage, columns["stage"], "")
+    return (keys + "\x1f" + np.where(is_stage, columns["agent"], "") + "\x1f" + columns["evaluator"]).astype(str)
+
+
+def alignment_keys(*runs: dict) -> list:
+    """按notebook/cell/flow/stage/agent/evaluator为每次运行的记录生成整数对齐键
+
+    同一个键因重试出现多次时按出现顺序编号，各次运行的第n次出现互相对齐。
+    """
+    keys = [_record_keys(columns) for columns in runs]
+    _, codes = np.unique(np.concatenate(keys), return_inverse=True)
+    codes = codes.reshape(-1).astype(np.int64)
+    n_codes = int(codes.max()) + 1 if len(codes) else 1
+    result, start = [], 0
+    for run_keys in keys:
+        run_codes = codes[start : start + len(run_keys)]
+        start += len(run_keys)
+        order = np.argsort(run_codes, kind="stable")
+        sorted_codes = run_codes[order]
+        first = np.ones(len(run_codes), dtype=bool)
+        first[1:] = sorted_codes[1:] != sorted_codes[:-1]
+        group_start = np.maximum.accumulate(np.where(first, np.arange(len(run_codes)), 0))
+        occurrence = np.empty(len(run_codes), dtype=np.int64)
+        occurrence[order] = np.arange(len(run_codes)) - group_start
+        result.append(occurrence * n_codes + run_codes)
+    return result
+
+
+def paired_permutation_test(deltas, n_permutations: int = 1000, rng=None, max_resample_size: int = 10000) -> float:
+    """配对差值的符号翻转置换检验，返回均值差为0的双侧p值；配对数多于max_resample_size时使用正态近似"""
+    deltas = np.asarray(deltas, dtype=np.float64)
+    if len(deltas) == 0 or not np.any(deltas):
+        return 1.0
+    observed = abs(deltas.mean())
+    if len(deltas) > max_resample_size or n_permutations <= 0:
+        return float(math.erfc(observed / (np.sqrt(np.sum(deltas**2)) / len(deltas)) / math.sqrt(2)))
+    rng = rng if rng is not None else np.random.default_rng()
+    signs = rng.choice([-1.0, 1.0], size=(n_permutations, len(deltas)))
+    means = np.abs(signs @ deltas) / len(deltas)
+    return float((np.sum(means >= observed * (1 - 1e-12)) + 1) / (n_permutations + 1))
+
+
+def adjust_p_values(p_values, method: str = "holm") -> list[float]:
+    """多重比较校正：holm控制族错误率，bh（Benjamini-Hochberg）控制错误发现率，none不校正"""
+    p_values = np.asarray(p_values, dtype=np.float64)
+    n = len(p_values)
+    if n == 0 or method == "none":
+        return p_values.tolist()
+    order = np.argsort(p_values, kind="stable")
+    if method == "holm":
+        adjusted = np.maximum.accumulate(p_values[order] * (n - np.arange(n)))
+    elif method == "bh":
+        adjusted = np.minimum.accumulate((p_values[order] * n / np.arange(1, n + 1))[::-1])[::-1]
+    else:
+        raise ValueError(f"Unknown p-value correction: {method}")
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1.0)
+    return result.tolist()
+
+
+def compare_runs(
+    columns_a: dict,
+    columns_b: dict,
+    n_resamples: int = 1000,
+    n_permutations: int = 1000,
+    confidence: float = 0.95,
+    alpha: float = 0.05,
+    min_effect: float = 0.0,
+    seed: Optional[int] = None,
+    correction: str = "holm",
+) -> tuple[list[dict], dict]:
+    """对齐两次运行的评估记录，按eval_type/flow/stage分组逐项对比COMPARE_METRICS
+
+    只比较两侧至少有一侧不为0的配对（未评分的记录各项评分均为0）。差值为B-A，所有对比项的p值按correction
+    做多重比较校正，校正后p值低于alpha、相对变化不小于min_effect且方向变差的指标标记为regression。
+    A侧均值为0时相对变化为None。
+    """
+    if np is None:
+        raise ImportError("numpy is required for evaluation comparison")
+    rng = np.random.default_rng(seed)
+    keys_a, keys_b = alignment_keys(columns_a, columns_b)
+    _, idx_a, idx_b = np.intersect1d(keys_a, keys_b, assume_unique=True, return_indices=True)
+    stats = {"matched": len(idx_a), "only_a": len(keys_a) - len(idx_a), "only_b": len(keys_b) - len(idx_b)}
+    is_stage = columns_a["eval_type"][idx_a] == "STAGE"
+    stage = np.where(is_stage, columns_a["stage"][idx_a], "")
+    group_keys = (columns_a["eval_type"][idx_a] + "\x1f" + columns_a["flow"][idx_a] + "\x1f" + stage).astype(str)
+    unique_keys, inverse = np.unique(group_keys, return_inverse=True)
+    type_order = {"NOTEBOOK": 0, "FLOW": 1, "STAGE": 2}
+    rows = []
+    for group, key in sorted(enumerate(unique_keys), key=lambda x: (type_order.get(x[1].split("\x1f")[0], 3), x[1])):
+        in_group = inverse.reshape(-1) == group
+        for metric in COMPARE_METRICS:
+            values_a = columns_a[metric][idx_a][in_group].astype(np.float64)
+            values_b = columns_b[metric][idx_b][in_group].astype(np.float64)
+            used = (values_a != 0) | (values_b != 0)
+            if not np.any(used):
+                continue
+            values_a, values_b = values_a[used], values_b[used]
+            deltas = values_b - values_a
+            delta = float(deltas.mean())
+            low, high = bootstrap_mean_ci(deltas, n_resamples, confidence, rng)
+            p_value = paired_permutation_test(deltas, n_permutations, rng)
+            mean_a = float(values_a.mean())
+            relative = delta / abs(mean_a) if mean_a else (None if delta else 0.0)
+            rows.append(
+                dict(
+                    zip(["eval_type", "flow", "stage"], key.split("\x1f")),
+                    metric=metric,
+                    pairs=int(used.sum()),
+                    mean_a=mean_a,
+                    mean_b=float(values_b.mean()),
+                    delta=delta,
+                    relative=relative,
+                    ci=[low, high],
+                    p_value=p_value,
+                    p_adjusted=p_value,
+                    status="",
+                )
+            )
+    for row, p_adjusted in zip(rows, adjust_p_values([row["p_value"] for row in rows], correction)):
+        row["p_adjusted"] = p_adjusted
+        effect = math.inf if row["relative"] is None else abs(row["relative"])
+        if p_adjusted < alpha and effect >= min_effect and row["delta"]:
+            worse = row["delta"] * COMPARE_METRICS[row["metric"]] > 0
+            row["status"] = "regression" if worse else "improved"
+    return rows, stats
+
+
+def format_compare_rows(rows: list[dict]) -> list[dict]:
+    return [
+        {
+            "type": row["eval_type"],
+            "flow": row["flow"],
+            "stage": row["stage"],
+            "metric": row["metric"],
+            "pairs": row["pairs"],
+            "A": f"{row['mean_a']:.3f}",
+            "B": f"{row['mean_b']:.3f}",
+            "delta": f"{row['delta']:+.3f} ("
+            + ("n/a" if row["relative"] is None else f"{row['relative']:+.1%}")
+            + ")",
+            "ci": f"[{row['ci'][0]:+.3f}, {row['ci'][1]:+.3f}]",
+            "p": f"{row['p_adjusted']:.4f}",
+            "status": row["status"].upper(),
+        }
+        for row in rows
+    ]
+
+
+def compare_main(argv: Optional[list[str]] = None):
+    """bot_eval compare: 对比两次运行的评估记录，存在显著退化时返回1"""
+    parser = argparse.ArgumentParser(prog="bot_eval compare", description="Compare two evaluation runs.")
+    parser.add_argument(
+        "--alpha", type=float, default=0.05, help="Significance level of the permutation test (default: 0.05)"
+    )
+    parser.add_argument(
+        "--correction",
+        choices=["holm", "bh", "none"],
+        default="holm",
+        help="Multiple-comparison correction of p-values across metrics: holm, bh or none (default: holm)",
+    )
+    parser.add_argument(
+        "--min_effect",
+        type=float,
+        default=0.0,
+        help="Min relative change of a significant delta to be flagged (default: 0.0)",
+    )
+    parser.add_argument(
+        "--bootstrap", type=int, default=1000, help="Bootstrap resamples for delta CIs (default: 1000)"
+    )
+    parser.add_argument(
+        "--permutations", type=int, default=1000, help="Sign-flip permutations per test (default: 1000)"
+    )
+    parser.add_argument(
+        "--confidence", type=float, default=0.95, help="Confidence level of delta CIs (default: 0.95)"
+    )
+    parser.add_argument(
+        "--chunk_size", type=int, default=100000, help="Records loaded per chunk (default: 100000)"
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for bootstrap and permutations")
+    parser.add_argument("--json", type=str, default="", help="Save the full comparison as JSON to this path")
+    parser.add_argument("path_a", help="Baseline evaluation records, .jsonl, .jsonl.gz or .npz")
+    parser.add_argument("path_b", help="Candidate evaluation records, .jsonl, .jsonl.gz or .npz")
+    args = parser.parse_args(argv)
+
+    rows, stats = compare_runs(
+        load_columns([args.path_a], COMPARE_FIELDS, args.chunk_size),
+        load_columns([args.path_b], COMPARE_FIELDS, args.chunk_size),
+        n_resamples=args.bootstrap,
+        n_permutations=args.permutations,
+        confidence=args.confidence,
+        alpha=args.alpha,
+        min_effect=args.min_effect,
+        seed=args.seed,
+        correction=args.correction,
+    )
+    print(f"Matched {stats['matched']} records, {stats['only_a']} only in A, {stats['only_b']} only in B")
+    print(format_summary_table(format_compare_rows(rows)))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"stats": stats, "metrics": rows}, f, indent=2, ensure_ascii=False)
+        print(f"Comparison saved to: {args.json}")
+    regressions = [row for row in rows if row["status"] == "regression"]
+    if regressions:
+        print(f"Found {len(regressions)} significant regressions")
+        return 1
+    return 0
@@ -8,9 +8,10 @@ https://opensource.org/licenses/MIT
 import time
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor, Future
 from pydantic import BaseModel
 from enum import Enum
-from typing import List, Dict, Optional, Type
+from typing import List, Dict, Optional, Type, Tuple, Any
 from IPython.display import Markdown
 from ..bot_agents.base import BaseAgent
 from ..bot_evaluators.base import BaseEvaluator
@@ -18,6 +19,7 @@ from ..bot_evaluators.dummy_global import DummyGlobalEvaluator
 from ..bot_evaluators.flow_task_executor import FlowTaskExecEvaluator
 from ..bot_outputs import _D, _I, _W, _E, _F, _M, _B
 from ..bot_outputs import set_stage, flush_output, output_evaluation
+from ..bot_chat import get_response_cache
 from ..bot_evaluation import FlowEvaluationRecord, StageEvaluationRecord, NotebookEvaluationRecord
 
 TASK_AGENT_STATE_ERROR = "_AGENT_STATE_ERROR_32534526_"
@@ -46,6 +48,9 @@ class StageNode[ST, AS](BaseModel):
     evaluators: Optional[Type[BaseEvaluator] | List[Type[BaseEvaluator]]] = None
     states: Dict[AS | str, StageNext[ST] | List[StageNext[ST]] | Dict[TaskAction, StageNext[ST]] | ST | str] = {}
     next_stage: Optional[StageNext[ST] | List[StageNext[ST]] | Dict[TaskAction, StageNext[ST]] | ST | str] = None
+    # 为True时，同一阶段的多个Agent并发执行，depends中声明的Agent需等待其依赖的Agent执行完成后才开始执行
+    concurrent: bool = False
+    depends: Dict[Type[BaseAgent], List[Type[BaseAgent]]] = {}
 
 
 class BaseTaskFlow:
@@ -58,12 +63,25 @@ class BaseTaskFlow:
     STOP_STAGES = [TASK_STAGE_COMPLETED, TASK_STAGE_GLOBAL_FINISHED]
     FLOW_EVALUATOR = FlowTaskExecEvaluator
     GLOBAL_EVALUATOR = DummyGlobalEvaluator
+    MAX_WORKERS = 4
 
-    def __init__(self, notebook_context, agent_factory, evaluator_factory=None):
+    def __init__(
+        self,
+        notebook_context,
+        agent_factory,
+        evaluator_factory=None,
+        concurrent_evaluating=False,
+        defer_evaluating=False,
+    ):
         self.notebook_context = notebook_context
         self.agent_factory = agent_factory
         self.evaluator_factory = evaluator_factory
+        self.concurrent_evaluating = concurrent_evaluating
+        self.defer_evaluating = defer_evaluating
         self.stage_nodes = {}
+        self._executor = None
+        self._pending_evaluations: List[Tuple[Future, Any, BaseEvaluator, Dict]] = []
+        self._response_cache_stats: Dict[str, int] = {}
         self.prepare_stage_nodes()
 
     @property
@@ -105,6 +123,106 @@ class BaseTaskFlow:
                 state_ns[TaskAction.SKIP] = state_ns.get(TaskAction.SKIP) or state_ns.get(TaskAction.CONTINUE)
             if TASK_AGENT_STATE_ERROR not in st.states:
                 st.states[TASK_AGENT_STATE_ERROR] = {"*": StageNext(stage=st.stage)}
+            if st.depends:
+                agent_classes = st.agents if isinstance(st.agents, list) else [st.agents]
+                for agent_class, deps in st.depends.items():
+                    assert agent_class in agent_classes, f"Unknown agent `{agent_class}` in depends of `{st.stage}`"
+                    for dep in deps:
+                        assert agent_classes.index(dep) < agent_classes.index(agent_class), (
+                            f"Agent `{agent_class.__name__}` must be declared after its dependency "
+                            f"`{dep.__name__}` in stage `{st.stage}`"
+                        )
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="bot_flow")
+        return self._executor
+
+    def run_stage_agents(self, stage, agents):
+        """并发执行同一阶段的多个Agent，返回最后一个Agent的执行结果"""
+        st = self.stage_nodes[stage]
+        agent_classes = st.agents if isinstance(st.agents, list) else [st.agents]
+        futures: List[Future] = []
+
+        def _run(agent, deps):
+            for dep in deps:
+                futures[agent_classes.index(dep)].result()
+            _I(f"Executing stage `{stage}` with agent `{type(agent).__name__}` ...")
+            return agent()
+
+        with ThreadPoolExecutor(max_workers=len(agents), thread_name_prefix="bot_stage") as executor:
+            for agent_class, agent in zip(agent_classes, agents):
+                futures.append(executor.submit(_run, agent, st.depends.get(agent_class, [])))
+            results = [future.result() for future in futures]
+        return results[-1]
+
+    def is_concurrent_stage(self, stage, agents):
+        st = self.stage_nodes.get(stage)
+        return st is not None and st.concurrent and len(agents) > 1
+
+    def _complete_evaluation(self, evaluator, evaluation_result, record_fields):
+        evaluation_result.timestamp = evaluation_result.timestamp or time.time()
+        evaluation_result.evaluator = evaluation_result.evaluator or type(evaluator).__name__
+        for k, v in record_fields.items():
+            setattr(evaluation_result, k, v)
+        output_evaluation(evaluation_result)
+
+    def _handle_evaluation_error(self, stage, e):
+        _W(f"Error during task evaluation stage `{stage}`: `{type(e)}`: `{e}`")
+        _M(f"**Error** during task evaluation stage `{stage}`: `{type(e)}`: `{e}`")
+        _M(f"```python\n{traceback.format_exc()}\n```")
+
+    def run_stage_evaluators(self, stage, evaluators, record_fields):
+        """执行阶段评估器，可并发执行或延迟到后台执行，评估完成后输出评估记录"""
+        if not self.concurrent_evaluating and not self.defer_evaluating:
+            for evaluator in evaluators:
+                try:
+                    _I(f"Evaluating stage `{stage}` with evaluator `{type(evaluator).__name__}` ...")
+                    self._complete_evaluation(evaluator, evaluator(), record_fields)
+                except Exception as e:
+                    self._handle_evaluation_error(stage, e)
+            return
+        futures = []
+        for evaluator in evaluators:
+            try:
+                _I(f"Evaluating stage `{stage}` with evaluator `{type(evaluator).__name__}` in background ...")
+                if isinstance(evaluator, BaseEvaluator) and type(evaluator).__call__ is BaseEvaluator.__call__:
+                    # 提前渲染提示词，避免后续阶段修改任务状态后影响评估结果
+                    evaluator.prepare_messages()
+                futures.append((self.executor.submit(evaluator), stage, evaluator, record_fields))
+            except Exception as e:
+                self._handle_evaluation_error(stage, e)
+        self._pending_evaluations.extend(futures)
+        self.publish_evaluations(wait=not self.defer_evaluating)
+
+    def publish_evaluations(self, wait=False):
+        """输出已完成的后台评估记录，wait为True时等待所有评估完成"""
+        pending = []
+        for future, stage, evaluator, record_fields in self._pending_evaluations:
+            if not wait and not future.done():
+                pending.append((future, stage, evaluator, record_fields))
+                continue
+            try:
+                self._complete_evaluation(evaluator, future.result(), record_fields)
+            except Exception as e:
+                self._handle_evaluation_error(stage, e)
+        self._pending_evaluations = pending
+
+    def shutdown(self):
+        """等待所有后台评估完成并释放线程池"""
+        self.publish_evaluations(wait=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def output_flow_evaluation(self, record):
+        """输出流程级评估记录，启用回复缓存时附带本次流程的缓存统计"""
+        if get_response_cache().enabled:
+            record.response_cache = {
+                k: v - self._response_cache_stats.get(k, 0) for k, v in get_response_cache().stats().items()
+            }
+        output_evaluation(record)
 
     def get_stage_agents(self, stage) -> List[BaseAgent]:
         for t in self.STAGE_NODES:
@@ -182,102 +300,114 @@ class BaseTaskFlow:
         start_stage_name = start_stage.value if isinstance(start_stage, Enum) else start_stage
         stage = start_stage or self.START_STAGE
         agent = None
-        while n_tries <= max_tries:
-            stage_st = time.time()
-            try:
-                stage_name = stage.value if isinstance(stage, Enum) else stage
-                stage_name = stage_name.replace(".", "-").capitalize()
-                set_stage(stage_name)
-                agents = self.get_stage_agents(stage)
-                for agent in agents:
-                    _I(f"Executing stage `{stage}` with agent `{type(agent).__name__}` ...")
-                    failed, state = agent()
-            except Exception as e:
-                _W(f"Error during task execution stage `{stage}`: `{type(e)}`: `{e}`")
-                _M(f"**Error** during task execution stage `{stage}`: `{type(e)}`: `{e}`")
-                _M(f"```python\n{traceback.format_exc()}\n```")
-                state = TASK_AGENT_STATE_ERROR
-                failed = True
-            stage_count += 1
-            stage_duration = time.time() - stage_st
-            flow_duration += stage_duration
-            _I(f"Stage `{stage}` completed in {stage_duration:.2f} seconds with state `{state}` and failed `{failed}`")
-            if start_stage_name != TASK_STAGE_COMPLETED:
-                if evaluators := self.get_stage_evaluators(stage):
-                    for evaluator in evaluators:
+        self._response_cache_stats = get_response_cache().stats()
+        try:
+            while n_tries <= max_tries:
+                self.publish_evaluations(wait=False)
+                stage_st = time.time()
+                try:
+                    stage_name = stage.value if isinstance(stage, Enum) else stage
+                    stage_name = stage_name.replace(".", "-").capitalize()
+                    set_stage(stage_name)
+                    agents = self.get_stage_agents(stage)
+                    if self.is_concurrent_stage(stage, agents):
+                        agent = agents[-1]
+                        failed, state = self.run_stage_agents(stage, agents)
+                    else:
+                        for agent in agents:
+                            _I(f"Executing stage `{stage}` with agent `{type(agent).__name__}` ...")
+                            failed, state = agent()
+                except Exception as e:
+                    _W(f"Error during task execution stage `{stage}`: `{type(e)}`: `{e}`")
+                    _M(f"**Error** during task execution stage `{stage}`: `{type(e)}`: `{e}`")
+                    _M(f"```python\n{traceback.format_exc()}\n```")
+                    state = TASK_AGENT_STATE_ERROR
+                    failed = True
+                stage_count += 1
+                stage_duration = time.time() - stage_st
+                flow_duration += stage_duration
+                _I(
+                    f"Stage `{stage}` completed in {stage_duration:.2f} seconds "
+                    f"with state `{state}` and failed `{failed}`"
+                )
+                if start_stage_name != TASK_STAGE_COMPLETED:
+                    if evaluators := self.get_stage_evaluators(stage):
                         # If the agent has evaluators, run them
-                        try:
-                            _I(f"Evaluating stage `{stage}` with evaluator `{type(evaluator).__name__}` ...")
-                            evaluation_result = evaluator()
-                            evaluation_result.timestamp = evaluation_result.timestamp or time.time()
-                            evaluation_result.evaluator = evaluation_result.evaluator or type(evaluator).__name__
-                            evaluation_result.cell_index = self.task.cell_idx
-                            evaluation_result.flow = type(self).__name__
-                            evaluation_result.stage = str(stage)
-                            evaluation_result.agent = type(agent).__name__
-                            evaluation_result.execution_duration = stage_duration
-                            evaluation_result.is_success = not failed
-                            output_evaluation(evaluation_result)
-                        except Exception as e:
-                            _W(f"Error during task evaluation stage `{stage}`: `{type(e)}`: `{e}`")
-                            _M(f"**Error** during task evaluation stage `{stage}`: `{type(e)}`: `{e}`")
-                            _M(f"```python\n{traceback.format_exc()}\n```")
-                else:
-                    output_evaluation(
-                        StageEvaluationRecord(
-                            timestamp=time.time(),
-                            evaluator="default",
-                            cell_index=self.task.cell_idx,
-                            flow=type(self).__name__,
-                            stage=str(stage),
-                            agent=type(agent).__name__,
-                            execution_duration=stage_duration,
-                            is_success=not failed,
+                        self.run_stage_evaluators(
+                            stage,
+                            evaluators,
+                            {
+                                "cell_index": self.task.cell_idx,
+                                "flow": type(self).__name__,
+                                "stage": str(stage),
+                                "agent": type(agent).__name__,
+                                "execution_duration": stage_duration,
+                                "is_success": not failed,
+                                "exec_profile": getattr(agent, "profile", None),
+                                "saved_debug_loops": getattr(agent, "saved_debug_loops", 0),
+                            },
+                        )
+                    else:
+                        output_evaluation(
+                            StageEvaluationRecord(
+                                timestamp=time.time(),
+                                evaluator="default",
+                                cell_index=self.task.cell_idx,
+                                flow=type(self).__name__,
+                                stage=str(stage),
+                                agent=type(agent).__name__,
+                                execution_duration=stage_duration,
+                                is_success=not failed,
+                                exec_profile=getattr(agent, "profile", None),
+                                saved_debug_loops=getattr(agent, "saved_debug_loops", 0),
+                            )
                         )
-                    )
 
-            if state != TASK_AGENT_STATE_ERROR:
-                # Agent did not fail, check if we have reached the final stage
-                next_stage = self.get_next_stage(stage, state, TaskAction.CONTINUE)
-                self.task.agent_stage = next_stage
-                self.task.update_cell()
-                if next_stage in self.STOP_STAGES:
-                    _I(f"Task execution **Stopped** at stage `{next_stage}`")
-                    stage = next_stage
-                    break
+                if state != TASK_AGENT_STATE_ERROR:
+                    # Agent did not fail, check if we have reached the final stage
+                    next_stage = self.get_next_stage(stage, state, TaskAction.CONTINUE)
+                    self.task.agent_stage = next_stage
+                    self.task.update_cell()
+                    if next_stage in self.STOP_STAGES:
+                        _I(f"Task execution **Stopped** at stage `{next_stage}`")
+                        stage = next_stage
+                        break
 
-            if failed:
-                # Agent failed
-                n_tries += 1
-                if n_tries > max_tries:
-                    _M(f"**Max flow tries reached** during task execution stage `{stage}`, **Stop!**")
-                    break
+                if failed:
+                    # Agent failed
+                    n_tries += 1
+                    if n_tries > max_tries:
+                        _M(f"**Max flow tries reached** during task execution stage `{stage}`, **Stop!**")
+                        break
 
-            if stage_confirm:
-                # We need to confirm
-                message = self.get_prompt_message(stage, state, failed)
-                _M("**Confirm**: " + message)
-                flush_output()
-                action = self.match_action(input(message))
-                next_stage = self.get_next_stage(stage, state, action)
-                self.task.agent_stage = next_stage
-                self.task.update_cell()
-                if action == TaskAction.STOP:
-                    _I(f"Task execution **Stopped**, and set next stage to `{next_stage}`")
-                    stage = next_stage
-                    break
+                if stage_confirm:
+                    # We need to confirm
+                    message = self.get_prompt_message(stage, state, failed)
+                    _M("**Confirm**: " + message)
+                    flush_output()
+                    action = self.match_action(input(message))
+                    next_stage = self.get_next_stage(stage, state, action)
+                    self.task.agent_stage = next_stage
+                    self.task.update_cell()
+                    if action == TaskAction.STOP:
+                        _I(f"Task execution **Stopped**, and set next stage to `{next_stage}`")
+                        stage = next_stage
+                        break
+                    else:
+                        _I(f"Action: `{action}` transits stage to `{next_stage}`")
+                        stage = next_stage
                 else:
-                    _I(f"Action: `{action}` transits stage to `{next_stage}`")
+                    # transit to the next stage without confirmation
+                    next_stage = self.get_next_stage(stage, state, TaskAction.CONTINUE)
+                    self.task.agent_stage = next_stage
+                    self.task.update_cell()
+                    _I(f"Transits stage to `{next_stage}`")
                     stage = next_stage
-            else:
-                # transit to the next stage without confirmation
-                next_stage = self.get_next_stage(stage, state, TaskAction.CONTINUE)
-                self.task.agent_stage = next_stage
-                self.task.update_cell()
-                _I(f"Transits stage to `{next_stage}`")
-                stage = next_stage
-            if not stage_continue:
-                break
+                if not stage_continue:
+                    break
+        finally:
+            # 异常或中断退出时也要释放线程池及等待中的后台评估
+            self.shutdown()
         # Finalize the task execution
         if start_stage_name != TASK_STAGE_COMPLETED:
             stage_name = stage.value if isinstance(stage, Enum) else stage
@@ -293,9 +423,9 @@ class BaseTaskFlow:
                     evaluation_result.flow = type(self).__name__
                     evaluation_result.stage = str(stage)
                     evaluation_result.is_success = True
-                    output_evaluation(evaluation_result)
+                    self.output_flow_evaluation(evaluation_result)
                 else:
-                    output_evaluation(
+                    self.output_flow_evaluation(
                         NotebookEvaluationRecord(
                             timestamp=time.time(),
                             evaluator="default",
@@ -319,10 +449,10 @@ class BaseTaskFlow:
                     evaluation_result.stage_count = stage_count
                     evaluation_result.execution_duration = flow_duration
                     evaluation_result.is_success = True
-                    output_evaluation(evaluation_result)
+                    self.output_flow_evaluation(evaluation_result)
                 else:
                     # If no evaluator, just output the evaluation record
-                    output_evaluation(
+                    self.output_flow_evaluation(
                         FlowEvaluationRecord(
                             timestamp=time.time(),
                             evaluator="default",
@@ -335,7 +465,7 @@ class BaseTaskFlow:
                         )
                     )
             elif stage in self.STOP_STAGES:
-                output_evaluation(
+                self.output_flow_evaluation(
                     FlowEvaluationRecord(
                         timestamp=time.time(),
                         evaluator="default",
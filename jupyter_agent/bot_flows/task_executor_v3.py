@@ -17,7 +17,8 @@ from .base import (
 from ..bot_agents.task_planner_v3 import TaskPlannerAgentV3, TaskPlannerState
 from ..bot_agents.code_generator import CodeGeneratorAgent
 from ..bot_agents.code_debuger import CodeDebugerAgent
-from ..bot_agents.code_executor import CodeExecutor
+from ..bot_agents.code_executor import CodeExecutor, CodeExecutorState
+from ..bot_agents.code_optimizer import CodeOptimizerAgent
 from ..bot_agents.task_structrue_summarier import TaskStructureSummaryAgent, TaskStructureSummaryState
 from ..bot_agents.task_structrue_reasoner import TaskStructureReasoningAgent
 from ..bot_agents.output_task_result import OutputTaskResult
@@ -33,6 +34,7 @@ class TaskStage(str, Enum):
     CODING = "coding"
     EXECUTING = "executing"
     DEBUGGING = "debugging"
+    OPTIMIZING = "optimizing"
     REASONING = "reasoning"
     SUMMARY = "summary"
     PREPARE_NEXT = "prepare_next"
@@ -71,13 +73,28 @@ class TaskExecutorFlowV3(BaseTaskFlow):
                 TaskPlannerState.GLOBAL_FINISHED: TaskStage.COMPLETED,
             },
         ),
-        StageNode[TaskStage, None](stage=TaskStage.CODING, agents=CodeGeneratorAgent, next_stage=TaskStage.EXECUTING),
+        StageNode[TaskStage, bool](
+            stage=TaskStage.CODING,
+            agents=CodeGeneratorAgent,
+            states={True: TaskStage.EXECUTING, False: TaskStage.DEBUGGING},
+        ),
         StageNode[TaskStage, bool](
             stage=TaskStage.EXECUTING,
             agents=CodeExecutor,
-            states={True: TaskStage.SUMMARY, False: TaskStage.DEBUGGING},
+            states={
+                True: TaskStage.SUMMARY,
+                False: TaskStage.DEBUGGING,
+                CodeExecutorState.SLOW: TaskStage.OPTIMIZING,
+            },
+        ),
+        StageNode[TaskStage, bool](
+            stage=TaskStage.DEBUGGING,
+            agents=CodeDebugerAgent,
+            states={True: TaskStage.EXECUTING, False: TaskStage.DEBUGGING},
+        ),
+        StageNode[TaskStage, None](
+            stage=TaskStage.OPTIMIZING, agents=CodeOptimizerAgent, next_stage=TaskStage.SUMMARY
         ),
-        StageNode[TaskStage, None](stage=TaskStage.DEBUGGING, agents=CodeDebugerAgent, next_stage=TaskStage.EXECUTING),
         StageNode[TaskStage, TaskStructureSummaryState](
             stage=TaskStage.REASONING,
             agents=TaskStructureReasoningAgent,
@@ -108,7 +125,11 @@ class TaskExecutorFlowV3(BaseTaskFlow):
         StageNode[TaskStage, bool](
             stage=TaskStage.COMPLETED,
             agents=CodeExecutor,
-            states={True: TaskStage.OUTPUT_RESULT, False: TaskStage.DEBUGGING},
+            states={
+                True: TaskStage.OUTPUT_RESULT,
+                False: TaskStage.DEBUGGING,
+                CodeExecutorState.SLOW: TaskStage.OUTPUT_RESULT,
+            },
         ),
         StageNode[TaskStage, None](
             stage=TaskStage.OUTPUT_RESULT, agents=OutputTaskResult, next_stage=TaskStage.COMPLETED
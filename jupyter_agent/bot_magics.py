@@ -5,24 +5,28 @@ This software is released under the MIT License.
 https://opensource.org/licenses/MIT
 """
 
+import os
 import time
 import shlex
+import atexit
 import argparse
 import ipynbname
 import traceback
 
 from IPython.display import Markdown
 from IPython.core.magic import Magics, magics_class, cell_magic
-from traitlets import Unicode, Int, Bool
+from traitlets import Unicode, Int, Bool, Float
 from traitlets.config.configurable import Configurable
 from .bot_contexts import NotebookContext
 from .bot_agents.base import AgentModelType, AgentFactory
 from .bot_agents.request_user_supply import RequestUserSupplyAgent
+from .bot_agents.code_executor import CodeExecutor
 from .bot_evaluators.base import EvaluatorFactory
 from .bot_flows import MasterPlannerFlow, TaskExecutorFlowV3
 from .bot_outputs import _D, _I, _W, _E, _F, _M, _B, _O, reset_output, set_logging_level, flush_output
-from .bot_actions import close_action_dispatcher
-from .utils import get_env_capbilities
+from .bot_actions import close_action_dispatcher, configure_action_dispatcher
+from .bot_chat import get_client_pool, close_client_pool, get_response_cache
+from .utils import get_env_capbilities, get_template_registry
 
 
 @magics_class
@@ -31,29 +35,80 @@ class BotMagics(Magics, Configurable):
 
     # 配置项
     logging_level = Unicode("INFO", help="Debug level for logging").tag(config=True)
+    logging_max_records = Int(1000, help="Max log records kept per level in the agent output").tag(config=True)
+    logging_spill_path = Unicode("", help="Append the full log of all levels to this file").tag(config=True)
     default_api_url = Unicode(None, allow_none=True, help="Default API URL").tag(config=True)
     default_api_key = Unicode("API_KEY", help="Default API Key").tag(config=True)
     default_model_name = Unicode("", help="Default Model Name").tag(config=True)
+    default_context_budget = Int(0, help="Default Context Token Budget, 0 for unlimited").tag(config=True)
     planner_api_url = Unicode(None, allow_none=True, help="Planner API URL").tag(config=True)
     planner_api_key = Unicode("API_KEY", help="Planner API Key").tag(config=True)
     planner_model_name = Unicode("", help="Planner Model Name").tag(config=True)
+    planner_context_budget = Int(0, help="Planner Context Token Budget, 0 for unlimited").tag(config=True)
     coding_api_url = Unicode(None, allow_none=True, help="Coding API URL").tag(config=True)
     coding_api_key = Unicode("API_KEY", help="Coding API Key").tag(config=True)
     coding_model_name = Unicode("", help="Coding Model Name").tag(config=True)
+    coding_context_budget = Int(0, help="Coding Context Token Budget, 0 for unlimited").tag(config=True)
     evaluating_api_url = Unicode(None, allow_none=True, help="Evaluating API URL").tag(config=True)
     evaluating_api_key = Unicode("API_KEY", help="Evaluating API Key").tag(config=True)
     evaluating_model_name = Unicode("", help="Evaluating Model Name").tag(config=True)
+    evaluating_context_budget = Int(0, help="Evaluating Context Token Budget, 0 for unlimited").tag(config=True)
     reasoning_api_url = Unicode(None, allow_none=True, help="Reasoning API URL").tag(config=True)
     reasoning_api_key = Unicode("API_KEY", help="Reasoning API Key").tag(config=True)
     reasoning_model_name = Unicode("", help="Reasoning Model Name").tag(config=True)
+    reasoning_context_budget = Int(0, help="Reasoning Context Token Budget, 0 for unlimited").tag(config=True)
     display_message = Bool(False, help="Display chat message").tag(config=True)
     display_think = Bool(True, help="Display chatthink response").tag(config=True)
     display_response = Bool(False, help="Display chat full response").tag(config=True)
+    chat_stream = Bool(False, help="Receive chat replies in streaming mode").tag(config=True)
+    chat_timeout = Float(None, allow_none=True, help="Timeout in seconds for chat requests").tag(config=True)
+    chat_pool_max_connections = Int(16, help="Max HTTP connections per chat client").tag(config=True)
+    chat_pool_keepalive_expiry = Float(60.0, help="Keep-alive expiry in seconds for idle connections").tag(config=True)
+    chat_pool_idle_timeout = Float(600.0, help="Close chat clients unused for this many seconds, 0 to disable").tag(config=True)
+    response_cache_mode = Unicode(
+        os.environ.get("JUPYTER_AGENT_RESPONSE_CACHE_MODE", "off"),
+        help="Chat response cache mode: off, readwrite, replay or record",
+    ).tag(config=True)
+    response_cache_dir = Unicode(
+        os.environ.get("JUPYTER_AGENT_RESPONSE_CACHE_DIR", ""), help="Directory for cached chat responses"
+    ).tag(config=True)
+    response_cache_ttl = Float(7 * 24 * 3600, help="Expire cached chat responses after this many seconds").tag(
+        config=True
+    )
+    response_cache_max_size = Int(256 * 1024 * 1024, help="Max total size in bytes of cached chat responses").tag(
+        config=True
+    )
+    action_reply_timeout = Float(
+        None, allow_none=True, help="Timeout in seconds waiting for the frontend to reply an action"
+    ).tag(config=True)
+    action_reply_ttl = Float(600.0, help="Drop retrieved action replies after this many seconds").tag(config=True)
+    action_reply_max_size = Int(1000, help="Max action replies kept, 0 for unlimited").tag(config=True)
+    output_spill_dir = Unicode("", help="Save the full stdout/stderr of executed cells to this directory").tag(
+        config=True
+    )
+    exec_max_time = Float(0, help="Interrupt generated code running over this many seconds, 0 for unlimited").tag(
+        config=True
+    )
+    exec_max_cpu_time = Float(0, help="Interrupt generated code using more CPU seconds, 0 for unlimited").tag(
+        config=True
+    )
+    exec_max_memory = Int(0, help="Interrupt generated code growing RSS by more MB, 0 for unlimited").tag(config=True)
+    exec_profile = Bool(False, help="Profile time, peak memory and hotspots of generated code").tag(config=True)
+    exec_profile_top_n = Int(5, help="Number of hotspot functions kept in the execution profile").tag(config=True)
+    exec_optimize_threshold = Float(
+        0, help="Try to optimize generated code running longer than this many seconds, 0 to disable"
+    ).tag(config=True)
+    exec_optimize_snapshot_max_size = Float(
+        256, help="Skip optimizing when the variables copied before execution exceed this many MB, 0 for unlimited"
+    ).tag(config=True)
+    template_cache_dir = Unicode("", help="Directory for compiled prompt template bytecode cache").tag(config=True)
     support_save_meta = Bool(False, help="Support save metadata to cell").tag(config=True)
     support_user_confirm = Bool(False, help="Support user confirm").tag(config=True)
     support_user_supply_info = Bool(False, help="Support user supply info").tag(config=True)
     support_set_cell_content = Bool(False, help="Support set cell content").tag(config=True)
     enable_evaluating = Bool(False, help="Enable evaluating task").tag(config=True)
+    concurrent_evaluating = Bool(False, help="Run stage evaluators concurrently").tag(config=True)
+    defer_evaluating = Bool(False, help="Run stage evaluators in background without blocking").tag(config=True)
     enable_supply_mocking = Bool(False, help="Enable supply mocking").tag(config=True)
     notebook_path = Unicode(None, allow_none=True, help="Path to Notebook file").tag(config=True)
     default_task_flow = Unicode("v3", allow_none=True, help="Default task flow").tag(config=True)
@@ -108,10 +163,15 @@ class BotMagics(Magics, Configurable):
     def bot(self, line, cell):
         """Jupyter cell magic: %%bot"""
         try:
-            reset_output(stage="Logging", logging_level=self.logging_level)
+            reset_output(
+                stage="Logging",
+                logging_level=self.logging_level,
+                max_log_records=self.logging_max_records,
+                log_spill_path=self.logging_spill_path or None,
+            )
             _I("Cell magic %%bot executing ...")
-            _D(f"Cell magic called with line: {repr(line.strip())}")
-            _D(f"Cell magic called with cell: {repr(cell.strip())}")
+            _D("Cell magic called with line: {!r}", line.strip())
+            _D("Cell magic called with cell: {!r}", cell.strip())
             if not self.ensure_notebook_path():
                 _O(
                     Markdown(
@@ -138,16 +198,45 @@ class BotMagics(Magics, Configurable):
             get_env_capbilities().user_supply_info = self.support_user_supply_info
             get_env_capbilities().set_cell_content = self.support_set_cell_content
             RequestUserSupplyAgent.MOCK_USER_SUPPLY = self.enable_supply_mocking
+            CodeExecutor.OUTPUT_SPILL_DIR = self.output_spill_dir or None
+            CodeExecutor.MAX_EXEC_TIME = self.exec_max_time
+            CodeExecutor.MAX_EXEC_CPU_TIME = self.exec_max_cpu_time
+            CodeExecutor.MAX_EXEC_MEMORY = self.exec_max_memory
+            CodeExecutor.PROFILE = self.exec_profile
+            CodeExecutor.PROFILE_TOP_N = self.exec_profile_top_n
+            CodeExecutor.OPTIMIZE_THRESHOLD = self.exec_optimize_threshold
+            CodeExecutor.SNAPSHOT_MAX_SIZE = self.exec_optimize_snapshot_max_size
+            get_client_pool().configure(
+                max_connections=self.chat_pool_max_connections,
+                keepalive_expiry=self.chat_pool_keepalive_expiry,
+                idle_timeout=self.chat_pool_idle_timeout,
+            )
+            get_response_cache().configure(
+                cache_dir=self.response_cache_dir,
+                mode=self.response_cache_mode,
+                ttl=self.response_cache_ttl,
+                max_size=self.response_cache_max_size,
+            )
+            get_template_registry().configure(bytecode_cache_dir=self.template_cache_dir)
+            configure_action_dispatcher(
+                reply_timeout=self.action_reply_timeout,
+                reply_ttl=self.action_reply_ttl,
+                reply_max_size=self.action_reply_max_size,
+            )
             options = self.parse_args(line)
             set_logging_level(options.logging_level)
             _D(f"Cell magic called with options: {options}")
             nb_context = NotebookContext(line, cell, notebook_path=self.notebook_path)
             agent_factory = self.get_agent_factory(nb_context)
             evaluator_factory = self.get_evaluator_factory(nb_context)
+            flow_kwargs = {
+                "concurrent_evaluating": self.concurrent_evaluating,
+                "defer_evaluating": self.defer_evaluating,
+            }
             if options.planning:
-                flow = MasterPlannerFlow(nb_context, agent_factory, evaluator_factory)
+                flow = MasterPlannerFlow(nb_context, agent_factory, evaluator_factory, **flow_kwargs)
             elif options.flow == "v3":
-                flow = TaskExecutorFlowV3(nb_context, agent_factory, evaluator_factory)
+                flow = TaskExecutorFlowV3(nb_context, agent_factory, evaluator_factory, **flow_kwargs)
             else:
                 raise ValueError(f"Unknown flow: {options.flow}")
             flow(
@@ -160,7 +249,8 @@ class BotMagics(Magics, Configurable):
             traceback.print_exc()
         finally:
             close_action_dispatcher()
-            flush_output()
+            get_client_pool().evict_idle()
+            flush_output(final=True)
 
     def ensure_notebook_path(self):
         if self.notebook_path:
@@ -184,21 +274,43 @@ class BotMagics(Magics, Configurable):
             display_think=self.display_think,
             display_message=self.display_message,
             display_response=self.display_response,
+            timeout=self.chat_timeout,
+            stream=self.chat_stream,
         )
         agent_factory.config_model(
-            AgentModelType.DEFAULT, self.default_api_url, self.default_api_key, self.default_model_name
+            AgentModelType.DEFAULT,
+            self.default_api_url,
+            self.default_api_key,
+            self.default_model_name,
+            self.default_context_budget,
         )
         agent_factory.config_model(
-            AgentModelType.PLANNER, self.planner_api_url, self.planner_api_key, self.planner_model_name
+            AgentModelType.PLANNER,
+            self.planner_api_url,
+            self.planner_api_key,
+            self.planner_model_name,
+            self.planner_context_budget,
         )
         agent_factory.config_model(
-            AgentModelType.CODING, self.coding_api_url, self.coding_api_key, self.coding_model_name
+            AgentModelType.CODING,
+            self.coding_api_url,
+            self.coding_api_key,
+            self.coding_model_name,
+            self.coding_context_budget,
         )
         agent_factory.config_model(
-            AgentModelType.EVALUATING, self.evaluating_api_url, self.evaluating_api_key, self.evaluating_model_name
+            AgentModelType.EVALUATING,
+            self.evaluating_api_url,
+            self.evaluating_api_key,
+            self.evaluating_model_name,
+            self.evaluating_context_budget,
         )
         agent_factory.config_model(
-            AgentModelType.REASONING, self.reasoning_api_url, self.reasoning_api_key, self.reasoning_model_name
+            AgentModelType.REASONING,
+            self.reasoning_api_url,
+            self.reasoning_api_key,
+            self.reasoning_model_name,
+            self.reasoning_context_budget,
         )
         return agent_factory
 
@@ -209,21 +321,43 @@ class BotMagics(Magics, Configurable):
                 display_think=self.display_think,
                 display_message=self.display_message,
                 display_response=self.display_response,
+                timeout=self.chat_timeout,
+                stream=self.chat_stream,
             )
             evaluator_factory.config_model(
-                AgentModelType.DEFAULT, self.default_api_url, self.default_api_key, self.default_model_name
+                AgentModelType.DEFAULT,
+                self.default_api_url,
+                self.default_api_key,
+                self.default_model_name,
+                self.default_context_budget,
             )
             evaluator_factory.config_model(
-                AgentModelType.PLANNER, self.planner_api_url, self.planner_api_key, self.planner_model_name
+                AgentModelType.PLANNER,
+                self.planner_api_url,
+                self.planner_api_key,
+                self.planner_model_name,
+                self.planner_context_budget,
             )
             evaluator_factory.config_model(
-                AgentModelType.CODING, self.coding_api_url, self.coding_api_key, self.coding_model_name
+                AgentModelType.CODING,
+                self.coding_api_url,
+                self.coding_api_key,
+                self.coding_model_name,
+                self.coding_context_budget,
             )
             evaluator_factory.config_model(
-                AgentModelType.EVALUATING, self.evaluating_api_url, self.evaluating_api_key, self.evaluating_model_name
+                AgentModelType.EVALUATING,
+                self.evaluating_api_url,
+                self.evaluating_api_key,
+                self.evaluating_model_name,
+                self.evaluating_context_budget,
             )
             evaluator_factory.config_model(
-                AgentModelType.REASONING, self.reasoning_api_url, self.reasoning_api_key, self.reasoning_model_name
+                AgentModelType.REASONING,
+                self.reasoning_api_url,
+                self.reasoning_api_key,
+                self.reasoning_model_name,
+                self.reasoning_context_budget,
             )
         else:
             evaluator_factory = None
@@ -233,3 +367,10 @@ class BotMagics(Magics, Configurable):
 def load_ipython_extension(ipython):
     """Load the bot magic extension."""
     ipython.register_magics(BotMagics)
+    atexit.register(close_client_pool)
+
+
+def unload_ipython_extension(ipython):
+    """Unload the bot magic extension, closing pooled chat connections."""
+    close_client_pool()
+    atexit.unregister(close_client_pool)
@@ -7,8 +7,13 @@ https://opensource.org/licenses/MIT
 
 import json
 import time
+import uuid
+import heapq
+import collections
 import datetime
-import jinja2
+import threading
+import contextlib
+import contextvars
 
 from enum import Enum
 from typing import Optional, Dict, List, Tuple, Any, Type
@@ -16,7 +21,7 @@ from pydantic import BaseModel, Field
 from IPython.display import display, Markdown
 from .bot_evaluation import BaseEvaluationRecord
 from .bot_actions import ActionBase
-from .utils import no_indent, no_wrap
+from .utils import no_indent, no_wrap, get_template_registry
 
 STAGE_SWITCHER_SCRIPT = no_wrap(
     """
@@ -119,53 +124,57 @@ AGENT_OUTPUT_TEMPLEATE = no_indent(
     </div>
     <div class="agent-output-content">
         <div class="agent-stage-switcher">
-            {% for stage in contents.keys() %}
+            {% for stage in stages %}
             <span class="agent-stage-title agent-stage-{{ stage }} {{ 'active' if stage == active_stage }}" onclick="{% include 'switcher_script' %}">
                 {{ stage }}
             </span>
             {% endfor %}
         </div>
-        {% for stage, contents in contents.items() %}
+        {% for stage in stages %}
         <div class="agent-stage-output-panel agent-stage-{{ stage }} {{ 'active' if stage == active_stage }}">
-            {% if stage == 'Logging' +%}
-                ```log
-                {% for content in contents %}
-                    {{ content['content'] }}
-                {% endfor %}
-                ```
-            {% else %}
-                {% for content in contents %}
-                    {% if content['type'] == 'block' %}
-                    <div class="agent-output-block">
-                        <div class="agent-output-block-title {{ 'collapsed' if content['collapsed'] else ''}}" onclick="this.classList.toggle('collapsed')">
-                            {{ content['title'] }}
-                        </div>
-                        <div class="agent-output-block-content">
-                            {% if content['format'] == 'markdown' +%}
-                                {{ content['content'] }}
-                            {%+ elif content['format'] == 'code' +%}
-                                ```{{ content['code_language'] }}
-                                {{ content['content'] }}
-                                ```
-                            {%+ endif %}
-                        </div>
-                    </div>
-                    {% elif content['type'] == 'markdown' +%}
-                        {{ content['content'] }}
-                    {% elif content['type'] == 'text' +%}
-                        ```{{ content['code_language'] }}
-                        {{ content['content'] }}
-                        ```
-                    {%+ endif %}
-                {% endfor %}
-            {% endif %}
-        </div>
+        {{ fragments[stage] }}</div>
         {% endfor %}
     </div>
 </div>
 """
 )
 
+AGENT_STAGE_TEMPLATE = no_indent(
+    """{% if stage == 'Logging' +%}
+    ```log
+    {% for content in contents %}
+        {{ content['content'] }}
+    {% endfor %}
+    ```
+{% else %}
+    {% for content in contents %}
+        {% if content['type'] == 'block' %}
+        <div class="agent-output-block">
+            <div class="agent-output-block-title {{ 'collapsed' if content['collapsed'] else ''}}" onclick="this.classList.toggle('collapsed')">
+                {{ content['title'] }}
+            </div>
+            <div class="agent-output-block-content">
+                {% if content['format'] == 'markdown' +%}
+                    {{ content['content'] }}
+                {%+ elif content['format'] == 'code' +%}
+                    ```{{ content['code_language'] }}
+                    {{ content['content'] }}
+                    ```
+                {%+ endif %}
+            </div>
+        </div>
+        {% elif content['type'] == 'markdown' +%}
+            {{ content['content'] }}
+        {% elif content['type'] == 'text' +%}
+            ```{{ content['code_language'] }}
+            {{ content['content'] }}
+            ```
+        {%+ endif %}
+    {% endfor %}
+{% endif %}
+"""
+)
+
 LOGGING_LEVELS = {
     "DEBUG": 10,
     "INFO": 20,
@@ -175,55 +184,154 @@ LOGGING_LEVELS = {
 }
 
 
+def format_message(msg, args=()):
+    """延迟格式化日志消息：msg可以是返回字符串的函数，提供args时以str.format格式化"""
+    if callable(msg):
+        msg = msg()
+    return str(msg).format(*args) if args else msg
+
+
+class LogStore:
+    """有界的日志存储
+
+    每个级别各用一个环形缓冲保存最近max_records条日志，按级别过滤时只合并不低于该级别的缓冲。
+    设置spill_path时所有写入的日志同时追加到该文件，保留完整的日志。
+    """
+
+    def __init__(self, max_records=1000, spill_path=None):
+        self.max_records = max_records
+        self.spill_path = spill_path
+        self._seq = 0
+        self._levels = {level: collections.deque(maxlen=max_records) for level in LOGGING_LEVELS.values()}
+        self._dropped = dict.fromkeys(LOGGING_LEVELS.values(), 0)
+        self._spill_file = None
+
+    def append(self, level_n, level_name, msg, keep=True):
+        content = f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')}] {level_name}: {msg}"
+        if keep:
+            index = self._levels[level_n]
+            if len(index) == index.maxlen:
+                self._dropped[level_n] += 1
+            index.append((self._seq, content))
+            self._seq += 1
+        if self.spill_path:
+            if self._spill_file is None:
+                self._spill_file = open(self.spill_path, "a", encoding="utf-8", buffering=1)
+            self._spill_file.write(content + "\n")
+        return content
+
+    def records(self, min_level=0):
+        """按写入顺序返回不低于min_level的最近max_records条日志"""
+        indexes = [index for level, index in self._levels.items() if level >= min_level]
+        return [content for _, content in heapq.merge(*indexes)][-self.max_records :]
+
+    def dropped(self, min_level=0):
+        """不低于min_level的日志中未被records返回的条数，包括环形缓冲淘汰的及合并后超出max_records的"""
+        evicted = sum(n for level, n in self._dropped.items() if level >= min_level)
+        kept = sum(len(index) for level, index in self._levels.items() if level >= min_level)
+        return evicted + max(0, kept - self.max_records)
+
+    def __len__(self):
+        return sum(len(index) for index in self._levels.values())
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+
 class AgentOutput:
     """
     AgentOutput 是一个用于在 Jupyter Notebook 中显示 Agent 输出的类。
+
+    各阶段的内容分别渲染为片段并缓存，只有内容变化的阶段才会重新渲染。输出的更新由后台定时器合并，
+    每display_interval秒最多刷新一次，调用方不会被阻塞；flush_output会在当前线程立即刷新。
     """
 
-    def __init__(self, title=None, collapsed=False, logging_level="INFO"):
+    display_interval = 1.0
+
+    def __init__(self, title=None, collapsed=False, logging_level="INFO", max_log_records=1000, log_spill_path=None):
         self.title = title
         self.collapsed = collapsed
-        self.logging_level = (
-            logging_level if isinstance(logging_level, int) else LOGGING_LEVELS.get(logging_level.upper(), 20)
-        )
-        self.jinja_env = jinja2.Environment(
-            trim_blocks=True, lstrip_blocks=True, loader=jinja2.DictLoader({"switcher_script": STAGE_SWITCHER_SCRIPT})
-        )
-        self.template = self.jinja_env.from_string(AGENT_OUTPUT_TEMPLEATE)
+        templates = {"switcher_script": STAGE_SWITCHER_SCRIPT}
+        self.template = get_template_registry().get_template(AGENT_OUTPUT_TEMPLEATE, templates)
+        self.stage_template = get_template_registry().get_template(AGENT_STAGE_TEMPLATE, templates)
         self.handler = None
+        self._lock = threading.RLock()
+        self._render_timer = None
+        self._held = 0
+        self._fragments = {}
+        self._dirty_stages = set()
         self._is_dirty = True
         self._latest_display_tm = 0
         self._contents = {}
+        self._metadata_content = None
         self._active_stage = None
         self._agent_data_timestamp = None
         self._agent_data = {}
-        self._logging_records = []
+        self._log_store = LogStore(max_log_records, log_spill_path)
         self._evaluation_records = []
         self._action_records = []
+        self._sent_records = {"jupyter-agent-evaluation-records": 0, "jupyter-agent-action-records": 0}
+        self.output_id = uuid.uuid4().hex
+        self.logging_level = logging_level
 
     @property
-    def content(self):
+    def logging_level(self):
+        return self._logging_level
+
+    @logging_level.setter
+    def logging_level(self, logging_level):
+        self._logging_level = (
+            logging_level if isinstance(logging_level, int) else LOGGING_LEVELS.get(logging_level.upper(), 20)
+        )
+        self._mark_dirty("Logging")
+
+    @property
+    def _accept_level(self):
+        """低于该级别的日志在格式化之前即被丢弃"""
+        return LOGGING_LEVELS["DEBUG"] if self._log_store.spill_path else self._logging_level
+
+    def _mark_dirty(self, stage):
+        if stage == "Metadata":
+            self._metadata_content = None
+        self._dirty_stages.add(stage)
+        self._is_dirty = True
+
+    def _stage_contents(self):
         contents = dict(self._contents)
         if self._agent_data:
-            contents["Metadata"] = [
-                {
-                    "type": "text",
-                    "content": json.dumps(self.metadata, indent=2, ensure_ascii=False),
-                    "code_language": "json",
-                }
-            ]
-        filtered_logs = [log for log in self._logging_records if log["level"] >= self.logging_level]
+            # 序列化全部记录的开销随记录数增长，缓存序列化的结果，仅在元数据变化后重新序列化
+            if self._metadata_content is None:
+                self._metadata_content = json.dumps(self.metadata, indent=2, ensure_ascii=False)
+            contents["Metadata"] = [{"type": "text", "content": self._metadata_content, "code_language": "json"}]
+        filtered_logs = [{"content": content} for content in self._log_store.records(self.logging_level)]
         if len(filtered_logs) > 0:
+            dropped = self._log_store.dropped(self.logging_level)
+            if dropped:
+                spilled = f", see {self._log_store.spill_path}" if self._log_store.spill_path else ""
+                filtered_logs.insert(0, {"content": f"... {dropped} earlier log records dropped{spilled}"})
             contents["Logging"] = filtered_logs
-        return self.template.render(
-            title=self.title,
-            collapsed=self.collapsed,
-            active_stage=self._active_stage,
-            contents=contents,
-        )
+        return contents
 
     @property
-    def metadata(self):
+    def content(self):
+        with self._lock:
+            contents = self._stage_contents()
+            for stage, stage_contents in contents.items():
+                if stage in self._dirty_stages or stage not in self._fragments:
+                    self._fragments[stage] = self.stage_template.render(stage=stage, contents=stage_contents)
+            self._fragments = {stage: self._fragments[stage] for stage in contents}
+            self._dirty_stages.clear()
+            return self.template.render(
+                title=self.title,
+                collapsed=self.collapsed,
+                active_stage=self._active_stage,
+                stages=list(contents),
+                fragments=self._fragments,
+            )
+
+    def _base_metadata(self):
         metadata = {"reply_type": "AgentOutput", "exclude_from_context": True}
         if self._agent_data:
             metadata.update(
@@ -233,113 +341,187 @@ class AgentOutput:
                     "jupyter-agent-data": self._agent_data,
                 }
             )
+        return metadata
+
+    @property
+    def metadata(self):
+        """包含全部评估及动作记录的完整元数据"""
+        metadata = self._base_metadata()
         if self._evaluation_records:
             metadata["jupyter-agent-evaluation-records"] = [record.model_dump() for record in self._evaluation_records]
         if self._action_records:
             metadata["jupyter-agent-action-records"] = [record.model_dump() for record in self._action_records]
         return metadata
 
-    def display(self, stage=None, force=False, wait=True):
-        if stage is not None and stage != self._active_stage:
-            self._active_stage = stage
-            self._is_dirty = True
-        if not self._is_dirty and not force:
-            return
-        if not force and time.time() - self._latest_display_tm < 1:
-            if wait:
-                time.sleep(1 - (time.time() - self._latest_display_tm))
-            else:
+    def display_metadata(self, final=False):
+        """随输出更新发送的元数据
+
+        每次更新只携带上次发送之后新增的评估及动作记录，并以`<key>-start`给出其中第一条记录的序号，
+        由NotebookRunner按jupyter-agent-output-id及序号重新拼接；final为True时发送包含全部记录的最终快照。
+        """
+        metadata = self._base_metadata()
+        metadata["jupyter-agent-output-id"] = self.output_id
+        for key, records in (
+            ("jupyter-agent-evaluation-records", self._evaluation_records),
+            ("jupyter-agent-action-records", self._action_records),
+        ):
+            start = 0 if final else self._sent_records[key]
+            if len(records) > start:
+                metadata[key] = [record.model_dump() for record in records[start:]]
+                metadata[key + "-start"] = start
+            self._sent_records[key] = len(records)
+        if final:
+            metadata["jupyter-agent-output-final"] = True
+        return metadata
+
+    def display(self, stage=None, force=False, wait=True, final=False):
+        """刷新输出，wait为True或尚未创建输出时在当前线程立即刷新，否则交由后台定时器合并刷新
+
+        final为True时立即刷新并发送包含全部记录的最终元数据快照。
+        """
+        with self._lock:
+            if stage is not None and stage != self._active_stage:
+                self._active_stage = stage
+                self._is_dirty = True
+            if not self._is_dirty and not force and not final:
                 return
+            if self._held:
+                # 暂停刷新期间只记录变化，恢复后再刷新
+                return
+            if self.handler is None or force or wait or final:
+                self._cancel_timer()
+                self._update_display(final)
+            elif self._render_timer is None:
+                delay = max(0.0, self.display_interval - (time.time() - self._latest_display_tm))
+                # 在定时器线程中沿用当前的上下文，使输出归属到当前单元格
+                self._render_timer = threading.Timer(delay, contextvars.copy_context().run, args=(self._on_timer,))
+                self._render_timer.daemon = True
+                self._render_timer.start()
+
+    @contextlib.contextmanager
+    def hold_display(self):
+        """暂停刷新输出：进入时立即完成待合并的刷新，退出后补上期间的更新
+
+        执行生成的代码时输出被TeeOutputCapture捕获，暂停刷新以免输出面板被一并捕获。
+        """
+        with self._lock:
+            self._cancel_timer()
+            if self._is_dirty and self.handler is not None:
+                self._update_display()
+            self._held += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held -= 1
+            self.display(force=False, wait=False)
+
+    def _cancel_timer(self):
+        if self._render_timer is not None:
+            self._render_timer.cancel()
+            self._render_timer = None
+
+    def _on_timer(self):
+        with self._lock:
+            self._render_timer = None
+            if self._is_dirty and not self._held:
+                self._update_display()
+
+    def _update_display(self, final=False):
         if self.handler is None:
-            self.handler = display(Markdown(self.content), metadata=self.metadata, display_id=True)
+            self.handler = display(Markdown(self.content), metadata=self.display_metadata(final), display_id=True)
         else:
-            self.handler.update(Markdown(self.content), metadata=self.metadata)
+            self.handler.update(Markdown(self.content), metadata=self.display_metadata(final))
         self._latest_display_tm = time.time()
         self._is_dirty = False
 
     def clear(self, stage=None, clear_metadata=False):
-        if stage is None:
-            self._contents = {}
-        else:
-            self._contents[stage] = []
-        if clear_metadata:
-            self._agent_data = {}
-        self._is_dirty = True
+        with self._lock:
+            if stage is None:
+                self._contents = {}
+                self._fragments = {}
+            else:
+                self._contents[stage] = []
+                self._mark_dirty(stage)
+            if clear_metadata:
+                self._agent_data = {}
+                self._mark_dirty("Metadata")
+            self._is_dirty = True
         self.display(force=False, wait=False)
 
     def output_block(
         self, content, title="Block", collapsed=True, stage=None, format="markdown", code_language="python"
     ):
-        if stage is None:
-            stage = self._active_stage
-        if stage not in self._contents:
-            self._contents[stage] = []
-        self._contents[stage].append(
-            {
-                "type": "block",
-                "title": title,
-                "content": content,
-                "collapsed": collapsed,
-                "format": format,
-                "code_language": code_language,
-            }
-        )
-        self._is_dirty = True
+        with self._lock:
+            if stage is None:
+                stage = self._active_stage
+            if stage not in self._contents:
+                self._contents[stage] = []
+            self._contents[stage].append(
+                {
+                    "type": "block",
+                    "title": title,
+                    "content": content,
+                    "collapsed": collapsed,
+                    "format": format,
+                    "code_language": code_language,
+                }
+            )
+            self._mark_dirty(stage)
         self.display(stage, force=False, wait=False)
 
     def output_text(self, content, stage=None, code_language="python"):
-        if stage is None:
-            stage = self._active_stage
-        if stage not in self._contents:
-            self._contents[stage] = []
-        if (
-            len(self._contents[stage]) > 0
-            and self._contents[stage][-1]["type"] == "text"
-            and self._contents[stage][-1]["code_language"] == code_language
-        ):
-            self._contents[stage][-1]["content"] += "\n" + content
-        else:
-            self._contents[stage].append({"type": "text", "content": content, "code_language": code_language})
-        self._is_dirty = True
+        with self._lock:
+            if stage is None:
+                stage = self._active_stage
+            if stage not in self._contents:
+                self._contents[stage] = []
+            if (
+                len(self._contents[stage]) > 0
+                and self._contents[stage][-1]["type"] == "text"
+                and self._contents[stage][-1]["code_language"] == code_language
+            ):
+                self._contents[stage][-1]["content"] += "\n" + content
+            else:
+                self._contents[stage].append({"type": "text", "content": content, "code_language": code_language})
+            self._mark_dirty(stage)
         self.display(stage, force=False, wait=False)
 
     def output_markdown(self, content, stage=None):
-        if stage is None:
-            stage = self._active_stage
-        if stage not in self._contents:
-            self._contents[stage] = []
-        self._contents[stage].append({"type": "markdown", "content": content})
-        self._is_dirty = True
+        with self._lock:
+            if stage is None:
+                stage = self._active_stage
+            if stage not in self._contents:
+                self._contents[stage] = []
+            self._contents[stage].append({"type": "markdown", "content": content})
+            self._mark_dirty(stage)
         self.display(stage, force=False, wait=False)
 
     def output_agent_data(self, **kwargs):
-        self.log(f"output agent data {kwargs}", level="DEBUG")
-        self._agent_data.update(kwargs)
-        self._agent_data_timestamp = time.time()
-        self._is_dirty = True
+        self.log(lambda: f"output agent data {kwargs}", level="DEBUG")
+        with self._lock:
+            self._agent_data.update(kwargs)
+            self._agent_data_timestamp = time.time()
+            self._mark_dirty("Metadata")
         self.display(force=False, wait=False)
 
-    def log(self, msg, level="INFO"):
+    def log(self, msg, level="INFO", *args):
         level = level.upper()
         assert level in LOGGING_LEVELS
-        tm = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
         level_n = LOGGING_LEVELS[level]
-        content = f"[{tm}] {level}: {msg}"
-        if self._logging_records and self._logging_records[-1]["level"] == level_n:
-            self._logging_records[-1]["content"] += "\n" + content
-        else:
-            self._logging_records.append(
-                {
-                    "type": "logging",
-                    "level": level_n,
-                    "level_name": level,
-                    "time": tm,
-                    "msg": msg,
-                    "content": content,
-                }
-            )
-        self._is_dirty = True
-        self.display(force=False, wait=False)
+        if level_n < self._accept_level:
+            return
+        msg = format_message(msg, args)
+        keep = level_n >= self.logging_level
+        with self._lock:
+            self._log_store.append(level_n, level, msg, keep=keep)
+            if keep:
+                self._mark_dirty("Logging")
+        if keep:
+            self.display(force=False, wait=False)
+
+    def close(self):
+        self._log_store.close()
 
     def log_evaluation(self, record: BaseEvaluationRecord):
         assert isinstance(
@@ -347,22 +529,24 @@ class AgentOutput:
         ), "record must be an instance of BaseEvalutionRecord or its subclass"
         if record.timestamp == 0:
             record.timestamp = time.time()
-        self._evaluation_records.append(record)
+        with self._lock:
+            self._evaluation_records.append(record)
+            self._mark_dirty("Metadata")
         self.log(
             f"Evaluation: {record.eval_type}[{record.cell_index}] duration: {record.execution_duration:.2f}s "
             f"success: {record.is_success} correct: {record.correct_score:.2f}",
             level="INFO",
         )
-        self._is_dirty = True
         self.display(force=False, wait=False)
 
     def log_action(self, record: ActionBase):
         assert isinstance(record, ActionBase), "record must be an instance of BaseActionRecord or its subclass"
         if record.timestamp == 0:
             record.timestamp = time.time()
-        self._action_records.append(record)
+        with self._lock:
+            self._action_records.append(record)
+            self._mark_dirty("Metadata")
         self.log(f"Action: {record.action} from {record.source}", level="INFO")
-        self._is_dirty = True
         self.display(force=False, wait=False)
 
 
@@ -380,16 +564,20 @@ def set_stage(stage):
     get_output().display(stage)
 
 
-def reset_output(title=None, collapsed=False, stage=None, logging_level="INFO"):
+def reset_output(
+    title=None, collapsed=False, stage=None, logging_level="INFO", max_log_records=1000, log_spill_path=None
+):
     global __agent_output
-    __agent_output = AgentOutput(title, collapsed, logging_level)
+    if __agent_output is not None:
+        __agent_output.close()
+    __agent_output = AgentOutput(title, collapsed, logging_level, max_log_records, log_spill_path)
     if stage is not None:
         __agent_output.display(stage)
     return __agent_output
 
 
-def log(msg, level="INFO"):
-    get_output().log(msg, level)
+def log(msg, level="INFO", *args):
+    get_output().log(msg, level, *args)
 
 
 def output_block(content, title="Block", collapsed=True, stage=None, format="markdown", code_language="python"):
@@ -420,8 +608,12 @@ def clear_output(stage=None, clear_metadata=False):
     get_output().clear(stage, clear_metadata)
 
 
-def flush_output(force=False):
-    get_output().display(force=force, wait=True)
+def flush_output(force=False, final=False):
+    get_output().display(force=force, wait=True, final=final)
+
+
+def hold_output():
+    return get_output().hold_display()
 
 
 def set_title(title):
@@ -526,8 +718,8 @@ _T = output_text
 _B = output_block
 _A = output_agent_data
 _L = log
-_D = lambda msg: log(msg, level="DEBUG")
-_I = lambda msg: log(msg, level="INFO")
-_W = lambda msg: log(msg, level="WARN")
-_E = lambda msg: log(msg, level="ERROR")
-_F = lambda msg: log(msg, level="FATAL")
+_D = lambda msg, *args: log(msg, "DEBUG", *args)
+_I = lambda msg, *args: log(msg, "INFO", *args)
+_W = lambda msg, *args: log(msg, "WARN", *args)
+_E = lambda msg, *args: log(msg, "ERROR", *args)
+_F = lambda msg, *args: log(msg, "FATAL", *args)
@@ -6,13 +6,24 @@ https://opensource.org/licenses/MIT
 """
 
 import io
+import contextlib
 import os
 import re
 import sys
 import json
 import jinja2
 import openai
-
+import hashlib
+import nbformat
+import ctypes
+import pstats
+import cProfile
+import tempfile
+import tracemalloc
+import threading
+import time
+
+from collections import OrderedDict, deque
 from enum import Enum
 from typing import Optional
 from pydantic import BaseModel, Field
@@ -23,6 +34,16 @@ from IPython.core.displayhook import CapturingDisplayHook
 from IPython.utils.capture import capture_output, CapturedIO
 from IPython.utils.io import Tee
 
+try:
+    import orjson as fast_json
+except ImportError:
+    fast_json = json
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 
 class CloselessStringIO(io.StringIO):
     def close(self):
@@ -33,6 +54,88 @@ class CloselessStringIO(io.StringIO):
         return super().__del__()
 
 
+class HeadTailStringIO(io.TextIOBase):
+    """只保留开头head_size个字符和末尾tail_size个字符的输出缓冲，内存占用与输出量无关
+
+    中间被丢弃的部分记入dropped_chars/dropped_lines；指定spill_dir时完整输出另存到该目录下的临时文件。
+    """
+
+    def __init__(self, head_size: int = 8 * 1024, tail_size: int = 8 * 1024, spill_dir: Optional[str] = None):
+        super().__init__()
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.total_chars = 0
+        self.dropped_chars = 0
+        self.dropped_lines = 0
+        self._head: list[str] = []
+        self._head_len = 0
+        self._tail: deque[str] = deque()
+        self._tail_len = 0
+        self._tail_offset = 0  # _tail[0]中已丢弃的字符数
+        self.spill_path = None
+        self._spill_file = None
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_file = tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=spill_dir, prefix="jupyter-agent-output-", suffix=".txt", delete=False
+            )
+            self.spill_path = self._spill_file.name
+
+    def writable(self):
+        return True
+
+    def write(self, s: str) -> int:
+        size = len(s)
+        self.total_chars += size
+        if self._spill_file is not None:
+            self._spill_file.write(s)
+        if self._head_len < self.head_size:
+            part = s[: self.head_size - self._head_len]
+            self._head.append(part)
+            self._head_len += len(part)
+            s = s[len(part) :]
+        if s:
+            self._tail.append(s)
+            self._tail_len += len(s)
+            self._trim_tail()
+        return size
+
+    def _trim_tail(self):
+        while self._tail_len > self.tail_size:
+            first = self._tail[0]
+            drop = min(self._tail_len - self.tail_size, len(first) - self._tail_offset)
+            self.dropped_chars += drop
+            self.dropped_lines += first.count("\n", self._tail_offset, self._tail_offset + drop)
+            self._tail_len -= drop
+            self._tail_offset += drop
+            if self._tail_offset == len(first):
+                self._tail.popleft()
+                self._tail_offset = 0
+
+    def __len__(self):
+        return self._head_len + self._tail_len
+
+    def getvalue(self) -> str:
+        """返回截断后的内容，中间丢弃的部分以一行提示代替"""
+        head = "".join(self._head)
+        tail = "".join(self._tail)[self._tail_offset :]
+        if not self.dropped_chars:
+            return head + tail
+        notice = f"\n... [{self.dropped_chars} chars, {self.dropped_lines} lines dropped"
+        if self.spill_path:
+            notice += f", full output in {self.spill_path}"
+        return head + notice + "] ...\n" + tail
+
+    def flush(self):
+        if self._spill_file is not None and not self._spill_file.closed:
+            self._spill_file.flush()
+
+    def close(self):
+        """只关闭溢出文件，已缓存的内容仍可读取"""
+        if self._spill_file is not None:
+            self._spill_file.close()
+
+
 class TeeCapturingDisplayPublisher(CapturingDisplayPublisher):
 
     def __init__(self, *args, original_display_pub=None, **kwargs):
@@ -58,6 +161,20 @@ class TeeCapturingDisplayHook(CapturingDisplayHook):
 
 
 class TeeOutputCapture(capture_output):
+    """捕获输出的同时照常显示
+
+    指定max_size时stdout/stderr各只保留开头和末尾共max_size个字符（见HeadTailStringIO），否则保留全部输出。
+    """
+
+    def __init__(self, *args, max_size: Optional[int] = None, spill_dir: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_size = max_size
+        self.spill_dir = spill_dir
+
+    def _make_buffer(self):
+        if self.max_size is None:
+            return CloselessStringIO()
+        return HeadTailStringIO(self.max_size // 2, self.max_size - self.max_size // 2, spill_dir=self.spill_dir)
 
     def __enter__(self):
 
@@ -72,10 +189,10 @@ class TeeOutputCapture(capture_output):
 
         stdout = stderr = outputs = None
         if self.stdout:
-            stdout = CloselessStringIO()
+            stdout = self._make_buffer()
             sys.stdout = Tee(stdout, channel="stdout")
         if self.stderr:
-            stderr = CloselessStringIO()
+            stderr = self._make_buffer()
             sys.stderr = Tee(stderr, channel="stderr")
         if self.display:
             if self.shell is not None:
@@ -88,8 +205,242 @@ class TeeOutputCapture(capture_output):
                 self.save_display_pub = None
                 outputs = None
 
+        self._buffers = [buffer for buffer in (stdout, stderr) if buffer is not None]
         return CapturedIO(stdout, stderr, outputs)
 
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        for buffer in self._buffers:
+            buffer.close()
+
+
+def get_rss_bytes() -> int:
+    """返回当前进程的常驻内存（RSS）字节数，无法获取时返回0"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class ExecutionLimitExceeded(BaseException):
+    """代码执行超出限制时由ExecutionWatchdog注入到执行线程中的异常
+
+    继承自BaseException，避免被生成代码中的`except Exception`吞掉。
+    """
+
+
+class ExecutionWatchdog(threading.Thread):
+    """在后台线程中监控代码执行的耗时、CPU时间及内存增长，超出限制时中断执行线程
+
+    max_wall_time/max_cpu_time单位为秒，max_memory为RSS增长的字节数，0表示不限制。超限后通过
+    PyThreadState_SetAsyncExc向执行线程注入ExecutionLimitExceeded，长时间运行的C扩展调用会在返回后才被中断。
+
+    CPU时间为执行线程自身的CPU时间，不包括Agent的其他线程；不支持pthread_getcpuclockid的平台（如Windows）上
+    为整个进程的CPU时间。armed为False时只在arm()与disarm()之间注入异常，见armed_in()。
+    """
+
+    def __init__(
+        self, max_wall_time: float = 0, max_cpu_time: float = 0, max_memory: int = 0, interval=0.1, armed=True
+    ):
+        super().__init__(daemon=True)
+        self.max_wall_time = max_wall_time
+        self.max_cpu_time = max_cpu_time
+        self.max_memory = max_memory
+        self.interval = interval
+        self.exceeded: Optional[str] = None
+        self.usage = {"wall_time": 0.0, "cpu_time": 0.0, "memory": 0}
+        self._armed = armed
+        self._injected = False
+        self._target_id = None
+        self._cpu_clock = time.process_time
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_wall_time or self.max_cpu_time or self.max_memory)
+
+    def _thread_cpu_clock(self):
+        """返回读取执行线程CPU时间的函数，可在其他线程中调用"""
+        try:
+            clock_id = time.pthread_getcpuclockid(self._target_id)
+            time.clock_gettime(clock_id)
+            return lambda: time.clock_gettime(clock_id)
+        except (AttributeError, OSError):
+            return time.process_time
+
+    def __enter__(self):
+        self._target_id = threading.get_ident()
+        self._cpu_clock = self._thread_cpu_clock()
+        self._start_wall = time.monotonic()
+        self._start_cpu = self._cpu_clock()
+        self._start_rss = get_rss_bytes() if self.max_memory else 0
+        if self.enabled:
+            self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._lock:
+            self._stopped.set()
+        self.disarm()
+        if self.is_alive():
+            self.join()
+        self._measure()
+        return exc_type is not None and issubclass(exc_type, ExecutionLimitExceeded)
+
+    def _clear_pending(self):
+        if self._injected:
+            # 清除尚未触发的异常
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self._target_id), None)
+
+    def arm(self):
+        """允许向执行线程注入异常，需在执行线程中调用"""
+        with self._lock:
+            self._armed = True
+
+    def disarm(self):
+        """禁止注入异常并清除尚未触发的异常，需在执行线程中调用"""
+        try:
+            with self._lock:
+                self._armed = False
+                self._clear_pending()
+        except ExecutionLimitExceeded:
+            pass
+
+    @contextlib.contextmanager
+    def armed_in(self, shell):
+        """仅在IPython执行用户代码（run_code）期间注入异常
+
+        避免异常在run_cell的记录历史、输出捕获的恢复等过程中触发，使shell及捕获的状态不一致。
+        shell没有run_code时（非IPython环境）在整个期间注入。
+        """
+        run_code = getattr(shell, "run_code", None)
+        if run_code is None:
+            self.arm()
+            try:
+                yield self
+            finally:
+                self.disarm()
+            return
+
+        async def _run_code(*args, **kwargs):
+            self.arm()
+            try:
+                return await run_code(*args, **kwargs)
+            finally:
+                self.disarm()
+
+        shadowed = "run_code" in vars(shell)
+        shell.run_code = _run_code
+        try:
+            yield self
+        finally:
+            if shadowed:
+                shell.run_code = run_code
+            else:
+                del shell.run_code
+
+    def _measure(self):
+        self.usage["wall_time"] = time.monotonic() - self._start_wall
+        self.usage["cpu_time"] = self._cpu_clock() - self._start_cpu
+        if self.max_memory:
+            self.usage["memory"] = max(self.usage["memory"], get_rss_bytes() - self._start_rss)
+
+    def check(self) -> Optional[str]:
+        """检查资源使用，返回超出的限制名称"""
+        self._measure()
+        if self.max_wall_time and self.usage["wall_time"] > self.max_wall_time:
+            return "wall_time"
+        if self.max_cpu_time and self.usage["cpu_time"] > self.max_cpu_time:
+            return "cpu_time"
+        if self.max_memory and self.usage["memory"] > self.max_memory:
+            return "memory"
+        return None
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            exceeded = self.check()
+            if exceeded:
+                with self._lock:
+                    if self._stopped.is_set():
+                        return
+                    if not self._armed:
+                        # 不在用户代码中时不中断，等待进入用户代码后再中断
+                        continue
+                    self.exceeded = exceeded
+                    self._injected = True
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_ulong(self._target_id), ctypes.py_object(ExecutionLimitExceeded)
+                    )
+                return
+
+    def format_exceeded(self) -> str:
+        """返回超限原因的描述"""
+        if self.exceeded == "wall_time":
+            return f"wall time {self.usage['wall_time']:.1f}s exceeded the limit of {self.max_wall_time:.1f}s"
+        if self.exceeded == "cpu_time":
+            return f"CPU time {self.usage['cpu_time']:.1f}s exceeded the limit of {self.max_cpu_time:.1f}s"
+        if self.exceeded == "memory":
+            return (
+                f"memory growth {self.usage['memory'] / 1024 / 1024:.1f}MB "
+                f"exceeded the limit of {self.max_memory / 1024 / 1024:.1f}MB"
+            )
+        return ""
+
+
+class ExecutionProfiler:
+    """采集代码执行期间的内存分配峰值（tracemalloc）及自身耗时最多的top_n个函数（cProfile）
+
+    两者都会明显拖慢被执行的代码，仅在需要时开启。
+    """
+
+    def __init__(self, top_n: int = 5):
+        self.top_n = top_n
+        self.peak_memory = 0
+        self.hotspots: list[str] = []
+        self._profiler = None
+        self._start_tracemalloc = False
+
+    def __enter__(self):
+        self._start_tracemalloc = not tracemalloc.is_tracing()
+        if self._start_tracemalloc:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        if self.top_n > 0:
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError:  # 已有其他profiler在运行
+                self._profiler = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._profiler is not None:
+            self._profiler.disable()
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        if self._start_tracemalloc:
+            tracemalloc.stop()
+        if self._profiler is not None:
+            self.hotspots = self.format_hotspots(pstats.Stats(self._profiler))
+
+    def format_hotspots(self, stats: pstats.Stats) -> list[str]:
+        entries = []
+        for (filename, lineno, func), (_, ncalls, tottime, cumtime, _) in stats.stats.items():  # type: ignore
+            if "_lsprof.Profiler" in func or filename == __file__:  # 跳过profiler自身
+                continue
+            entries.append((tottime, cumtime, ncalls, func, os.path.basename(filename), lineno))
+        entries.sort(reverse=True)
+        return [
+            f"{func} ({filename}:{lineno}) calls={ncalls} self={tottime:.3f}s total={cumtime:.3f}s"
+            if filename != "~"
+            else f"{func} calls={ncalls} self={tottime:.3f}s total={cumtime:.3f}s"
+            for tottime, cumtime, ncalls, func, filename, lineno in entries[: self.top_n]
+        ]
+
 
 def indent(text: str, indent: int = 4) -> str:
     return "\n".join(f"{' ' * indent}{line}" for line in text.split("\n"))
@@ -129,3 +480,167 @@ def set_env_capbilities(env_capbilities: EnvironmentCapbilities):
     global __env_capbilities
 
     __env_capbilities = env_capbilities
+
+
+def to_json(obj) -> str:
+
+    def _default(o):
+        if isinstance(o, BaseModel):
+            return o.model_dump()
+        if isinstance(o, Enum):
+            return o.value
+        return repr(o)
+
+    return json.dumps(obj, indent=2, ensure_ascii=False, default=_default)
+
+
+class TemplateRegistry:
+    """编译后Jinja模板的注册表
+
+    按模板源码哈希缓存编译结果（LRU），相同的include模板集合共享同一个Environment；
+    设置bytecode_cache_dir后编译出的字节码会写入磁盘，内核重启后可跳过编译。
+    """
+
+    SOURCE_PREFIX = "__source__/"
+
+    def __init__(self, max_size=256, max_environments=32, bytecode_cache_dir=None):
+        self.max_size = max_size
+        self.max_environments = max_environments
+        self.bytecode_cache_dir = bytecode_cache_dir
+        self._environments: OrderedDict[str, tuple[jinja2.Environment, dict]] = OrderedDict()
+        self._templates: OrderedDict[tuple[str, str], jinja2.Template] = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_size=None, max_environments=None, bytecode_cache_dir=None):
+        """更新注册表配置，字节码缓存目录变化时清空已编译的模板"""
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if max_environments is not None:
+                self.max_environments = max_environments
+            if bytecode_cache_dir is not None and (bytecode_cache_dir or None) != self.bytecode_cache_dir:
+                self.bytecode_cache_dir = bytecode_cache_dir or None
+                self.clear()
+            self._evict()
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _create_environment(self, mapping: dict) -> jinja2.Environment:
+        bytecode_cache = None
+        if self.bytecode_cache_dir:
+            os.makedirs(self.bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(self.bytecode_cache_dir)
+        env = jinja2.Environment(
+            loader=jinja2.DictLoader(mapping),
+            trim_blocks=True,
+            lstrip_blocks=True,
+            cache_size=self.max_size,
+            bytecode_cache=bytecode_cache,
+        )
+        env.filters["json"] = to_json
+        return env
+
+    def _get_environment(self, templates=None) -> tuple[str, jinja2.Environment, dict]:
+        env_key = self._hash(repr(sorted((templates or {}).items())))
+        if env_key in self._environments:
+            self._environments.move_to_end(env_key)
+            env, mapping = self._environments[env_key]
+        else:
+            mapping = dict(templates or {})
+            env = self._create_environment(mapping)
+            self._environments[env_key] = (env, mapping)
+        return env_key, env, mapping
+
+    def _evict(self):
+        while len(self._templates) > self.max_size:
+            (env_key, name), _ = self._templates.popitem(last=False)
+            if env_key in self._environments:
+                self._environments[env_key][1].pop(name, None)
+        while len(self._environments) > self.max_environments:
+            env_key, _ = self._environments.popitem(last=False)
+            for key in [key for key in self._templates if key[0] == env_key]:
+                del self._templates[key]
+
+    def get_environment(self, templates=None) -> jinja2.Environment:
+        """获取可include给定模板集合的共享Environment"""
+        with self._lock:
+            _, env, _ = self._get_environment(templates)
+            self._evict()
+            return env
+
+    def get_template(self, source: str, templates=None) -> jinja2.Template:
+        """获取模板源码对应的编译结果，templates为可被include的模板集合"""
+        with self._lock:
+            env_key, env, mapping = self._get_environment(templates)
+            name = self.SOURCE_PREFIX + self._hash(source)
+            key = (env_key, name)
+            if key in self._templates:
+                self.hits += 1
+                self._templates.move_to_end(key)
+                return self._templates[key]
+            self.misses += 1
+            mapping[name] = source
+            template = env.get_template(name)
+            self._templates[key] = template
+            self._evict()
+            return template
+
+    def render(self, source: str, templates=None, **kwargs) -> str:
+        return self.get_template(source, templates).render(**kwargs)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "templates": len(self._templates)}
+
+    def clear(self):
+        with self._lock:
+            self._environments.clear()
+            self._templates.clear()
+            self.hits = self.misses = 0
+
+
+_default_template_registry = TemplateRegistry()
+
+
+def get_template_registry() -> TemplateRegistry:
+    return _default_template_registry
+
+
+def _join_lines(value):
+    return "".join(value) if isinstance(value, list) else value
+
+
+def is_text_mimetype(mimetype: str) -> bool:
+    return mimetype.startswith("text/") or mimetype.endswith("json")
+
+
+def _lean_output(output: dict) -> dict:
+    if "text" in output:
+        output["text"] = _join_lines(output["text"])
+    if "data" in output:
+        output["data"] = {
+            mimetype: value if mimetype.endswith("json") else _join_lines(value)
+            for mimetype, value in output["data"].items()
+            if is_text_mimetype(mimetype)
+        }
+    return output
+
+
+def read_notebook(fp) -> dict:
+    """以只读方式快速读取Notebook文件，用于加载上下文
+
+    使用快速JSON解析，只保留单元格的source、metadata及文本类输出，跳过图片等二进制输出，不做格式校验，
+    也不转换为NotebookNode；Notebook不是v4格式时回退到nbformat.reads。需要完整内容或写回的场景应使用nbformat.read。
+    """
+    content = fp.read()
+    nb = fast_json.loads(content)
+    if nb.get("nbformat") != 4:
+        return nbformat.reads(content if isinstance(content, str) else content.decode("utf-8"), as_version=4)
+    for cell in nb.get("cells", []):
+        cell["source"] = _join_lines(cell.get("source", ""))
+        if "outputs" in cell:
+            cell["outputs"] = [_lean_output(output) for output in cell["outputs"]]
+    return nb
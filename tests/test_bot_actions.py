@@ -100,3 +100,137 @@ def test_request_user_reply(monkeypatch):
     replies = bot_actions.request_user_reply(prompts)
     assert len(replies) == 2
     assert replies[0].answer == "test"
+
+
+def test_action_reply_wakes_waiter():
+    dispatcher = bot_actions.ActionDispatcher()
+    action = bot_actions.ActionRequestUserConfirm()
+    reply_action = bot_actions.ActionRequestUserConfirm()
+    reply = bot_actions.ActionReply(reply_timestamp=time.time(), uuid=action.uuid, reply=reply_action)
+    timer = threading.Timer(0.05, dispatcher.put_action_reply, args=(reply,))
+    timer.start()
+    st = time.perf_counter()
+    assert dispatcher.get_action_reply(action, wait=True, timeout=5) == reply_action
+    assert time.perf_counter() - st < 1
+    assert dispatcher.action_replies[action.uuid].retrieved
+    dispatcher.close()
+
+
+def test_action_reply_timeout_and_cancel():
+    dispatcher = bot_actions.ActionDispatcher(reply_timeout=0.05)
+    action = bot_actions.ActionRequestUserConfirm()
+    assert dispatcher.get_action_reply(action) is None
+    assert not dispatcher._reply_futures
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(dispatcher.get_action_reply(action, timeout=5)))
+    waiter.start()
+    while not dispatcher._reply_futures:
+        time.sleep(0.01)
+    assert dispatcher.cancel_action_reply(action)
+    waiter.join(1)
+    assert results == [None]
+    dispatcher.close()
+    assert dispatcher.get_action_reply(action) is None
+
+
+def test_fetch_action_long_poll():
+    dispatcher = bot_actions.ActionDispatcher()
+    assert dispatcher.fetch_action() is None
+    threading.Timer(0.05, dispatcher.send_action, args=(bot_actions.ActionSetCellContent(),)).start()
+    assert dispatcher.fetch_action(timeout=5)["action"] == "set_cell_content"
+    threading.Timer(0.05, dispatcher.close).start()
+    st = time.perf_counter()
+    assert dispatcher.fetch_action(timeout=5) is None
+    assert dispatcher.fetch_action(timeout=5) is None
+    assert time.perf_counter() - st < 1
+
+
+def test_http_batch_fetch_and_reply():
+    import json
+    import urllib.request
+
+    get_env_capbilities().user_confirm = True
+    bot_actions.close_action_dispatcher()
+    dispatcher = bot_actions.get_action_dispatcher()
+    base_url = f"http://{dispatcher.host}:{dispatcher.port}"
+
+    def call(path, data=None):
+        body = json.dumps(data).encode() if data is not None else None
+        req = urllib.request.Request(base_url + path, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=5) as res:
+            return json.loads(res.read())
+
+    try:
+        # 长轮询期间其他请求不会被阻塞
+        polls = []
+        poller = threading.Thread(target=lambda: polls.append(call("/action_fetch?max=10&timeout=5")))
+        poller.start()
+        time.sleep(0.1)
+        assert call("/echo") == {"status": "OK"}
+        actions = [bot_actions.ActionSetCellContent() for _ in range(3)]
+        for action in actions:
+            dispatcher.send_action(action)
+        poller.join(5)
+        fetched = polls[0]["actions"] + call("/action_fetch?max=10").get("actions", [])
+        assert [a["uuid"] for a in fetched] == [a.uuid for a in actions]
+        assert call("/action_fetch?max=10") == {"status": "EMPTY"}
+
+        requests = [bot_actions.ActionRequestUserConfirm() for _ in range(2)]
+        replies = [{"uuid": r.uuid, "reply": bot_actions.ActionRequestUserConfirm().model_dump()} for r in requests]
+        result = call("/action_reply", replies + [{"uuid": "x", "reply": {"action": "nonexistent"}}])
+        assert [r["status"] for r in result["results"]] == ["OK", "OK", "ERROR"]
+        for r in requests:
+            assert dispatcher.get_action_reply(r, wait=False).action == "request_user_confirm"
+    finally:
+        bot_actions.close_action_dispatcher()
+        get_env_capbilities().user_confirm = False
+
+
+def test_action_fetch_ignores_timeout_without_threading_server(monkeypatch):
+    import json
+    import bottle
+
+    dispatcher = bot_actions.ActionDispatcher()
+    assert dispatcher.server is None
+    monkeypatch.setattr(bot_actions, "get_action_dispatcher", lambda: dispatcher)
+    bottle.request.bind({"QUERY_STRING": "timeout=5"})
+    st = time.perf_counter()
+    assert json.loads(bot_actions.action_fetch()) == {"status": "EMPTY"}
+    assert time.perf_counter() - st < 1
+
+
+def test_action_reply_store_eviction():
+    store = bot_actions.ActionReplyStore(retrieved_ttl=10, pending_ttl=100, max_size=3)
+    now = time.time()
+    for i in range(4):
+        reply = bot_actions.ActionReply(reply_timestamp=now, uuid=f"u{i}", reply=bot_actions.ActionSetCellContent())
+        store[reply.uuid] = reply
+    # 未取回的回复不会因max_size被淘汰
+    assert store.metrics() == {"pending": 4, "retrieved": 0, "evicted": 0}
+    assert store.retrieve("u0").retrieved
+    assert "u0" not in store and store.metrics()["evicted"] == 1
+    store.retrieve("u1")
+    assert store.get("u1").retrieved and len(store) == 3
+    store.prune(now + 50)
+    assert store.metrics() == {"pending": 2, "retrieved": 0, "evicted": 2}
+    store.prune(now + 200)
+    assert len(store) == 0 and store.get("u2") is None
+
+
+def test_register_action_class():
+    class ActionCustom(bot_actions.ActionBase):
+        action: str = "custom_action_for_test"
+
+    assert bot_actions.get_action_class("custom_action_for_test") is ActionCustom
+    assert bot_actions.get_action_class("ActionCustom") is ActionCustom
+
+    class ActionOverride(bot_actions.ActionSetCellContent):
+        pass
+
+    assert bot_actions.get_action_class("set_cell_content") is bot_actions.ActionSetCellContent
+    bot_actions.register_action_class(ActionOverride)
+    try:
+        assert bot_actions.get_action_class("set_cell_content") is ActionOverride
+    finally:
+        bot_actions.register_action_class(bot_actions.ActionSetCellContent)
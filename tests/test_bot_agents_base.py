@@ -224,3 +224,148 @@ def test_agent_factory(monkeypatch, notebook_context):
     # Test with string
     # agent = factory("DummyChatAgent")
     # assert isinstance(agent, DummyChatAgent)
+
+
+def test_cell_context_cache_hits_and_misses():
+    from jupyter_agent.bot_agents.base import CellContextCache
+
+    class Cell:
+        def __init__(self, source):
+            self.source = source
+            self.type = "code"
+            self.is_code_context = True
+            self.is_task_context = False
+            self.cell_output = self.cell_result = self.cell_error = ""
+            self.content_hash = source
+
+    cache = CellContextCache()
+    first = cache.render(Cell("x = 1"))
+    assert "x = 1" in first
+    assert cache.render(Cell("x = 1")) == first
+    cache.render(Cell("x = 2"))
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["rendered_bytes"] > 0
+
+
+def test_cell_context_cache_keys_on_important_infos_content():
+    from jupyter_agent.bot_agents.base import CellContextCache
+
+    cache = CellContextCache(template="{{ cell.source }} {{ merged_important_infos | tojson }}")
+    cell = types.SimpleNamespace(source="x = 1", content_hash="h1")
+    assert cache.render(cell, {"a": 1}).endswith('{"a": 1}')
+    assert cache.render(cell, {"a": 2}).endswith('{"a": 2}')
+    assert cache.render(cell, {"a": 1}).endswith('{"a": 1}')
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_cell_context_cache_concurrent_render():
+    from concurrent.futures import ThreadPoolExecutor
+    from jupyter_agent.bot_agents.base import CellContextCache
+
+    cell = types.SimpleNamespace(
+        type="code", is_code_context=True, is_task_context=False, cell_output="", cell_result="", cell_error=""
+    )
+    cache = CellContextCache(max_size=8)
+
+    def _render(idx):
+        source = "x = {}".format(idx % 16)
+        return source in cache.render(types.SimpleNamespace(**vars(cell), source=source, content_hash=source))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert all(executor.map(_render, range(2000)))
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] == 2000
+    assert len(cache.fragments) <= 8
+
+
+def test_context_assembler_keeps_recent_and_summarizes_old_tasks():
+    from jupyter_agent.bot_agents.base import ContextAssembler, SummarizedCellContext
+
+    class Cell:
+        def __init__(self, type, source, subject=""):
+            self.type = type
+            self.source = source
+            self.subject = subject
+            self.content_hash = None
+
+    class Cache:
+        def render(self, cell):
+            return cell.subject + cell.source
+
+    cells = [
+        Cell("planning", "p" * 40),
+        Cell("task", "t" * 400, subject="old task"),
+        Cell("code", "c" * 400),
+        Cell("task", "t" * 40, subject="new task"),
+    ]
+    assembler = ContextAssembler(budget=60, token_counter=len, cell_context_cache=Cache())
+    selected = assembler.select_cells(cells)
+    assert [cell.subject for cell in selected] == ["", "old task", "new task"]
+    assert all(isinstance(cell, SummarizedCellContext) for cell in selected[1:])
+    assert selected[2].source == ""
+    assembler.budget = 200
+    selected = assembler.select_cells(cells)
+    assert selected[0] is cells[0] and selected[-1] is cells[-1]
+    assert isinstance(selected[1], SummarizedCellContext)
+    assert ContextAssembler(0).select_cells(cells) is cells
+    # 固定部分占用的token从预算中扣除
+    assembler.budget = 500
+    assert cells[2] in assembler.select_cells(cells)
+    assembler.reserved_tokens = 40
+    assert cells[2] not in assembler.select_cells(cells)
+
+
+def test_context_assembler_prefers_relevant_cells():
+    from jupyter_agent.bot_agents.base import ContextAssembler
+
+    class Cell:
+        def __init__(self, source):
+            self.type = "code"
+            self.source = source
+            self.content_hash = None
+
+    class Cache:
+        def render(self, cell):
+            return cell.source
+
+    cells = [
+        Cell("sales = load_sales()  " + "x" * 40),
+        Cell("print('hello world')  " + "y" * 40),
+        Cell("plot(weather)  " + "z" * 40),
+    ]
+    assembler = ContextAssembler(budget=130, token_counter=len, cell_context_cache=Cache())
+    assert assembler.select_cells(cells) == cells[1:]
+    assert assembler.select_cells(cells, query="Summarize the sales by month") == [cells[0], cells[2]]
+    assert ContextAssembler.words("统计销售额 df_sales") == {"统计", "计销", "销售", "售额", "df_sales"}
+
+
+def test_log_prompt_tokens_is_lazy(base_chat_agent, monkeypatch):
+    from jupyter_agent.bot_agents import base
+    from jupyter_agent.utils import get_template_registry
+
+    logged = []
+    monkeypatch.setattr(base, "_D", lambda msg, *args: logged.append(msg))
+    contexts = base_chat_agent.prepare_contexts()
+    assert contexts["blocks"]
+    with patch.object(get_template_registry(), "render", side_effect=AssertionError("rendered eagerly")):
+        base_chat_agent.log_prompt_tokens(contexts)
+    assert len(logged) == 1 and callable(logged[0])
+    assert logged[0]().startswith("Prompt tokens:")
+
+
+def test_prepare_contexts_reserves_fixed_prompt_tokens(base_chat_agent, monkeypatch):
+    from jupyter_agent.bot_agents import base
+
+    budgets = []
+
+    def select_cells(self, cells, query=""):
+        budgets.append((self.budget, self.reserved_tokens))
+        return cells
+
+    monkeypatch.setattr(base.ContextAssembler, "select_cells", select_cells)
+    base_chat_agent.context_budget = 10000
+    contexts = base_chat_agent.prepare_contexts()
+    assert contexts["cells"] == base_chat_agent.cells
+    ((budget, reserved),) = budgets
+    assert budget == 10000 and 0 < reserved == base_chat_agent.measure_fixed_tokens(contexts)
@@ -0,0 +1,285 @@
+import time
+import types
+import pytest
+
+from jupyter_agent import bot_contexts
+from jupyter_agent.bot_agents import code_executor
+from jupyter_agent.utils import HeadTailStringIO, TeeOutputCapture, ExecutionWatchdog, ExecutionLimitExceeded
+
+
+def test_head_tail_string_io_keeps_head_and_tail(tmp_path):
+    buffer = HeadTailStringIO(head_size=10, tail_size=10, spill_dir=str(tmp_path))
+    lines = ["line{:04d}\n".format(i) for i in range(1000)]
+    for line in lines:
+        buffer.write(line)
+    buffer.close()
+    value = buffer.getvalue()
+    assert value.startswith("line0000\nl") and value.endswith("\nline0999\n")
+    assert buffer.total_chars == 9000
+    assert buffer.dropped_chars == 9000 - 20
+    assert buffer.dropped_lines == 997
+    assert len(buffer) == 20
+    assert "8980 chars, 997 lines dropped" in value and buffer.spill_path in value
+    assert open(buffer.spill_path).read() == "".join(lines)
+
+
+def test_head_tail_string_io_small_output():
+    buffer = HeadTailStringIO(head_size=10, tail_size=10)
+    buffer.write("hello\n")
+    buffer.write("world, more")
+    assert buffer.getvalue() == "hello\nworld, more"
+    assert buffer.dropped_chars == 0
+
+
+def test_tee_output_capture_bounded(capsys):
+    with TeeOutputCapture(max_size=100, display=False) as captured:
+        for i in range(10000):
+            print(i)
+    assert len(captured.stdout) < 200
+    assert captured.stdout.startswith("0\n1\n") and captured.stdout.endswith("9998\n9999\n")
+    assert "9999" in capsys.readouterr().out
+
+
+def test_code_executor_bounds_cell_output(monkeypatch):
+    class FakeShell:
+        def run_cell(self, source):
+            exec(source, {})
+            return types.SimpleNamespace(success=True, result=None)
+
+    monkeypatch.setattr(code_executor, "get_ipython", lambda: FakeShell())
+    monkeypatch.setattr(bot_contexts.CodeCellContext, "max_output_size", 1024)
+    source = "for i in range(100000):\n    print('row', i)"
+    task = bot_contexts.CodeCellContext(0, {"cell_type": "code", "source": source, "metadata": {}, "outputs": []})
+    executor = code_executor.CodeExecutor(types.SimpleNamespace(cur_task=task))
+    assert executor() == (False, True)
+    assert task.cell_output.startswith("Stdout:\n\nrow 0\n")
+    assert "lines dropped" in task.cell_output
+    assert task.cell_output.rstrip().endswith("row 99999")
+
+
+class FakeShell:
+    def __init__(self):
+        self.user_ns = {}
+
+    def run_cell(self, source):
+        try:
+            exec(source, {})
+        except BaseException as e:
+            return types.SimpleNamespace(success=False, result=None, error_before_exec=None, error_in_exec=e)
+        return types.SimpleNamespace(success=True, result=None)
+
+    def _format_exception_for_storage(self, error):
+        return {"traceback": ["{}: {}".format(type(error).__name__, error)]}
+
+
+def make_executor(monkeypatch, source):
+    monkeypatch.setattr(code_executor, "get_ipython", lambda: FakeShell())
+    task = bot_contexts.CodeCellContext(0, {"cell_type": "code", "source": source, "metadata": {}, "outputs": []})
+    return task, code_executor.CodeExecutor(types.SimpleNamespace(cur_task=task))
+
+
+def test_execution_watchdog_interrupts_slow_loop():
+    start = time.monotonic()
+    with ExecutionWatchdog(max_wall_time=0.2, interval=0.02) as watchdog:
+        try:
+            while True:
+                pass
+        except Exception:  # 不会吞掉超限异常
+            pass
+    assert watchdog.exceeded == "wall_time"
+    assert time.monotonic() - start < 2
+
+    with ExecutionWatchdog(max_wall_time=5) as watchdog:
+        sum(range(1000))
+    assert watchdog.exceeded is None and watchdog.usage["wall_time"] < 5
+
+
+def test_execution_watchdog_interrupts_only_inside_run_code():
+    class Shell:
+        def __init__(self):
+            self.ran = False
+
+        async def run_code(self, seconds):
+            self.ran = True
+            start = time.monotonic()
+            while time.monotonic() - start < seconds:
+                pass
+
+        def run_cell(self, seconds):
+            # 模拟run_cell在用户代码前后的记录历史等操作
+            time.sleep(0.1)
+            coro = self.run_code(seconds)
+            try:
+                coro.send(None)
+            except StopIteration:
+                pass
+            time.sleep(0.1)
+            return "done"
+
+    shell = Shell()
+    with ExecutionWatchdog(max_wall_time=0.05, interval=0.01, armed=False) as watchdog:
+        with watchdog.armed_in(shell):
+            assert shell.run_cell(0) == "done"
+    assert shell.ran and watchdog.exceeded is None and "run_code" not in vars(shell)
+
+    with ExecutionWatchdog(max_wall_time=0.2, interval=0.01, armed=False) as watchdog:
+        with watchdog.armed_in(shell):
+            with pytest.raises(ExecutionLimitExceeded):
+                shell.run_cell(5)
+    assert watchdog.exceeded == "wall_time"
+
+
+def test_code_executor_reports_exceeded_limit(monkeypatch):
+    task, executor = make_executor(monkeypatch, "while True:\n    x = [i * i for i in range(1000)]")
+    monkeypatch.setattr(code_executor.CodeExecutor, "MAX_EXEC_CPU_TIME", 0.2)
+    assert executor() == (True, False)
+    assert task.cell_error.startswith("ExecutionLimitExceeded: The code was interrupted because its CPU time")
+    assert "vectorize" in task.cell_error
+
+
+def test_code_executor_collects_profile(monkeypatch):
+    source = "def slow(n):\n    return sum(i * i for i in range(n))\n\nvalues = [slow(10000) for _ in range(20)]"
+    task, executor = make_executor(monkeypatch, source)
+    monkeypatch.setattr(code_executor.CodeExecutor, "PROFILE", True)
+    assert executor() == (False, True)
+    assert set(executor.profile) == {"wall_time", "cpu_time", "peak_memory_mb", "hotspots"}
+    assert executor.profile["wall_time"] > 0
+    assert len(executor.profile["hotspots"]) <= 5
+    assert any(line.startswith("<genexpr>") for line in executor.profile["hotspots"])
+
+
+def test_task_data_includes_exec_profile():
+    from jupyter_agent.bot_agents.base import _TASK_DATA
+    from jupyter_agent.utils import get_template_registry
+
+    task = {"subject": "s", "coding_prompt": "c", "source": "x = 1", "exec_profile": {"wall_time": 12.5}}
+    text = get_template_registry().render(_TASK_DATA, {})
+    assert "性能数据" not in text
+    text = get_template_registry().render(_TASK_DATA, {}, task=task)
+    assert "### 当前代码执行的性能数据：" in text and '"wall_time": 12.5' in text
+
+
+class NamespaceShell(FakeShell):
+    def __init__(self):
+        self.user_ns = {}
+
+    def run_cell(self, source):
+        try:
+            exec(source, self.user_ns)
+        except BaseException as e:
+            return types.SimpleNamespace(success=False, result=None, error_before_exec=None, error_in_exec=e)
+        return types.SimpleNamespace(success=True, result=None)
+
+
+def make_optimizer(monkeypatch, source, user_ns=None):
+    from jupyter_agent.bot_agents import code_optimizer
+
+    shell = NamespaceShell()
+    monkeypatch.setattr(code_executor, "get_ipython", lambda: shell)
+    monkeypatch.setattr(code_optimizer, "get_ipython", lambda: shell)
+    monkeypatch.setattr(code_executor.CodeExecutor, "OPTIMIZE_THRESHOLD", 1e-9)
+    shell.user_ns.update(user_ns or {})
+    task = bot_contexts.AgentCellContext(0, {"cell_type": "code", "source": "%%bot\n" + source, "metadata": {}})
+    task.agent_stage = "executing"
+    context = types.SimpleNamespace(cur_task=task, cells=[])
+    assert code_executor.CodeExecutor(context)() == (False, code_executor.CodeExecutorState.SLOW)
+    task.set_data("exec_profile", {"wall_time": 10.0})
+    optimizer = code_optimizer.CodeOptimizerAgent(context, base_url="http://test", api_key="key", model_name="m")
+    return shell, task, optimizer
+
+
+def test_code_executor_reports_slow_execution(monkeypatch):
+    task, executor = make_executor(monkeypatch, "import time\ntime.sleep(0.05)")
+    task.agent_stage = "executing"
+    monkeypatch.setattr(code_executor.CodeExecutor, "OPTIMIZE_THRESHOLD", 0.01)
+    assert executor() == (False, code_executor.CodeExecutorState.SLOW)
+    assert executor.profile["wall_time"] >= 0.05
+    assert task.exec_snapshot == {"time": code_executor.MISSING}
+    source = code_executor.OPTIMIZED_CODE_HEADER + "\nimport time\ntime.sleep(0.05)"
+    task, executor = make_executor(monkeypatch, source)
+    task.agent_stage = "executing"
+    assert executor() == (False, True)
+
+
+def test_code_executor_snapshots_only_when_optimizing_follows(monkeypatch):
+    monkeypatch.setattr(code_executor.CodeExecutor, "OPTIMIZE_THRESHOLD", 0.01)
+    task, executor = make_executor(monkeypatch, "import time\ntime.sleep(0.05)")
+    task.agent_stage = "completed"
+    monkeypatch.setattr(executor, "take_snapshot", lambda ipython: pytest.fail("snapshot taken"))
+    assert executor() == (False, True) and task.exec_snapshot is None
+    # 变量过大时不拷贝，也不进入优化阶段
+    monkeypatch.setattr(code_executor.CodeExecutor, "SNAPSHOT_MAX_SIZE", 1)
+    shell = NamespaceShell()
+    shell.user_ns["data"] = bytes(2 * 1024 * 1024)
+    monkeypatch.setattr(code_executor, "get_ipython", lambda: shell)
+    source = "import time\ntime.sleep(0.05)\nsize = len(data)"
+    task = bot_contexts.CodeCellContext(0, {"cell_type": "code", "source": source, "metadata": {}, "outputs": []})
+    task.agent_stage = "executing"
+    task.exec_snapshot = {"stale": 1}
+    assert code_executor.CodeExecutor(types.SimpleNamespace(cur_task=task))() == (False, True)
+    assert task.exec_snapshot is None
+
+
+def test_code_optimizer_keeps_faster_matching_code(monkeypatch):
+    shell, task, optimizer = make_optimizer(monkeypatch, "total = 0\nfor i in range(10):\n    total += i\nprint(total)")
+    assert optimizer.on_reply("total = sum(range(10))\nprint(total)") == (False, True)
+    assert task.source.startswith(code_executor.OPTIMIZED_CODE_HEADER)
+    assert task.exec_profile["wall_time"] < 10.0
+    assert shell.user_ns["total"] == 45
+
+
+def test_code_optimizer_rejects_different_output(monkeypatch):
+    shell, task, optimizer = make_optimizer(monkeypatch, "total = sum(range(10))\nprint(total)")
+    source = task.source
+    assert optimizer.on_reply("total = 0\nbroken = True\nprint(total)") == (False, False)
+    assert task.source == source
+    assert task.cell_output.startswith("Stdout:\n\n45")
+    assert task.exec_profile == {"wall_time": 10.0}
+    assert shell.user_ns["total"] == 45 and "broken" not in shell.user_ns
+
+
+def test_code_optimizer_replays_from_pre_execution_state(monkeypatch):
+    source = "data.append(1)\ncount += 1\nprint(count, len(data))"
+    shell, task, optimizer = make_optimizer(monkeypatch, source, user_ns={"data": [], "count": 0, "_": "keep"})
+    assert optimizer.on_reply("data.append(1)\ncount += 1\nprint(count, len(data))") == (False, True)
+    assert shell.user_ns["count"] == 1 and shell.user_ns["data"] == [1] and shell.user_ns["_"] == "keep"
+    assert task.exec_snapshot is None
+    # 放弃改写时恢复原代码执行后的变量，被改写代码原地修改的只是快照中的拷贝
+    shell, task, optimizer = make_optimizer(monkeypatch, source, user_ns={"data": [], "count": 0})
+    data = shell.user_ns["data"]
+    assert optimizer.on_reply("data.append(2)\ncount += 5\nprint(count)") == (False, False)
+    assert shell.user_ns["count"] == 1 and shell.user_ns["data"] is data and data == [1]
+
+
+def test_code_executor_holds_pending_output_renders(monkeypatch):
+    import threading
+    from jupyter_agent import bot_outputs
+
+    running = threading.Event()
+    updates = []
+
+    class Handler:
+        def update(self, *args, **kwargs):
+            updates.append(running.is_set())
+
+    class BusyShell(FakeShell):
+        def run_cell(self, source):
+            running.set()
+            # 其他线程在执行期间输出日志，触发后台的合并刷新
+            threading.Thread(target=output.log, args=("during execution",)).start()
+            time.sleep(0.3)
+            running.clear()
+            return types.SimpleNamespace(success=True, result=None)
+
+    monkeypatch.setattr(bot_outputs, "display", lambda *args, **kwargs: Handler())
+    output = bot_outputs.AgentOutput()
+    output.display_interval = 0.05
+    monkeypatch.setattr(bot_outputs, "get_output", lambda: output)
+    output.display()
+    output.log("pending before execution")
+    monkeypatch.setattr(code_executor, "get_ipython", lambda: BusyShell())
+    task = bot_contexts.CodeCellContext(0, {"cell_type": "code", "source": "x = 1", "metadata": {}, "outputs": []})
+    assert code_executor.CodeExecutor(types.SimpleNamespace(cur_task=task))() == (False, True)
+    time.sleep(0.2)
+    assert updates and True not in updates
+    assert len(updates) >= 2 and "during execution" in output.content
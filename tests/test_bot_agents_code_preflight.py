@@ -0,0 +1,71 @@
+import types
+
+from jupyter_agent import bot_contexts
+from jupyter_agent.bot_agents import code_preflight
+from jupyter_agent.bot_flows.task_executor_v3 import TaskExecutorFlowV3, TaskStage
+
+
+def make_checker(monkeypatch, source, cells=(), user_ns=None):
+    shell = types.SimpleNamespace(user_ns=user_ns or {})
+    monkeypatch.setattr(code_preflight, "get_ipython", lambda: shell)
+    task = bot_contexts.AgentCellContext(
+        len(cells), {"cell_type": "code", "source": "%%bot\n" + source, "metadata": {}}
+    )
+    cells = [
+        bot_contexts.CellContext.from_cell(idx, {"cell_type": "code", "source": cell, "metadata": {}, "outputs": []})
+        for idx, cell in enumerate(cells)
+    ]
+    context = types.SimpleNamespace(cur_task=task, cells=cells + [task])
+    return task, code_preflight.CodePreflightChecker(context)
+
+
+def test_preflight_adds_missing_imports(monkeypatch):
+    source = "# Generated by Jupyter Agent (Coder)\n%matplotlib inline\nprint(math.sqrt(np.mean([1, 4])), df, x)"
+    task, checker = make_checker(monkeypatch, source, cells=["x = 1\nfor item in []:\n    pass"], user_ns={"df": 1})
+    assert checker() == (False, True)
+    assert task.source.split("\n")[:3] == ["# Generated by Jupyter Agent (Coder)", "import math", "import numpy as np"]
+    assert checker.saved_debug_loops == 1
+
+
+def test_preflight_leaves_unknown_names(monkeypatch):
+    task, checker = make_checker(monkeypatch, "def f(a, *args):\n    return a + unknown_name\nprint(f(1), datetime)")
+    source = task.source
+    assert checker() == (False, True)
+    assert task.source == source and checker.saved_debug_loops == 0
+
+
+def test_preflight_routes_syntax_errors_to_debugging(monkeypatch):
+    task, checker = make_checker(monkeypatch, "print(1\n")
+    assert checker() == (True, False)
+    assert task.cell_error.startswith("SyntaxError:")
+    flow = TaskExecutorFlowV3.__new__(TaskExecutorFlowV3)
+    flow.stage_nodes = {}
+    flow.prepare_stage_nodes()
+    assert flow.get_next_stage(TaskStage.CODING, False, "continue") == TaskStage.DEBUGGING
+    assert flow.get_next_stage(TaskStage.DEBUGGING, True, "continue") == TaskStage.EXECUTING
+
+
+def test_preflight_only_imports_allowlisted_stdlib(monkeypatch):
+    task, checker = make_checker(monkeypatch, "print(json.dumps(copy), this, string)")
+    assert checker() == (False, True)
+    assert task.source.split("\n")[0] == "import json"
+    assert "import copy" not in task.source and "import this" not in task.source
+
+
+def test_code_generator_runs_preflight_in_its_stage(monkeypatch):
+    from jupyter_agent.bot_agents.code_generator import CodeGeneratorAgent
+    from jupyter_agent.bot_agents.code_debuger import CodeDebugerAgent
+
+    task, checker = make_checker(monkeypatch, "pass")
+    kwargs = {"base_url": "http://test", "api_key": "key", "model_name": "m"}
+    generator = CodeGeneratorAgent(checker.notebook_context, **kwargs)
+    assert generator.on_reply("print(math.pi)") == (False, True)
+    assert "import math" in task.source and generator.saved_debug_loops == 1
+    debugger = CodeDebugerAgent(checker.notebook_context, **kwargs)
+    assert debugger.on_reply("print(1") == (True, False)
+    assert task.cell_error.startswith("SyntaxError:") and debugger.saved_debug_loops == 0
+    flow = TaskExecutorFlowV3.__new__(TaskExecutorFlowV3)
+    flow.stage_nodes = {}
+    flow.prepare_stage_nodes()
+    assert flow.stage_nodes[TaskStage.CODING].agents is CodeGeneratorAgent
+    assert flow.stage_nodes[TaskStage.DEBUGGING].agents is CodeDebugerAgent
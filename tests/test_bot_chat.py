@@ -18,6 +18,8 @@ def patch_loggers(monkeypatch):
     monkeypatch.setattr(bot_chat, "_F", DummyLogger())
     monkeypatch.setattr(bot_chat, "_B", DummyLogger())
     monkeypatch.setattr(bot_chat, "_M", DummyLogger())
+    yield
+    bot_chat.close_client_pool()
 
 
 def test_chatmessages_add_and_get():
@@ -48,6 +50,31 @@ def test_chatmessages_clear():
     assert cm.get() == []
 
 
+def test_chatmessages_share_compiled_templates():
+    from jupyter_agent.utils import TemplateRegistry
+
+    registry = TemplateRegistry()
+    with patch.object(bot_chat, "get_template_registry", return_value=registry):
+        for name in ("Alice", "Bob"):
+            cm = bot_chat.ChatMessages(contexts={"name": name}, templates={"GREETING": "Hello, {{ name }}!"})
+            cm.add("{% include 'GREETING' %} {{ {'a': 1} | json }}")
+            assert cm.get()[0]["content"][0]["text"].startswith("Hello, {}!".format(name))
+        assert cm.jinja_env is registry.get_environment({"GREETING": "Hello, {{ name }}!"})
+    assert registry.stats() == {"hits": 1, "misses": 1, "templates": 1}
+
+
+def test_template_registry_lru_and_bytecode_cache(tmp_path):
+    from jupyter_agent.utils import TemplateRegistry
+
+    registry = TemplateRegistry(max_size=2, bytecode_cache_dir=str(tmp_path))
+    for i in range(3):
+        assert registry.render("{{ x }}-%d" % i, x="v") == "v-%d" % i
+    assert registry.stats()["templates"] == 2
+    assert list(tmp_path.iterdir())
+    registry.clear()
+    assert registry.render("{{ x }}-0", x="v") == "v-0"
+
+
 def test_chatmessages_add_unsupported_content_type():
     cm = bot_chat.ChatMessages()
     with pytest.raises(NotImplementedError):
@@ -124,3 +151,238 @@ def test_botchat_chat_no_response(mock_openai):
     messages = [{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]
     result = bc.chat(messages)
     assert result == []
+
+
+@patch("openai.OpenAI")
+def test_client_pool_reuses_client(mock_openai):
+    pool = bot_chat.ChatClientPool()
+    c1 = pool.get_client("http://test", "key")
+    c2 = pool.get_client("http://test", "key")
+    c3 = pool.get_client("http://other", "key")
+    assert c1 is c2
+    assert mock_openai.call_count == 2
+    assert len(pool) == 2
+    pool.close()
+    assert len(pool) == 0
+
+
+@patch("openai.OpenAI")
+def test_client_pool_evicts_idle_clients(mock_openai):
+    pool = bot_chat.ChatClientPool(idle_timeout=10)
+    client = pool.get_client("http://test", "key")
+    pool._clients[("http://test", "key", None)][1] -= 20
+    pool.evict_idle()
+    assert len(pool) == 0
+    client.close.assert_called_once()
+
+
+@patch("openai.OpenAI")
+def test_client_pool_keeps_checked_out_clients_open(mock_openai):
+    mock_openai.side_effect = lambda **kwargs: MagicMock()
+    pool = bot_chat.ChatClientPool(idle_timeout=10)
+    with pool.checkout("http://test", "key") as client:
+        pool._clients[("http://test", "key", None)][1] -= 20
+        pool.evict_idle()
+        assert len(pool) == 1
+        with pool.checkout("http://test", "key") as other:
+            assert other is client
+        pool.configure(max_connections=4)
+        assert len(pool) == 0
+        client.close.assert_not_called()
+        assert pool.get_client("http://test", "key") is not client
+    client.close.assert_called_once()
+    with pool.checkout("http://test", "key") as client:
+        pass
+    client.close.assert_not_called()
+    pool.close()
+    client.close.assert_called_once()
+
+
+@patch("openai.OpenAI")
+def test_client_pool_configure_accepts_zero(mock_openai):
+    pool = bot_chat.ChatClientPool(idle_timeout=10)
+    pool.configure(keepalive_expiry=0, idle_timeout=0)
+    assert pool.keepalive_expiry == 0 and pool.idle_timeout == 0
+    pool.configure(max_connections=4)
+    assert pool.max_connections == 4 and pool.keepalive_expiry == 0
+    pool.get_client("http://test", "key")
+    pool._clients[("http://test", "key", None)][1] -= 10000
+    pool.evict_idle()
+    assert len(pool) == 1
+
+
+@patch("openai.OpenAI")
+def test_botchat_chat_uses_pooled_client(mock_openai):
+    mock_client = MagicMock()
+    mock_choice = MagicMock()
+    mock_choice.message.content = "Hello"
+    mock_client.chat.completions.create.return_value.choices = [mock_choice]
+    mock_openai.return_value = mock_client
+
+    bc = bot_chat.BotChat("http://test", "key", "gpt-4")
+    messages = [{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]
+    bc.chat(messages)
+    bc.chat(messages)
+    assert mock_openai.call_count == 1
+    assert mock_client.chat.completions.create.call_count == 2
+
+
+def _split_chunks(text, size):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 1000])
+def test_botchat_parse_reply_stream_matches_full_parse(size):
+    bc = bot_chat.BotChat("http://test", "key", "gpt-4")
+    reply = (
+        "<think>step <think>inner</think> done</think>Intro text\n"
+        "```python\nprint('hi')\n```\n"
+        '{"a": 1}\n'
+        "```json\n{\"b\": 2}\n```\n"
+        "```\nfenced ```sql\nselect 1\n``` tail\n```\n"
+        "Bye ``inline`` </think> end ```python\nunclosed"
+    )
+    expected = list(bc.parse_reply(reply, ret_think_block=True))
+    result = list(bc.parse_reply_stream(_split_chunks(reply, size), ret_think_block=True))
+    assert result == expected
+
+
+def test_reply_tokenizer_emits_blocks_on_close_delimiter():
+    tokenizer = bot_chat.ReplyTokenizer()
+    assert tokenizer.feed("text ```js") == []
+    blocks = tokenizer.feed("on\n{}\n`")
+    assert blocks == [{"type": "text", "content": "text "}]
+    blocks = tokenizer.feed("``")
+    assert blocks == []
+    blocks = tokenizer.feed("\n")
+    assert blocks == [{"type": "code", "lang": "json", "content": "\n{}\n", "raw": "```json\n{}\n```"}]
+    assert tokenizer.close() == [{"type": "text", "content": "\n"}]
+
+
+def _stream_chunk(content):
+    chunk = MagicMock()
+    chunk.choices[0].delta.content = content
+    return chunk
+
+
+@patch("openai.OpenAI")
+def test_botchat_chat_stream_stops_early(mock_openai):
+    mock_client = MagicMock()
+    mock_stream = MagicMock()
+    consumed = []
+
+    def _iter():
+        for content in ["<think>hmm</think>", "```json\n", '{"a": 1}\n', "```", "\nmore text", " and more"]:
+            consumed.append(content)
+            yield _stream_chunk(content)
+
+    mock_stream.__iter__.side_effect = _iter
+    mock_client.chat.completions.create.return_value = mock_stream
+    mock_openai.return_value = mock_client
+
+    bc = bot_chat.BotChat("http://test", "key", "gpt-4", stream=True)
+    messages = [{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]
+    result = bc.chat(messages, stop_when=lambda replies: any(r.get("lang") == "json" for r in replies))
+    assert result == [{"type": "code", "lang": "json", "content": '\n{"a": 1}\n', "raw": '```json\n{"a": 1}\n```'}]
+    assert mock_client.chat.completions.create.call_args.kwargs["stream"] is True
+    mock_stream.close.assert_called_once()
+    assert " and more" not in consumed
+
+
+@patch("openai.OpenAI")
+def test_botchat_chat_stream_stopped_early_is_not_cached(mock_openai, tmp_path, monkeypatch):
+    mock_client = MagicMock()
+
+    def _create(**kwargs):
+        stream = MagicMock()
+        contents = ["```json\n", '{"a": 1}\n', "```", "\nmore"]
+        stream.__iter__.return_value = iter([_stream_chunk(content) for content in contents])
+        return stream
+
+    mock_client.chat.completions.create.side_effect = _create
+    mock_openai.return_value = mock_client
+    cache = bot_chat.ResponseCache(cache_dir=str(tmp_path), mode="readwrite")
+    monkeypatch.setattr(bot_chat, "get_response_cache", lambda: cache)
+
+    bc = bot_chat.BotChat("http://test", "key", "gpt-4", stream=True)
+    messages = [{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]
+    bc.chat(messages, stop_when=lambda replies: any(r.get("lang") == "json" for r in replies))
+    assert cache.stats()["writes"] == 0
+    result = bc.chat(messages)
+    assert result[-1]["content"] == "\nmore" and cache.stats()["writes"] == 1
+    assert mock_client.chat.completions.create.call_count == 2
+
+
+@patch("openai.OpenAI")
+def test_botchat_chat_response_cache_modes(mock_openai, tmp_path, monkeypatch):
+    mock_client = MagicMock()
+    mock_choice = MagicMock()
+    mock_choice.message.content = "Hello, world!"
+    mock_client.chat.completions.create.return_value.choices = [mock_choice]
+    mock_openai.return_value = mock_client
+    cache = bot_chat.ResponseCache(cache_dir=str(tmp_path), mode="readwrite")
+    monkeypatch.setattr(bot_chat, "get_response_cache", lambda: cache)
+
+    bc = bot_chat.BotChat("http://test", "key", "gpt-4")
+    first = bc.chat([{"role": "user", "content": "Hi"}])
+    second = bc.chat([{"role": "user", "content": "Hi  \r\n"}])
+    assert first == second
+    assert mock_client.chat.completions.create.call_count == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["writes"] == 1
+
+    cache.configure(mode="replay")
+    with pytest.raises(bot_chat.ResponseCacheMiss):
+        bc.chat([{"role": "user", "content": "Other"}])
+    assert mock_client.chat.completions.create.call_count == 1
+
+    cache.configure(mode="record")
+    bc.chat([{"role": "user", "content": "Hi"}])
+    assert mock_client.chat.completions.create.call_count == 2
+
+
+def test_response_cache_ttl_and_eviction(tmp_path):
+    cache = bot_chat.ResponseCache(cache_dir=str(tmp_path), mode="readwrite", ttl=60, max_size=0)
+    cache.put("a" * 64, "reply")
+    assert cache.get("a" * 64) == "reply"
+    cache.ttl = 1e-9
+    assert cache.get("a" * 64) is None
+    assert cache.stats()["expired"] == 1
+
+    cache = bot_chat.ResponseCache(cache_dir=str(tmp_path), mode="readwrite", ttl=0, max_size=300)
+    for key in ("b", "c", "d"):
+        cache.put(key * 64, "x" * 100)
+    assert cache.get("b" * 64) is None
+    assert cache.get("d" * 64) == "x" * 100
+    assert cache.stats()["evictions"] >= 1
+
+
+def test_response_cache_scans_only_when_over_size(tmp_path, monkeypatch):
+    cache = bot_chat.ResponseCache(cache_dir=str(tmp_path), mode="readwrite", ttl=0, max_size=10000)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+    for i in range(20):
+        cache.put("{:064x}".format(i), "x" * 100)
+    # 首次写入时扫描得到总大小，之后按写入的大小累加
+    assert len(scans) == 1
+    for i in range(20, 100):
+        cache.put("{:064x}".format(i), "x" * 100)
+    assert len(scans) > 1 and cache.stats()["evictions"] > 0
+    total = sum(f.stat().st_size for f in tmp_path.rglob("*.json"))
+    assert total <= 10000
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_chat_limiter_shared_through_env(monkeypatch):
+    monkeypatch.setenv(bot_chat.ChatLimiterManager.ADDRESS_ENV, "")
+    monkeypatch.setenv(bot_chat.ChatLimiterManager.AUTHKEY_ENV, "")
+    manager = bot_chat.ChatLimiterManager.serve(1)
+    try:
+        first = bot_chat.ChatConcurrencyLimiter.from_env()
+        second = bot_chat.ChatConcurrencyLimiter.from_env()
+        with first:
+            assert second.semaphore.acquire(timeout=0.1) is False
+        assert second.semaphore.acquire(timeout=0.1) is True
+        second.semaphore.release()
+    finally:
+        manager.shutdown()
@@ -196,6 +196,16 @@ def test_format_cell_options_skips_none_and_falsey():
     assert "coding_prompt:" not in options_str
 
 
+def test_format_cell_options_skips_exec_profile():
+    cell = make_code_cell("%%bot\nprint('hi')")
+    ctx = bc.AgentCellContext(0, cell)
+    ctx.agent_data.task_id = "tid"
+    ctx.agent_data.exec_profile = {"wall_time": 1.5, "hotspots": ["f"]}
+    options_str = ctx.format_cell_options()
+    assert "task_id: tid" in options_str
+    assert "exec_profile" not in options_str and "wall_time" not in options_str
+
+
 def test_cell_context_match_subclass_returns_subclass():
     # UserSupplyInfoCellContext should match a raw cell with correct prefix
     cell = {
@@ -403,3 +413,60 @@ def test_notebook_context_cells_handles_invalid_notebook(tmp_path):
     ctx = bc.NotebookContext("", "", str(nb_path))
     cells = ctx.cells
     assert cells == []
+
+
+def test_cell_context_content_hash_tracks_changes():
+    cell = make_code_cell("print('hi')", outputs=[{"output_type": "stream", "name": "stdout", "text": "hi\n"}])
+    ctx1 = bc.CodeCellContext(0, cell)
+    ctx2 = bc.CodeCellContext(0, cell)
+    assert ctx1.content_hash == ctx2.content_hash
+    ctx2.cell_output = "changed"
+    assert ctx1.content_hash != ctx2.content_hash
+    assert bc.CodeCellContext(1, cell).content_hash != ctx1.content_hash
+    assert bc.CellContext(0, cell).content_hash != ctx1.content_hash
+
+
+def test_notebook_context_reuses_unchanged_cells(tmp_path):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [
+        nbformat.v4.new_code_cell("print('a')"),
+        nbformat.v4.new_markdown_cell("Some text"),
+        nbformat.v4.new_code_cell("%%bot -s stage1\nprint('b')"),
+    ]
+    nb_path = tmp_path / "testnb_cache.ipynb"
+    with open(nb_path, "w", encoding="utf-8") as f:
+        nbformat.write(nb, f)
+    first = bc.NotebookContext("-s stage1", "print('b')", str(nb_path)).cells
+    nb.cells[1].source = "Changed text"
+    with open(nb_path, "w", encoding="utf-8") as f:
+        nbformat.write(nb, f)
+    ctx = bc.NotebookContext("-s stage1", "print('b')", str(nb_path))
+    second = ctx.cells
+    assert len(first) == len(second) == 2
+    assert second[0] is first[0]
+    assert second[1] is not first[1]
+    assert second[1].source == "Changed text"
+    assert ctx.cur_task is not bc.NotebookContext("-s stage1", "print('b')", str(nb_path)).cur_task
+
+
+def test_read_notebook_skips_binary_outputs(tmp_path):
+    from jupyter_agent.utils import read_notebook
+
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [
+        nbformat.v4.new_code_cell(
+            "plot()\nshow()",
+            outputs=[
+                nbformat.v4.new_output(
+                    "display_data", data={"image/png": "iVBORw0KGgo=" * 1000, "text/plain": "<Figure>"}
+                )
+            ],
+        )
+    ]
+    nb_path = tmp_path / "plots.ipynb"
+    with open(nb_path, "w", encoding="utf-8") as f:
+        nbformat.write(nb, f)
+    with open(nb_path, "rb") as f:
+        lean = read_notebook(f)
+    assert lean["cells"][0]["source"] == "plot()\nshow()"
+    assert lean["cells"][0]["outputs"][0]["data"] == {"text/plain": "<Figure>"}
@@ -1,4 +1,5 @@
 import os
+import json
 import tempfile
 import time
 import nbformat
@@ -138,6 +139,7 @@ def test_on_cell_executed_triggers_save(tmp_path):
     execute_reply = {"content": {"payload": []}}
     with patch("nbformat.write") as mock_write:
         runner.on_cell_executed(0, cell, execute_reply)
+        runner.checkpoint.flush()
         mock_write.assert_called_once()
 
 
@@ -225,3 +227,126 @@ def test_handle_set_next_cell_unsupported_index(sample_notebook):
     action = bot_evaluation.ActionSetCellContent(params=params)
     with pytest.raises(ValueError, match="Unsupported set_next_cell index: -2"):
         runner.handle_set_next_cell(0, action)
+
+
+def test_collect_notebooks(tmp_path):
+    for name in ("b.ipynb", "a.ipynb", "notes.txt"):
+        (tmp_path / name).write_text("{}")
+    assert [p.name for p in bot_evaluation.collect_notebooks(str(tmp_path))] == ["a.ipynb", "b.ipynb"]
+    assert [p.name for p in bot_evaluation.collect_notebooks(str(tmp_path / "a*"))] == ["a.ipynb"]
+    assert bot_evaluation.collect_notebooks("single.ipynb") == [Path("single.ipynb")]
+
+
+def test_run_batch_merges_records(tmp_path, capsys):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def fake_run_notebook(kwargs):
+        record = bot_evaluation.FlowEvaluationRecord(notebook_name=str(kwargs["output_path"]), is_success=True)
+        with open(kwargs["evaluate_path"], "w") as f:
+            f.write(record.model_dump_json() + "\n")
+        return {
+            "notebook": str(kwargs["input_path"]),
+            "evaluate_path": str(kwargs["evaluate_path"]),
+            "duration": 0.1,
+            "error": "",
+        }
+
+    notebooks = [tmp_path / "a.ipynb", tmp_path / "b.ipynb"]
+    with patch.object(bot_evaluation, "ProcessPoolExecutor", ThreadPoolExecutor), patch.object(
+        bot_evaluation, "run_notebook", fake_run_notebook
+    ):
+        results = bot_evaluation.run_batch(notebooks, output_dir=tmp_path / "out", jobs=2)
+    assert len(results) == 2
+    lines = (tmp_path / "out" / "evaluation.jsonl").read_text().splitlines()
+    assert len(lines) == 2
+    out = capsys.readouterr().out
+    assert "1/1" in out and "b.ipynb" in out
+
+
+def test_checkpoint_writer_coalesces_and_writes_atomically(tmp_path):
+    out_path = tmp_path / "out.ipynb"
+    writer = bot_evaluation.NotebookCheckpointWriter(out_path, interval=0, every_n=3)
+    nb = nbformat.v4.new_notebook()
+    for i in range(7):
+        nb.cells.append(nbformat.v4.new_code_cell(source=f"x = {i}"))
+        writer.notify(nb)
+    writer.flush()
+    assert 1 <= writer.writes <= 2
+    assert len(nbformat.read(out_path, as_version=4).cells) == 6
+    assert writer.dirty
+    writer.close(nb)
+    assert len(nbformat.read(out_path, as_version=4).cells) == 7
+    assert [p.name for p in tmp_path.iterdir()] == ["out.ipynb"]
+
+
+def test_jsonl_sink_buffers_until_flush(tmp_path):
+    import gzip
+
+    for name, opener in (("eval.jsonl", open), ("eval.jsonl.gz", gzip.open)):
+        path = tmp_path / name
+        sink = bot_evaluation.create_evaluation_sink(path, buffer_size=3, flush_interval=60)
+        for i in range(5):
+            sink.write(bot_evaluation.StageEvaluationRecord(cell_index=i))
+        with opener(path, "rt") as f:
+            assert len(f.readlines()) == 4
+        sink.close()
+        with opener(path, "rt") as f:
+            assert [json.loads(line)["cell_index"] for line in f] == [0, 1, 2, 3, 4]
+
+
+def test_npz_sink_writes_columns(tmp_path):
+    np = pytest.importorskip("numpy")
+    path = tmp_path / "eval.npz"
+    with bot_evaluation.create_evaluation_sink(path) as sink:
+        sink.write(bot_evaluation.FlowEvaluationRecord(correct_score=0.5, is_success=True, flow="f"))
+        sink.write(bot_evaluation.StageEvaluationRecord(correct_score=1.0))
+    with bot_evaluation.create_evaluation_sink(path) as sink:
+        sink.write(bot_evaluation.NotebookEvaluationRecord())
+    with np.load(path) as data:
+        assert data["correct_score"].tolist() == [0.5, 1.0, 0.0]
+        assert data["eval_type"].tolist() == ["FLOW", "STAGE", "NOTEBOOK"]
+        assert data["is_success"].dtype == np.bool_
+        assert "response_cache" not in data
+
+
+def test_runner_reassembles_incremental_output_records(sample_notebook, tmp_path, monkeypatch):
+    from jupyter_agent import bot_outputs
+
+    displayed = []
+
+    class Handler:
+        def update(self, obj, metadata=None):
+            displayed.append(metadata)
+
+    def fake_display(obj, metadata=None, **kwargs):
+        displayed.append(metadata)
+        return Handler()
+
+    monkeypatch.setattr(bot_outputs, "display", fake_display)
+    ao = bot_outputs.AgentOutput()
+    for i in range(3):
+        ao.log_evaluation(bot_evaluation.StageEvaluationRecord(cell_index=0, stage=f"s{i}"))
+        ao.display(wait=True)
+    ao.output_markdown("no new records")
+    ao.display(wait=True)
+
+    runner = bot_evaluation.NotebookRunner(str(sample_notebook), evaluate_path=tmp_path / "eval.jsonl")
+    cell = runner.notebook.cells[0]
+    for metadata in displayed:
+        msg = {
+            "msg_type": "update_display_data",
+            "header": {"msg_type": "update_display_data"},
+            "content": {"data": {}, "metadata": metadata, "transient": {"display_id": "agent"}},
+        }
+        runner.client.process_message(msg, cell, 0)
+    assert "jupyter-agent-evaluation-records" not in displayed[-1]
+    runner.handle_evaluation_record(0, [displayed[-1]])
+    runner.evaluation_sink.flush()
+    stages = [json.loads(line)["stage"] for line in open(tmp_path / "eval.jsonl")]
+    assert stages[:3] == ["s0", "s1", "s2"]
+
+    # 最终快照与已收到的增量记录按序号去重
+    runner = bot_evaluation.NotebookRunner(str(sample_notebook))
+    runner.on_display_metadata(0, displayed[1])
+    records = runner.get_output_records(0, [ao.display_metadata(final=True)], "jupyter-agent-evaluation-records")
+    assert [r["stage"] for r in records] == ["s0", "s1", "s2"]
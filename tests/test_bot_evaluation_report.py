@@ -0,0 +1,176 @@
+import json
+import pytest
+
+from jupyter_agent import bot_evaluation
+
+np = pytest.importorskip("numpy")
+
+from jupyter_agent import bot_evaluation_report as report
+
+
+def write_records(path, count=50):
+    with bot_evaluation.create_evaluation_sink(path, buffer_size=1024) as sink:
+        for i in range(count):
+            sink.write(
+                bot_evaluation.StageEvaluationRecord(
+                    flow="F", stage="coding", agent="A" if i % 2 else "B", execution_duration=float(i), is_success=i < 40
+                )
+            )
+            sink.write(
+                bot_evaluation.FlowEvaluationRecord(
+                    flow="F", stage="completed", stage_count=i % 3 + 1, execution_duration=1.0, is_success=True
+                )
+            )
+            sink.write(bot_evaluation.FlowEvaluationRecord(flow="F", evaluator="judge", correct_score=(i % 5) / 4))
+
+
+def by_key(summary):
+    return {(s["eval_type"], s["agent"], s["evaluator"]): s for s in summary}
+
+
+@pytest.mark.parametrize("name", ["eval.jsonl", "eval.jsonl.gz", "eval.npz"])
+def test_report_groups_records(tmp_path, name):
+    write_records(tmp_path / name)
+    summary = by_key(report.EvaluationReport(seed=0).add_files([tmp_path / name], chunk_size=7).summary())
+    assert set(summary) == {("STAGE", "A", ""), ("STAGE", "B", ""), ("FLOW", "", ""), ("FLOW", "", "judge")}
+    stage_a = summary[("STAGE", "A", "")]
+    assert stage_a["count"] == 25
+    assert stage_a["success_rate"] == pytest.approx(20 / 25)
+    assert stage_a["latency"]["p50"] == pytest.approx(np.percentile(np.arange(1, 50, 2), 50))
+    assert summary[("FLOW", "", "")]["stage_counts"] == {1: 17, 2: 17, 3: 16}
+    assert summary[("FLOW", "", "")]["scores"] == {}
+    correct = summary[("FLOW", "", "judge")]["scores"]["correct_score"]
+    assert correct["mean"] == pytest.approx(0.5)
+    assert correct["ci"][0] < 0.5 < correct["ci"][1]
+
+
+def test_group_stats_reservoir_is_bounded():
+    report_ = report.EvaluationReport(max_samples=100, seed=0)
+    for start in range(0, 10000, 1000):
+        columns = report._records_to_columns(
+            [{"eval_type": "STAGE", "execution_duration": float(i)} for i in range(start, start + 1000)],
+            report.REPORT_FIELDS,
+        )
+        report_.add_chunk(columns)
+    (group,) = report_.groups.values()
+    assert group.count == 10000
+    assert len(group.samples) == 100
+    assert 3000 < np.median(group.samples[:, 0]) < 7000
+
+
+def test_bootstrap_mean_ci_scales_subsample():
+    rng = np.random.default_rng(0)
+    values = rng.normal(1.0, 1.0, size=400)
+    low, high = report.bootstrap_mean_ci(values, rng=rng)
+    assert low < values.mean() < high
+    assert high - low == pytest.approx(2 * 1.96 / 20, rel=0.2)
+    low, high = report.bootstrap_mean_ci(values, rng=rng, total=40000)
+    assert high - low == pytest.approx(2 * 1.96 / 200, rel=0.2)
+
+
+def test_bootstrap_mean_ci_shares_indices_across_columns():
+    values = np.random.default_rng(0).normal(1.0, 1.0, size=(400, 3))
+    bounds = report.bootstrap_mean_ci(values, rng=np.random.default_rng(1))
+    assert len(bounds) == 3
+    for column, (low, high) in zip(values.T, bounds):
+        assert low < column.mean() < high
+    assert bounds[0] == report.bootstrap_mean_ci(values[:, 0], rng=np.random.default_rng(1))
+
+
+def test_main_dispatches_report(tmp_path, capsys):
+    write_records(tmp_path / "eval.jsonl", count=10)
+    argv = ["report", "--seed", "0", "--json", str(tmp_path / "r.json"), str(tmp_path / "eval.jsonl")]
+    assert bot_evaluation.main(argv) == 0
+    out = capsys.readouterr().out
+    assert "STAGE" in out and "1:4 2:3 3:3" in out
+    assert len(json.loads((tmp_path / "r.json").read_text())) == 4
+
+
+def write_run(path, notebook, slowdown=0.0, score_drop=0.0, count=40):
+    rng = np.random.default_rng(1)
+    with bot_evaluation.create_evaluation_sink(path, buffer_size=1024) as sink:
+        for i in range(count):
+            for _ in range(2):  # 同一阶段重试两次
+                sink.write(
+                    bot_evaluation.StageEvaluationRecord(
+                        notebook_name=notebook,
+                        cell_index=i,
+                        flow="F",
+                        stage="coding",
+                        agent="A",
+                        execution_duration=1.0 + rng.random() + slowdown,
+                    )
+                )
+            sink.write(
+                bot_evaluation.FlowEvaluationRecord(
+                    notebook_name=notebook,
+                    cell_index=i,
+                    flow="F",
+                    evaluator="judge",
+                    correct_score=0.8 - score_drop + rng.random() * 0.1,
+                )
+            )
+
+
+def test_alignment_keys_number_retries():
+    def columns(names):
+        records = [{"eval_type": "STAGE", "notebook_name": name, "cell_index": 1} for name in names]
+        return report._records_to_columns(records, report.COMPARE_FIELDS)
+
+    keys_a, keys_b = report.alignment_keys(
+        columns(["/a/nb_1700000000.ipynb"] * 3), columns(["/b/nb_1700000999.ipynb"] * 2 + ["/b/other.ipynb"])
+    )
+    assert len(set(keys_a)) == 3
+    assert np.intersect1d(keys_a, keys_b).tolist() == sorted(keys_b[:2].tolist())
+
+
+def test_compare_runs_flags_regressions(tmp_path):
+    write_run(tmp_path / "a.jsonl", "/run_a/nb_1700000000.ipynb")
+    write_run(tmp_path / "b.jsonl", "/run_b/nb_1700000999.ipynb", slowdown=0.5, score_drop=0.2, count=45)
+    rows, stats = report.compare_runs(
+        report.load_columns([tmp_path / "a.jsonl"], report.COMPARE_FIELDS),
+        report.load_columns([tmp_path / "b.jsonl"], report.COMPARE_FIELDS),
+        seed=0,
+    )
+    assert stats == {"matched": 120, "only_a": 0, "only_b": 15}
+    rows = {(row["eval_type"], row["metric"]): row for row in rows}
+    duration = rows[("STAGE", "execution_duration")]
+    assert duration["pairs"] == 80
+    assert duration["delta"] == pytest.approx(0.5)
+    assert duration["status"] == "regression"
+    assert rows[("FLOW", "correct_score")]["status"] == "regression"
+    assert rows[("FLOW", "correct_score")]["ci"][1] < 0
+    assert ("FLOW", "planning_score") not in rows
+
+
+def test_adjust_p_values():
+    p_values = [0.01, 0.04, 0.03, 0.2]
+    assert report.adjust_p_values(p_values, "holm") == pytest.approx([0.04, 0.09, 0.09, 0.2])
+    assert report.adjust_p_values(p_values, "bh") == pytest.approx([0.04, 0.16 / 3, 0.16 / 3, 0.2])
+    assert report.adjust_p_values(p_values, "none") == p_values
+    with pytest.raises(ValueError):
+        report.adjust_p_values(p_values, "bonferroni")
+
+
+def test_compare_runs_relative_change_from_zero(tmp_path):
+    def columns(scores):
+        records = [
+            {"eval_type": "FLOW", "notebook_name": "nb", "cell_index": i, "flow": "F", "correct_score": s}
+            for i, s in enumerate(scores)
+        ]
+        return report._records_to_columns(records, report.COMPARE_FIELDS)
+
+    rows, _ = report.compare_runs(columns([0.0, 0.0, 0.0]), columns([0.5, 0.6, 0.7]), seed=0)
+    (row,) = [row for row in rows if row["metric"] == "correct_score"]
+    assert row["relative"] is None
+    assert "n/a" in report.format_compare_rows([row])[0]["delta"]
+    json.dumps(rows, allow_nan=False)
+
+
+def test_main_compare_exit_code(tmp_path, capsys):
+    write_run(tmp_path / "a.jsonl", "nb")
+    write_run(tmp_path / "same.jsonl", "nb")
+    write_run(tmp_path / "slow.jsonl", "nb", slowdown=0.5)
+    assert bot_evaluation.main(["compare", "--seed", "0", str(tmp_path / "a.jsonl"), str(tmp_path / "same.jsonl")]) == 0
+    assert bot_evaluation.main(["compare", "--seed", "0", str(tmp_path / "a.jsonl"), str(tmp_path / "slow.jsonl")]) == 1
+    assert "REGRESSION" in capsys.readouterr().out
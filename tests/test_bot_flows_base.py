@@ -1,9 +1,12 @@
+import time
 import pytest
 from unittest.mock import MagicMock, patch
 from enum import Enum
 from pydantic import BaseModel
 from jupyter_agent.bot_agents.base import BaseAgent
 from jupyter_agent.bot_flows import base
+from jupyter_agent.bot_evaluators.base import BaseEvaluator
+from jupyter_agent.bot_evaluation import StageEvaluationRecord
 
 
 # Dummy Enum and Agent for testing
@@ -201,3 +204,149 @@ def test_call_with_failure_and_retry(
     with patch("builtins.input", return_value="c"):
         result = flow(start_stage=DummyStage.START, max_tries=1, stage_continue=True, stage_confirm=False)
     assert result == DummyStage.START
+
+
+class InterruptAgent(BaseAgent):
+    def __call__(self):
+        raise KeyboardInterrupt()
+
+
+@patch("jupyter_agent.bot_flows.base.set_stage")
+def test_call_shuts_down_on_interrupt(mock_set_stage, notebook_context):
+    class InterruptFlow(base.BaseTaskFlow):
+        STAGE_NODES = [DummyStageTransition(stage=DummyStage.START, agents=InterruptAgent, states={})]
+        START_STAGE = DummyStage.START
+        STOP_STAGES = [DummyStage.END]
+
+    flow = InterruptFlow(notebook_context, lambda a: a(notebook_context))
+    with patch.object(flow, "shutdown") as mock_shutdown, pytest.raises(KeyboardInterrupt):
+        flow(start_stage=DummyStage.START, max_tries=1, stage_continue=True, stage_confirm=False)
+    mock_shutdown.assert_called_once()
+
+
+class SlowAgent(BaseAgent):
+    calls = []
+
+    def __call__(self):
+        time.sleep(0.2)
+        SlowAgent.calls.append(type(self).__name__)
+        return False, "success"
+
+
+class SlowAgentA(SlowAgent):
+    pass
+
+
+class SlowAgentB(SlowAgent):
+    pass
+
+
+class SlowAgentC(SlowAgent):
+    pass
+
+
+def make_concurrent_flow(depends=None):
+    class ConcurrentFlow(base.BaseTaskFlow):
+        STAGE_NODES = [
+            DummyStageTransition(
+                stage=DummyStage.START,
+                agents=[SlowAgentA, SlowAgentB, SlowAgentC],
+                concurrent=True,
+                depends=depends or {},
+                states={"success": DummyStageNext(stage=DummyStage.END)},
+            ),
+            DummyStageTransition(stage=DummyStage.END, agents=DummyAgent, states={}),
+        ]
+        START_STAGE = DummyStage.START
+        STOP_STAGES = [DummyStage.END]
+
+    return ConcurrentFlow
+
+
+def test_run_stage_agents_concurrently(notebook_context):
+    SlowAgent.calls = []
+    flow = make_concurrent_flow()(notebook_context, lambda a: a(notebook_context))
+    agents = flow.get_stage_agents(DummyStage.START)
+    st = time.time()
+    assert flow.run_stage_agents(DummyStage.START, agents) == (False, "success")
+    assert time.time() - st < 0.5
+    assert sorted(SlowAgent.calls) == ["SlowAgentA", "SlowAgentB", "SlowAgentC"]
+
+
+def test_run_stage_agents_respects_depends(notebook_context):
+    SlowAgent.calls = []
+    flow = make_concurrent_flow({SlowAgentC: [SlowAgentA]})(notebook_context, lambda a: a(notebook_context))
+    agents = flow.get_stage_agents(DummyStage.START)
+    flow.run_stage_agents(DummyStage.START, agents)
+    assert SlowAgent.calls.index("SlowAgentA") < SlowAgent.calls.index("SlowAgentC")
+
+
+def test_depends_must_follow_declaration_order(notebook_context):
+    with pytest.raises(AssertionError):
+        make_concurrent_flow({SlowAgentA: [SlowAgentC]})(notebook_context, lambda a: a(notebook_context))
+
+
+class SlowEvaluator(BaseEvaluator):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self):
+        time.sleep(0.2)
+        return StageEvaluationRecord(evaluator="slow")
+
+
+@patch("jupyter_agent.bot_flows.base.set_stage")
+@patch("jupyter_agent.bot_flows.base._M")
+@patch("jupyter_agent.bot_flows.base.output_evaluation")
+@patch("jupyter_agent.bot_flows.base.flush_output")
+def test_call_with_deferred_evaluators(mock_flush, mock_output_eval, mock_M, mock_set_stage, notebook_context):
+    class EvalFlow(base.BaseTaskFlow):
+        STAGE_NODES = [
+            DummyStageTransition(
+                stage=DummyStage.START,
+                agents=DummyAgent,
+                evaluators=[SlowEvaluator, SlowEvaluator],
+                states={"success": DummyStageNext(stage=DummyStage.MIDDLE)},
+            ),
+            DummyStageTransition(
+                stage=DummyStage.MIDDLE,
+                agents=DummyAgent,
+                evaluators=[SlowEvaluator],
+                states={"success": DummyStageNext(stage=DummyStage.END)},
+            ),
+            DummyStageTransition(stage=DummyStage.END, agents=DummyAgent, states={}),
+        ]
+        START_STAGE = DummyStage.START
+        STOP_STAGES = [DummyStage.END]
+        FLOW_EVALUATOR = None
+
+    flow = EvalFlow(
+        notebook_context,
+        lambda a: a(notebook_context),
+        lambda e: e(),
+        defer_evaluating=True,
+    )
+    st = time.time()
+    result = flow(start_stage=DummyStage.START, max_tries=2, stage_continue=True, stage_confirm=False)
+    assert result == DummyStage.END
+    assert time.time() - st < 0.5
+    stage_records = [c.args[0] for c in mock_output_eval.call_args_list if c.args[0].agent == "DummyAgent"]
+    assert len(stage_records) >= 3
+    assert {r.stage for r in stage_records} >= {str(DummyStage.START), str(DummyStage.MIDDLE)}
+
+
+@patch("jupyter_agent.bot_flows.base.set_stage")
+@patch("jupyter_agent.bot_flows.base._M")
+@patch("jupyter_agent.bot_flows.base.output_evaluation")
+@patch("jupyter_agent.bot_flows.base.flush_output")
+def test_call_records_exec_profile(mock_flush, mock_output_eval, mock_M, mock_set_stage, notebook_context):
+    class ProfiledAgent(DummyAgent):
+        profile = {"wall_time": 1.5, "hotspots": []}
+
+    flow_cls = make_simple_flow()
+    flow_cls.STAGE_NODES[0].agents = ProfiledAgent
+    flow = flow_cls(notebook_context, lambda agent_type: agent_type(DummyNotebookContext()), None)
+    flow(start_stage=DummyStage.START, max_tries=2, stage_continue=True, stage_confirm=False)
+    records = [call.args[0] for call in mock_output_eval.call_args_list]
+    stage_records = [r for r in records if isinstance(r, StageEvaluationRecord) and r.agent == "ProfiledAgent"]
+    assert stage_records[0].exec_profile == {"wall_time": 1.5, "hotspots": []}
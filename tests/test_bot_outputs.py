@@ -1,6 +1,7 @@
 import pytest
 import types
 import json
+import jinja2
 import time
 
 import jupyter_agent.bot_outputs as bot_outputs
@@ -32,7 +33,8 @@ def test_agent_output_init_defaults():
     assert ao.title is None
     assert ao.collapsed is False
     assert ao.logging_level == 20  # INFO
-    assert isinstance(ao.jinja_env, type(bot_outputs.jinja2.Environment()))
+    assert isinstance(ao.template, jinja2.Template)
+    assert isinstance(ao.stage_template, jinja2.Template)
     assert ao._contents == {}
     assert ao._active_stage is None
 
@@ -95,13 +97,58 @@ def test_log_and_logging_levels(patch_display):
     ao.log("debug msg", level="DEBUG")
     ao.log("info msg", level="INFO")
     ao.log("warn msg", level="WARN")
-    logs = ao._logging_records
-    assert any("debug msg" in l["content"] for l in logs)
-    assert any("info msg" in l["content"] for l in logs)
-    assert any("warn msg" in l["content"] for l in logs)
-    # Should merge consecutive logs of same level
+    logs = ao._log_store.records()
+    assert any("debug msg" in l for l in logs)
+    assert any("info msg" in l for l in logs)
+    assert any("warn msg" in l for l in logs)
     ao.log("another debug", level="DEBUG")
-    assert "another debug" in logs[-1]["content"]
+    assert "another debug" in ao._log_store.records()[-1]
+
+
+def test_log_store_rejects_below_level_and_formats_lazily(patch_display):
+    ao = bot_outputs.AgentOutput(logging_level="INFO")
+    called = []
+    ao.log(lambda: called.append(1) or "lazy", "DEBUG")
+    ao.log("value {} {!r:.5}", "INFO", 1, "abcdefgh")
+    assert called == []
+    assert len(ao._log_store) == 1
+    assert ao._log_store.records()[0].endswith("INFO: value 1 'abcd")
+    ao.logging_level = "WARN"
+    assert "Logging" not in ao._stage_contents()
+
+
+def test_log_store_is_bounded_and_spills(tmp_path, patch_display):
+    spill_path = tmp_path / "agent.log"
+    ao = bot_outputs.AgentOutput(logging_level="INFO", max_log_records=10, log_spill_path=spill_path)
+    for i in range(30):
+        ao.log("info {}", "INFO", i)
+        ao.log("debug {}", "DEBUG", i)
+    assert len(ao._log_store) == 10
+    logs = [log["content"] for log in ao._stage_contents()["Logging"]]
+    assert logs[0] == f"... 20 earlier log records dropped, see {spill_path}"
+    assert logs[-1].endswith("INFO: info 29")
+    ao.close()
+    lines = spill_path.read_text().splitlines()
+    assert len(lines) == 60
+    assert lines[1].endswith("DEBUG: debug 0")
+
+
+def test_log_store_dropped_counts_records_omitted_by_merge(patch_display):
+    store = bot_outputs.LogStore(max_records=10)
+    for i in range(8):
+        store.append(20, "INFO", f"info {i}")
+        store.append(30, "WARN", f"warn {i}")
+    assert len(store.records()) == 10 and store.dropped() == 6
+    assert len(store.records(30)) == 8 and store.dropped(30) == 0
+
+
+def test_output_agent_data_logs_lazily(patch_display):
+    ao = bot_outputs.AgentOutput(logging_level="INFO")
+    formatted = []
+    ao.log = lambda msg, level="INFO", *args: formatted.append((msg, level))
+    ao.output_agent_data(task_id="t1")
+    assert len(formatted) == 1 and callable(formatted[0][0]) and formatted[0][1] == "DEBUG"
+    assert formatted[0][0]() == "output agent data {'task_id': 't1'}"
 
 
 def test_get_output_and_reset_output(monkeypatch):
@@ -160,3 +207,86 @@ def test_agent_display_and_aliases(monkeypatch):
     # Test _O, _C
     assert bot_outputs._O("OBJ2", reply_type="RT2") == "displayed"
     assert bot_outputs._C("OBJ3", reply_type="RT3") == "displayed"
+
+
+def count_updates(dummy):
+    return sum(1 for call in dummy.calls if call[0] == "update")
+
+
+def test_display_updates_are_coalesced_in_background(patch_display):
+    ao = bot_outputs.AgentOutput()
+    ao.display_interval = 0.1
+    ao.display("Stage1")
+    st = time.time()
+    for i in range(200):
+        ao.log(f"line {i}")
+    assert time.time() - st < 0.5
+    assert count_updates(patch_display) <= 1
+    time.sleep(0.3)
+    assert count_updates(patch_display) <= 2
+    assert "line 199" in patch_display.calls[-1][1][0].data
+    assert not ao._is_dirty
+
+
+def test_flush_output_does_not_wait_for_throttle(patch_display):
+    ao = bot_outputs.reset_output(stage="Stage1")
+    ao.display_interval = 10
+    ao.log("first")
+    st = time.time()
+    bot_outputs.flush_output()
+    assert time.time() - st < 0.5
+    assert ao._render_timer is None
+    assert "first" in patch_display.calls[-1][1][0].data
+
+
+def test_only_dirty_stages_are_rerendered(patch_display):
+    ao = bot_outputs.AgentOutput()
+    ao.output_markdown("a", stage="S1")
+    ao.output_markdown("b", stage="S2")
+    ao.content
+    rendered = []
+    render = ao.stage_template.render
+    ao.stage_template = types.SimpleNamespace(
+        render=lambda stage, contents: rendered.append(stage) or render(stage=stage, contents=contents)
+    )
+    ao.output_markdown("c", stage="S2")
+    content = ao.content
+    assert rendered == ["S2"]
+    assert "c" in content and "a" in content
+
+
+def test_metadata_is_serialized_only_after_changes(patch_display, monkeypatch):
+    from jupyter_agent.bot_evaluation import StageEvaluationRecord
+
+    ao = bot_outputs.AgentOutput()
+    ao.output_agent_data(task_id="t1")
+    dumps = []
+    monkeypatch.setattr(bot_outputs.json, "dumps", lambda *args, **kwargs: dumps.append(1) or "{}")
+    ao.log("message")
+    ao.output_markdown("a", stage="S1")
+    ao.content
+    assert len(dumps) == 0
+    ao.log_evaluation(StageEvaluationRecord(cell_index=0))
+    ao.content
+    ao.content
+    assert len(dumps) == 1
+
+
+def test_display_metadata_sends_only_new_records(patch_display):
+    from jupyter_agent.bot_evaluation import StageEvaluationRecord
+
+    key = "jupyter-agent-evaluation-records"
+    ao = bot_outputs.AgentOutput()
+    ao.display_interval = 60
+    ao.display("Stage1")
+    ao.log_evaluation(StageEvaluationRecord(cell_index=0))
+    ao.log_evaluation(StageEvaluationRecord(cell_index=1))
+    first = ao.display_metadata()
+    assert [r["cell_index"] for r in first[key]] == [0, 1] and first[key + "-start"] == 0
+    assert key not in ao.display_metadata()
+    ao.log_evaluation(StageEvaluationRecord(cell_index=2))
+    update = ao.display_metadata()
+    assert [r["cell_index"] for r in update[key]] == [2] and update[key + "-start"] == 2
+    final = ao.display_metadata(final=True)
+    assert [r["cell_index"] for r in final[key]] == [0, 1, 2] and final["jupyter-agent-output-final"]
+    assert final["jupyter-agent-output-id"] == update["jupyter-agent-output-id"]